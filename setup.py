@@ -2,6 +2,9 @@ try:
     from setuptools import setup, Extension
 except ImportError:
     from distutils.core import setup, Extension
+from distutils.command.build_ext import build_ext
+from distutils.errors import (CCompilerError, DistutilsExecError,
+                              DistutilsPlatformError)
     
 import os
 import sys
@@ -30,6 +33,30 @@ Topic :: Software Development :: Libraries :: Python Modules
 
 """.split('\n'))
 
+class optional_build_ext(build_ext):
+    """
+    ewa falls back to a pure Python version of the frameinfo
+    extension, so a failure to compile it shouldn't stop installation.
+    """
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError, e:
+            self._warn(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError,
+                DistutilsPlatformError), e:
+            self._warn(e)
+
+    def _warn(self, e):
+        print >> sys.stderr, ("WARNING: could not compile the frameinfo "
+                              "extension (%s); ewa will use the slower "
+                              "pure Python version." % e)
+
 setup(author='Jacob Smullyan',
       author_email='jsmullyan@gmail.com',
       url='http://eastwestaudio.wnyc.org/',
@@ -46,9 +73,9 @@ setup(author='Jacob Smullyan',
       test_suite='nose.collector',
       ext_modules=[Extension('ewa.frameinfo',
                              ['src/ewa/frameinfo.c'])],
+      cmdclass={'build_ext' : optional_build_ext},
       scripts=['bin/ewasplice',
                'bin/ewabatch',
                'bin/ewa'],
-      install_requires=['eyed3'],
       )
       
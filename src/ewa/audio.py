@@ -16,18 +16,31 @@ This module is responsible for managing audio files:
 import os
 import thread
 
-from eyed3.mp3 import Mp3Exception
-from eyed3.id3.tag import TagException
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
-from ewa.mp3 import get_vbr_bitrate_samplerate_mode, splice
-from ewa.transcode import transcode
-from ewa.logutil import warn
-from ewa.rules import DefaultRule
+from ewa.iohints import get_io_hints
+from ewa.mp3 import (get_vbr_bitrate_samplerate_mode, plan_length,
+                     probe_mp3s, splice, splice_plan,
+                     splice_timing, splice_to_file, Mp3Error,
+                     RANGE_SPLICERS)
+from ewa.manifest import MANIFEST_SUFFIX, write_manifest
+from ewa.singleflight import single_flight, LOCK_TIMEOUT
+from ewa.transcode import (is_current, transcode, transcode_map,
+                           TranscodeError)
+from ewa.logutil import exception, warn
+from ewa.rules import DefaultRule, possible_extras
 
 path_join = os.path.join
 path_exists = os.path.exists
 getmtime = os.path.getmtime
 
+# appended to the name of a combined file to get that of its
+# timing sidecar
+SIDECAR_SUFFIX = '.json'
+
 
 def is_original(s):
     return getattr(s, 'is_original', False)
@@ -82,12 +95,9 @@ class BaseAudioProvider(object):
             path += '.mp3'
         if create:
             orig_path = self.get_extra_master_path(audioname)
-            if path_exists(path):
-                trans_mtime = getmtime(path)
-                orig_mtime = getmtime(orig_path)
-                if orig_mtime <= trans_mtime:
-                    # no transcoding necessary, return
-                    return path
+            if is_current(orig_path, path):
+                # no transcoding necessary, return
+                return path
             # either transcoded file is out of date
             # or it doesn't exist, transcode
             transcode(orig_path, path, bitrate, samplerate, mode)
@@ -101,7 +111,7 @@ class BaseAudioProvider(object):
         try:
             (isvbr, bitrate,
              samplerate, mode) = get_vbr_bitrate_samplerate_mode(audiopath)
-        except (Mp3Exception, TagException), exc:
+        except Mp3Error, exc:
             if self.tolerate_broken:
                 warn('got %s for %s', exc, audiopath)
                 # no splicing, return default rule
@@ -136,54 +146,269 @@ class BaseAudioProvider(object):
                     warn("extra audio not found: %s", x)
                     return None
 
-        return [y for y in (resolve(x) for x in symbols) if y]
+        if create:
+            # extras that are missing or out of date are transcoded
+            # at the same time; the rest needn't wait for the pool
+            transcode_map(resolve,
+                          [x for x in symbols
+                           if not is_original(x) and
+                           self._needs_transcode(x, mode, bitrate,
+                                                 samplerate)])
+        paths = map(resolve, symbols)
+        return [y for y in paths if y]
+
+    def _needs_transcode(self, audioname, mode, bitrate, samplerate):
+        try:
+            master = self.get_extra_master_path(audioname)
+        except FileNotFound:
+            return False
+        return not is_current(master,
+                              self.get_extra_transcoded_path(audioname,
+                                                             mode,
+                                                             bitrate,
+                                                             samplerate))
+
+    def get_combined_plan(self, audioname, rule, xing=False):
+        """
+        returns the splice plan (see ewa.mp3.splice_plan) of the
+        combined file for audioname, without producing it.
+        """
+        if audioname.startswith('/'):
+            audioname = audioname[1:]
+        mainpath = self.get_main_path(audioname)
+        playlist = self.get_playlist(audioname, rule)
+        return splice_plan(playlist, mainpath, xing)
+
+    def get_format_census(self, audionames, jobs=1):
+        """
+        probes the main files for audionames, using jobs worker
+        processes, and returns a tuple (formats, skipped): a
+        dictionary mapping each audioname whose main file is CBR to
+        its (bitrate, samplerate, mode), and a list of those that are
+        VBR or couldn't be probed, which get no extras.
+        """
+        audionames = list(audionames)
+        probes = probe_mp3s([self.get_main_path(a) for a in audionames],
+                            jobs)
+        formats = {}
+        skipped = []
+        for audioname, (ok, res) in zip(audionames, probes):
+            if ok and not res[0]:
+                formats[audioname] = tuple(res[1:])
+            else:
+                skipped.append(audioname)
+        return formats, skipped
+
+    def warm_extras(self, audionames, rule, jobs=1, dryrun=False):
+        """
+        transcodes, ahead of any request, every extra that rule puts
+        in the combined files for audionames, now or later (see
+        ewa.rules.possible_extras()), into the format of each main
+        file it goes with, so that creating the combined files never
+        waits for LAME.  Main files are probed by jobs worker
+        processes and transcodes are run by the transcode worker pool
+        (see ewa.transcode).  Returns a tuple (formats, skipped,
+        extras), where formats and skipped are as returned by
+        get_format_census() and extras maps each (extra, mode,
+        bitrate, samplerate) needed to 'current', 'transcoded',
+        'missing' (no master), 'failed', or, if dryrun is true,
+        'needed'.
+        """
+        formats, skipped = self.get_format_census(audionames, jobs)
+        needed = set()
+        for audioname, (bitrate, samplerate, mode) in formats.iteritems():
+            for x in possible_extras(rule, audioname):
+                needed.add((x, mode, bitrate, samplerate))
+        needed = sorted(needed)
+
+        def warm(extra):
+            x, mode, bitrate, samplerate = extra
+            path = self.get_extra_transcoded_path(x, mode, bitrate,
+                                                  samplerate)
+            try:
+                master = self.get_extra_master_path(x)
+            except FileNotFound:
+                return 'missing'
+            if is_current(master, path):
+                return 'current'
+            if dryrun:
+                return 'needed'
+            try:
+                self.get_extra_transcoded_path(x, mode, bitrate,
+                                               samplerate, True)
+            except (TranscodeError, Mp3Error, EnvironmentError):
+                exception("error transcoding %s to %s", x, path)
+                return 'failed'
+            return 'transcoded'
+
+        return formats, skipped, dict(zip(needed,
+                                          transcode_map(warm, needed)))
 
 
 class FSAudioProvider(BaseAudioProvider):
 
     def __init__(self, basedir, tolerate_vbr=True,
-                 tolerate_broken=True, targetdir=None):
+                 tolerate_broken=True, targetdir=None,
+                 manifests=False, lock_timeout=LOCK_TIMEOUT,
+                 sidecars=False):
+        """
+        if manifests is true, create_combined() writes a manifest
+        (see ewa.manifest) for each combined file rather than the file
+        itself.  Only one thread or process at a time creates a given
+        combined file; others wait up to lock_timeout seconds for it
+        (see ewa.singleflight).  If sidecars is true, a timing sidecar
+        (see read_sidecar()) is written along with each combined file.
+        """
         super(FSAudioProvider, self).__init__(basedir,
                                               tolerate_vbr,
                                               tolerate_broken)
         if targetdir is None:
             targetdir = path_join(basedir, 'combined')
         self.targetdir = os.path.abspath(targetdir)
+        self.manifests = manifests
+        self.lock_timeout = lock_timeout
+        self.sidecars = sidecars
 
     def get_combined_path(self, audioname):
-        return path_join(self.targetdir, audioname)
+        path = path_join(self.targetdir, audioname)
+        if self.manifests:
+            path += MANIFEST_SUFFIX
+        return path
 
-    def create_combined(self, audioname, rule, **spliceKwargs):
+    def create_combined(self, audioname, rule, fresh=None,
+                        **spliceKwargs):
+        """
+        creates the combined file (or manifest) for audioname and
+        returns its path.  If fresh is given, it is called once the
+        lock on the file is held, and if it returns true, the file
+        is taken to have been created by another thread or process
+        while this one waited and is left alone (see
+        ewa.singleflight).
+        """
         if audioname.startswith('/'):
             audioname = audioname[1:]
+        target = self.get_combined_path(audioname)
+        return single_flight(target,
+                             lambda: self._write_combined(audioname,
+                                                          rule,
+                                                          target,
+                                                          spliceKwargs),
+                             self.lock_timeout,
+                             fresh)
+
+    def _write_combined(self, audioname, rule, target, spliceKwargs):
         mainpath = self.get_main_path(audioname)
         playlist = self.get_playlist(audioname, rule)
-        target = self.get_combined_path(audioname)
+        if self.manifests:
+            write_manifest(target,
+                           splice_plan(playlist,
+                                       mainpath,
+                                       spliceKwargs.get('xing', False),
+                                       inline_tags=True))
+            if self.sidecars:
+                self._write_sidecar(audioname, playlist)
+            return target
         parent = os.path.dirname(target)
         if not path_exists(parent):
             os.makedirs(parent)
         renamed = '%s%d~%d~' % (target,
                                 os.getpid(),
                                 thread.get_ident())
+        hints = get_io_hints()
+        splicer = spliceKwargs.get('splicer')
+        preallocated = hints.preallocate and (splicer is None or
+                                              splicer in RANGE_SPLICERS)
         fp = open(renamed, 'wb')
-        for chunk in splice(playlist, mainpath, **spliceKwargs):
-            fp.write(chunk)
-        fp.close()
+        try:
+            fd = fp.fileno()
+            if preallocated:
+                plan = splice_plan(playlist,
+                                   mainpath,
+                                   spliceKwargs.get('xing', False))
+                hints.start_writing(fd, plan_length(plan))
+            splice_to_file(fp, playlist, mainpath, **spliceKwargs)
+            fp.flush()
+            if preallocated:
+                # in case the estimate was too generous
+                os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+            hints.done_writing(fd)
+        finally:
+            fp.close()
         os.rename(renamed, target)
+        hints.done_reading(mainpath)
+        if self.sidecars:
+            self._write_sidecar(audioname, playlist)
         return target
 
+    def get_sidecar_path(self, audioname):
+        return path_join(self.targetdir, audioname) + SIDECAR_SUFFIX
+
+    def _write_sidecar(self, audioname, playlist):
+        # written after the combined file, from the same playlist
+        duration, offsets = splice_timing(playlist)
+        ends = offsets[1:] + [duration]
+        data = dict(duration=round(duration, 3),
+                    segments=[dict(file=os.path.relpath(path, self.basedir),
+                                   start=round(start, 3),
+                                   duration=round(end - start, 3))
+                              for path, start, end in zip(playlist,
+                                                          offsets,
+                                                          ends)])
+        target = self.get_sidecar_path(audioname)
+        renamed = '%s%d~%d~' % (target,
+                                os.getpid(),
+                                thread.get_ident())
+        fp = open(renamed, 'w')
+        try:
+            json.dump(data, fp)
+        finally:
+            fp.close()
+        os.rename(renamed, target)
+
+    def read_sidecar(self, audioname):
+        """
+        returns the contents of the timing sidecar for audioname, a
+        JSON file next to its combined file giving the combined file's
+        duration and the start time and duration of each file in it,
+        with paths relative to basedir; or None if there is none or
+        it is older than the combined file.
+        """
+        if audioname.startswith('/'):
+            audioname = audioname[1:]
+        sidecar = self.get_sidecar_path(audioname)
+        try:
+            current = (getmtime(sidecar) >=
+                       getmtime(self.get_combined_path(audioname)))
+        except OSError:
+            return None
+        if not current:
+            return None
+        fp = open(sidecar)
+        try:
+            return json.load(fp)
+        finally:
+            fp.close()
+
 
 class StreamAudioProvider(BaseAudioProvider):
 
-    def create_combined(self, audioname, rule, **spliceKwargs):
+    def create_combined(self, audioname, rule, playlist=None,
+                        **spliceKwargs):
+        """
+        returns an iterator over the combined file for audioname, of
+        the files in playlist if given, otherwise in the playlist for
+        rule.
+        """
         if audioname.startswith('/'):
             audioname = audioname[1:]
         mainpath = self.get_main_path(audioname)
-        playlist = self.get_playlist(audioname, rule)
+        if playlist is None:
+            playlist = self.get_playlist(audioname, rule)
         return splice(playlist, mainpath, **spliceKwargs)
 
 
 __all__ = ['AudioProviderException',
            'FileNotFound',
            'FSAudioProvider',
+           'SIDECAR_SUFFIX',
            'StreamAudioProvider']
@@ -15,33 +15,85 @@ def buff_chunk_file(fp, end, bsize):
         else:
             break
 
+def buff_chunk_view(buff, start, end, bsize):
+    """
+    yields read-only views of at most bsize bytes over buff[start:end]
+    without copying; buff can be a string or an mmap.  Each view
+    holds a reference to buff, so an mmap stays mapped for as long as
+    any view of it is alive, as long as nobody closes it.
+    """
+    try:
+        buffer
+    except NameError:
+        view=memoryview(buff)
+    else:
+        # Python 2 can't make memoryviews of mmaps, and its
+        # memoryviews don't convert back to strings, but its
+        # buffer objects share memory just the same
+        view=None
+    idx=start
+    while idx < end:
+        size=min(bsize, end-idx)
+        if view is None:
+            yield buffer(buff, idx, size)
+        else:
+            yield view[idx:idx+size]
+        idx+=size
+
 def buff_chunk_iterator(iterator, bsize):
     """
     this adapts an iterator that yields chunks of
-    one size to one that yields chunks of another
+    one size to one that yields chunks of another.
+    Chunks that already have the right size are passed
+    through; the rest are gathered in a single buffer,
+    so the work done is linear in the bytes handled.
     """
-    buff=[]
-    buffsize=0
-    stopped=False
-    while 1:
-        while buffsize < bsize:
-            try:
-                chunkie=iterator.next()
-            except StopIteration:
-                stopped=True
-                break
-            else:
-                buff.append(chunkie)
-                buffsize+=len(chunkie)
-        if stopped:
-            if buffsize:
-                yield ''.join(buff)
-            raise StopIteration
-        else:
-            flattened=''.join(buff)
-            while len(flattened) >=bsize:
-                chunk=flattened[:bsize]
-                flattened=flattened[bsize:]
-                yield chunk
-            buff=[flattened]
-            buffsize=len(flattened)
+    buff=bytearray()
+    for chunk in iterator:
+        if not buff and len(chunk)==bsize:
+            yield chunk
+            continue
+        buff+=chunk
+        if len(buff) >= bsize:
+            end=len(buff)-len(buff)%bsize
+            for idx in xrange(0, end, bsize):
+                yield str(buff[idx:idx+bsize])
+            del buff[:end]
+    if buff:
+        yield str(buff)
+
+def coalesce_chunks(iterator, minsize):
+    """
+    adapts an iterator so that string chunks smaller than minsize
+    (tags, header bytes) are merged with their neighbours rather than
+    passed on by themselves, so that a sink that makes one write per
+    chunk makes few small writes.  Larger chunks are passed on
+    unchanged where possible.  Chunks that aren't strings, such as
+    views of a memory map, are passed on as they are, never copied
+    or held back.
+    """
+    held=[]
+    heldsize=0
+    for chunk in iterator:
+        size=len(chunk)
+        if not size:
+            continue
+        if not isinstance(chunk, str):
+            if held:
+                yield ''.join(held)
+                held=[]
+                heldsize=0
+            yield chunk
+            continue
+        if heldsize >= minsize and size >= minsize:
+            yield ''.join(held)
+            held=[]
+            heldsize=0
+        held.append(chunk)
+        heldsize+=size
+        if heldsize >= minsize and size < minsize:
+            yield ''.join(held)
+            held=[]
+            heldsize=0
+    if held:
+        yield ''.join(held)
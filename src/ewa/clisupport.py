@@ -43,11 +43,19 @@ except ImportError:
 import ewa.mp3
 import ewa.audio
 from ewa.config import Config, initConfig
+from ewa.iohints import initIOHints
 from ewa.lighttpd_hack_middleware import LighttpdHackMiddleware
 from ewa.logutil import (debug, error, exception, info, logger,
                          initLogging, warn)
+from ewa.manifest import MANIFEST_SUFFIX, find_stale_literals
+from ewa.prefetch import get_prefetch_stats, initPrefetch
+from ewa.procutil import get_process_stats
+from ewa.singleflight import get_single_flight_stats
+from ewa.transcode import initTranscoder
 from ewa.wsgiapp import EwaApp
 from ewa.rules import FileRule
+from ewa.segcache import get_segment_cache, initSegmentCache
+from ewa.spliceindex import initSpliceIndex
 from ewa import __version__
 
 VERSION_TEXT = """\
@@ -75,6 +83,10 @@ Splices MP3 files together.
 """
 
 
+ENGINES = ('default', 'sendfile', 'mmap', 'prefetch', 'resync', 'pipe',
+           'mp3cat', 'sox')
+
+
 def get_serve_parser():
     protocols = []
     if haveflup:
@@ -138,14 +150,30 @@ def get_splice_parser():
                       default=False,
                       help="sanity check the input mp3 files",
                       dest='sanitycheck')
+    parser.add_option('-x',
+                      '--xing',
+                      action='store_true',
+                      default=False,
+                      dest='xing',
+                      help=("write a Xing/Info header describing the "
+                            "whole spliced file"))
+    parser.add_option('-j',
+                      '--jobs',
+                      type=int,
+                      default=1,
+                      dest='jobs',
+                      metavar='JOBS',
+                      help=("number of processes to use for the sanity "
+                            "check (default: 1)"))
     parser.add_option('-e',
                       '--engine',
                       default='default',
                       dest='engine',
                       metavar='ENGINE',
-                      choices=('default', 'mp3cat', 'sox'),
+                      choices=ENGINES,
                       help=("which splicing engine to use (default ewa "
-                            "splicer, mp3cat, or sox)"))
+                            "splicer, sendfile, mmap, prefetch, resync, "
+                            "pipe, mp3cat, or sox)"))
     parser.add_option('--version',
                       action="store_true",
                       dest="version",
@@ -189,9 +217,10 @@ def get_ap_parser():
                       default=None,
                       dest='engine',
                       metavar='ENGINE',
-                      choices=('default', 'mp3cat', 'sox'),
+                      choices=ENGINES,
                       help=("which splicing engine to use (default ewa "
-                            "splicer, mp3cat, or sox)"))
+                            "splicer, sendfile, mmap, prefetch, resync, "
+                            "pipe, mp3cat, or sox)"))
     parser.add_option('-a',
                       '--absolute',
                       default=False,
@@ -245,12 +274,44 @@ def get_ap_parser():
                       dest='sleep',
                       help=('number of seconds to sleep between file generations; '
                             'default: 0.0'))
+    parser.add_option('-T', '--timing',
+                      default=False,
+                      action='store_true',
+                      dest='timing',
+                      help=('write a JSON file next to each combined file '
+                            'giving its duration and the start time of '
+                            'each part'))
+    parser.add_option('-W', '--warm',
+                      default=False,
+                      action='store_true',
+                      dest='warm',
+                      help=('instead of producing combined files, '
+                            'transcode all the extras they need in '
+                            'advance and report on the formats of the '
+                            'main files'))
+    parser.add_option('-j', '--jobs',
+                      type=int,
+                      default=1,
+                      dest='jobs',
+                      metavar='JOBS',
+                      help=("with --warm, number of processes to use to "
+                            "probe the main files (default: 1)"))
     return parser
 
 
 def resolve_engine(enginename):
     if enginename == 'default':
         return ewa.mp3._default_splicer
+    elif enginename == 'sendfile':
+        return ewa.mp3._sendfile_splicer
+    elif enginename == 'mmap':
+        return ewa.mp3._mmap_splicer
+    elif enginename == 'prefetch':
+        return ewa.mp3._prefetch_splicer
+    elif enginename == 'resync':
+        return ewa.mp3._resync_splicer
+    elif enginename == 'pipe':
+        return ewa.mp3._pipe_splicer
     elif enginename == 'mp3cat':
         return ewa.mp3._mp3cat_splicer
     elif enginename == 'sox':
@@ -263,26 +324,28 @@ def do_splice(args):
     if opts.version:
         print VERSION_TEXT % path.basename(sys.argv[0])
         sys.exit(0)
+    engine = resolve_engine(opts.engine)
+    if opts.xing and engine not in ewa.mp3.RANGE_SPLICERS:
+        parser.error('xing headers not supported by engine %s' % opts.engine)
     if opts.debugmode:
         Config.loglevel = logging.DEBUG
     initLogging(level=Config.loglevel,
                 filename=Config.logfile)
 
-    engine = resolve_engine(opts.engine)
     if opts.sanitycheck:
-        try:
-            ewa.mp3.mp3_sanity_check(args)
-        except Exception, e:
-            print >> sys.stderr, 'sanity check failed: %s' % str(e)
+        result = ewa.mp3.check_mp3s(args, opts.jobs)
+        if not result.ok:
+            for msg in result.messages():
+                print >> sys.stderr, 'sanity check failed: %s' % msg
             sys.exit(1)
 
     use_stdout = opts.output == '-'
     if use_stdout:
         fp = sys.stdout
     else:
-        fp = open(options.output, 'wb')
-    for chunk in ewa.mp3.splice(args, opts.tagfile, splicer=engine):
-        fp.write(chunk)
+        fp = open(opts.output, 'wb')
+    ewa.mp3.splice_to_file(fp, args, opts.tagfile, splicer=engine,
+                           xing=opts.xing)
     if not use_stdout:
         fp.close()
 
@@ -306,19 +369,34 @@ def do_audioprovider(args):
     if opts.rulefile:
         Config.rulefile = opts.rulefile
     if opts.engine:
-        Config.engine = engine
+        Config.engine = opts.engine
     engine = resolve_engine(Config.engine)
+    if Config.manifests and engine not in ewa.mp3.RANGE_SPLICERS:
+        parser.error('manifests not supported by engine %s' % Config.engine)
+    if Config.xing_header and engine not in ewa.mp3.RANGE_SPLICERS:
+        parser.error('xing headers not supported by engine %s' %
+                     Config.engine)
     initLogging(level=Config.loglevel)
+    indexdir = _init_caches()
+    initIOHints(Config.batch_io_hints)
     rule = FileRule(Config.rulefile)
 
     if opts.configtest:
         print "Config OK"
         sys.exit(0)
+    # before anything is done, and before args is replaced by an
+    # iterator, which is always true
+    if not args:
+        parser.error("no files specified")
 
     provider = ewa.audio.FSAudioProvider(Config.basedir,
                                          opts.tolerate_vbr,
                                          opts.tolerate_broken,
-                                         Config.targetdir)
+                                         Config.targetdir,
+                                         Config.manifests,
+                                         Config.lock_timeout,
+                                         (opts.timing or
+                                          Config.timing_sidecars))
     mainpath = provider.get_main_path("")
     if not mainpath.endswith('/'):
         # currently this won't happen,
@@ -350,6 +428,28 @@ def do_audioprovider(args):
                         os.unlink(file)
                 except Exception, e:
                     error("couldn't unlink %s: %s", file, e)
+        if indexdir:
+            for file in find_stale_literals(path.join(indexdir, 'literals'),
+                                            delete_finder.targetdir):
+                info('deleting %s', file)
+                if not opts.dryrun:
+                    try:
+                        os.unlink(file)
+                    except Exception, e:
+                        error("couldn't unlink %s: %s", file, e)
+
+    if opts.warm:
+        if opts.recursive:
+            args = RecursiveMp3FileIterator(args, mainpath)
+        if not opts.dryrun:
+            _change_user_group()
+        formats, skipped, extras = provider.warm_extras(args,
+                                                        rule,
+                                                        opts.jobs,
+                                                        opts.dryrun)
+        _print_warm_report(formats, skipped, extras)
+        info('single flight: %s', get_single_flight_stats())
+        sys.exit('failed' in extras.values() and 1 or 0)
 
     if opts.recursive:
         # replace args with an iterator that finds mp3 files
@@ -359,8 +459,6 @@ def do_audioprovider(args):
             args = RecursiveChangedMp3FileIterator(args,
                                                    mainpath,
                                                    opts.max_age)
-    if not args:
-        parser.error("no files specified")
 
     if opts.dryrun:
         for file in args:
@@ -378,14 +476,46 @@ def do_audioprovider(args):
             elif opts.sleep:
                 time.sleep(opts.sleep)
             try:
-                target = provider.create_combined(file, rule, splicer=engine)
+                target = provider.create_combined(file,
+                                                  rule,
+                                                  splicer=engine,
+                                                  xing=Config.xing_header)
             except:
                 exception("error creating combined file for %s", file)
             else:
                 debug('created %s', target)
+        info('probe cache: %s', ewa.mp3.get_probe_cache().stats())
+        info('external processes: %s', get_process_stats())
+        info('prefetch: %s', get_prefetch_stats())
+        info('single flight: %s', get_single_flight_stats())
     sys.exit(0)
 
 
+def _print_warm_report(formats, skipped, extras):
+    census = {}
+    for fmt in formats.itervalues():
+        census[fmt] = census.get(fmt, 0) + 1
+    print "formats of %d main files:" % (len(formats) + len(skipped))
+    for (bitrate, samplerate, mode), count in sorted(census.iteritems()):
+        print "\t%d kbps, %d Hz, mode %s: %d" % (bitrate,
+                                                samplerate,
+                                                mode,
+                                                count)
+    if skipped:
+        print "\tVBR or unreadable (no extras): %d" % len(skipped)
+    counts = {}
+    for (x, mode, bitrate, samplerate), status in sorted(extras.iteritems()):
+        counts[status] = counts.get(status, 0) + 1
+        if status in ('missing', 'failed', 'needed'):
+            print "%s: %s at %d kbps, %d Hz, mode %s" % (status,
+                                                         x,
+                                                         bitrate,
+                                                         samplerate,
+                                                         mode)
+    summary = ', '.join(['%d %s' % (counts[k], k) for k in sorted(counts)])
+    print "extras: %s" % (summary or 'none')
+
+
 class DeleteFinder(object):
     def __init__(self, files, basedir):
         self.files = files
@@ -398,6 +528,9 @@ class DeleteFinder(object):
         targetpath = os.path.join(root, apath)
         mainpath = path.join(self.basedir,
                              path.relpath(targetpath, self.targetdir))
+        for suffix in (MANIFEST_SUFFIX, ewa.audio.SIDECAR_SUFFIX):
+            if not isdir and mainpath.endswith(suffix):
+                mainpath = mainpath[:-len(suffix)]
 
         debug('mainpath for %s is %s', apath, mainpath)
         if not os.path.exists(mainpath):
@@ -463,6 +596,8 @@ class RecursiveChangedMp3FileIterator(RecursiveMp3FileIterator):
                     targetpath = os.path.join(self.targetdir,
                                               path.relpath(fullpath,
                                                            self.basedir))
+                    if Config.manifests:
+                        targetpath += MANIFEST_SUFFIX
                     try:
                         stats = os.stat(targetpath)
                     except OSError, ozzie:
@@ -541,7 +676,25 @@ def do_serve(args):
         parser.error('umask only applicable for unix sockets')
     if Config.unixsocket and (Config.interface or Config.port):
         parser.error('incompatible mixture of unix socket and tcp options')
+    if Config.stream and Config.manifests:
+        parser.error('manifests not applicable in streaming mode')
     engine = resolve_engine(Config.engine)
+    if Config.manifests and engine not in ewa.mp3.RANGE_SPLICERS:
+        parser.error('manifests not supported by engine %s' % Config.engine)
+    if Config.xing_header and engine not in ewa.mp3.RANGE_SPLICERS:
+        parser.error('xing headers not supported by engine %s' %
+                     Config.engine)
+    indexdir = _init_caches()
+    initIOHints(Config.server_io_hints)
+    if Config.segment_cache_size:
+        # before any children are forked, so that they share it
+        loaded = ewa.mp3.preload_segments(_extras_dir(), Config.xing_header)
+        info('preloaded %d segments: %s',
+             loaded,
+             get_segment_cache().stats())
+    literaldir = None
+    if indexdir:
+        literaldir = path.join(indexdir, 'literals')
 
     app = EwaApp(rule=rule,
                  basedir=Config.basedir,
@@ -551,7 +704,16 @@ def do_serve(args):
                  use_xsendfile=Config.use_xsendfile,
                  sendfile_header=Config.sendfile_header,
                  content_disposition=Config.content_disposition,
-                 splicer=engine)
+                 manifests=Config.manifests,
+                 literaldir=literaldir,
+                 write_size=Config.write_size,
+                 duration_headers=Config.duration_headers,
+                 hls=Config.hls,
+                 hls_media_url=Config.hls_media_url,
+                 hls_target_duration=Config.hls_target_duration,
+                 lock_timeout=Config.lock_timeout,
+                 splicer=engine,
+                 xing=Config.xing_header)
 
     if opts.lighttpd_hack:
         app = LighttpdHackMiddleware(app)
@@ -610,6 +772,30 @@ def do_serve(args):
         sys.exit(0)
 
 
+def _init_caches():
+    indexdir = Config.indexdir
+    if indexdir is None and Config.basedir:
+        indexdir = path.join(Config.basedir, 'index')
+    debug('splice index directory: %s', indexdir)
+    initSpliceIndex(indexdir)
+    ewa.mp3.initProbeCache(Config.probe_cache_size)
+    initPrefetch(Config.prefetch_segments,
+                 Config.prefetch_bytes,
+                 Config.prefetch_threads)
+    initTranscoder(Config.transcode_jobs,
+                   Config.transcode_nice,
+                   Config.transcode_ionice,
+                   Config.lock_timeout)
+    if Config.basedir:
+        initSegmentCache(Config.segment_cache_size,
+                         [_extras_dir()])
+    return indexdir
+
+
+def _extras_dir():
+    return path.join(Config.basedir, 'extra', 'transcoded')
+
+
 def _change_user_group():
     if not have_unix:
         # maybe do something else on Windows someday...
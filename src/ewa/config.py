@@ -56,16 +56,36 @@ DEFAULTS=dict(loglevel='critical',
               unixsocket=None,
               umask=None,
               stream=False,
+              write_size=65536,
               basedir=None,
               rulefile=None,
               targetdir=None,
+              manifests=False,
+              lock_timeout=60,
+              indexdir=None,
+              probe_cache_size=1000,
+              segment_cache_size=0,
+              prefetch_segments=2,
+              prefetch_bytes=4*1024*1024,
+              prefetch_threads=4,
+              server_io_hints=(),
+              batch_io_hints=(),
               pidfile=None,
               use_threads=not have_fork,
               engine='default',
+              xing_header=False,
+              duration_headers=False,
+              timing_sidecars=False,
+              hls=False,
+              hls_media_url=None,
+              hls_target_duration=10,
               user=None,
               group=None,
               content_disposition='attachment',
               lame_path='/usr/bin/lame',
+              transcode_jobs=2,
+              transcode_nice=0,
+              transcode_ionice=None,
               min_spare=None,
               max_spare=None,
               max_threads=None,
@@ -1,3 +1,4 @@
+#define PY_SSIZE_T_CLEAN
 #include "Python.h"
 
 /* most of this comes from Tom Clegg's mp3cat/frame.c;
@@ -23,10 +24,18 @@ const static int samplerate_table[4][3] =
   {44100, 48000, 32000} /* version 1 */
 };
 
-static int frame_length (const char* const buf, 
-			const int bufsize, 
-			int *save_version, 
-			int *save_layer) {
+/* decoded fields of a frame header */
+typedef struct {
+  int version;
+  int layer;
+  int bitrate;
+  int samplerate;
+  int mode;
+} frame_header;
+
+static int parse_header (const unsigned char* const buf,
+			 const Py_ssize_t bufsize,
+			 frame_header *hdr) {
      /* returns expected length of this frame based on header,
 	or 0 if header is incomprehensible */
   int
@@ -41,9 +50,9 @@ static int frame_length (const char* const buf,
     return 0;
 
   /* make sure first 11 bits are on */
-  if (buf[0] != '\377')
+  if (buf[0] != 0xff)
     return 0;
-  if ((buf[1] & '\340') != '\340')
+  if ((buf[1] & 0xe0) != 0xe0)
     return 0;
 
   /* discover version: 0=2.5, 1=reserved, 2=2, 3=1  */
@@ -129,44 +138,166 @@ static int frame_length (const char* const buf,
       length = 72 * bitrate / samplerate + padding;
   }
 
-  *save_version = version;
-  *save_layer = layer;
+  hdr->version = version;
+  hdr->layer = layer;
+  hdr->bitrate = bitrate;
+  hdr->samplerate = samplerate;
+  /* channel mode: 0=stereo, 1=joint stereo, 2=dual channel, 3=mono */
+  hdr->mode = (buf[3] >> 6) & 3;
   return length;
 }
 
+/* a frame found by walk_buffer */
+typedef struct {
+  Py_ssize_t offset;
+  int length;
+  frame_header hdr;
+} frame_entry;
+
+/* walks the frames in buf from offset, stopping at the first
+ * position that is not a complete frame (or, if resync is true,
+ * skipping forward to the next one).  The frames found are stored in
+ * a malloc'ed array in *frames (which the caller must free); returns
+ * the number of frames, or -1 if memory runs out.  *end is set to
+ * the end of the last complete frame.  This function doesn't touch
+ * any Python objects, so it can run without the GIL.
+ */
+static Py_ssize_t walk_buffer (const unsigned char* const buf,
+			       const Py_ssize_t bufsize,
+			       Py_ssize_t offset,
+			       const Py_ssize_t maxframes,
+			       const int resync,
+			       frame_entry **frames,
+			       Py_ssize_t *end) {
+  Py_ssize_t nframes=0, allocated=0;
+  frame_entry *entries=NULL, *tmp;
+  frame_header hdr;
+  int length;
+
+  *end=offset;
+  while (offset < bufsize && (maxframes < 0 || nframes < maxframes)) {
+    length=parse_header(buf+offset, bufsize-offset, &hdr);
+    if (length <= 0 || length > bufsize-offset) {
+      if (!resync)
+	break;
+      offset++;
+      continue;
+    }
+    if (nframes == allocated) {
+      allocated = allocated ? allocated * 2 : 256;
+      tmp=(frame_entry *)realloc(entries, allocated * sizeof(frame_entry));
+      if (tmp == NULL) {
+	free(entries);
+	*frames=NULL;
+	return -1;
+      }
+      entries=tmp;
+    }
+    entries[nframes].offset=offset;
+    entries[nframes].length=length;
+    entries[nframes].hdr=hdr;
+    nframes++;
+    offset+=length;
+    *end=offset;
+  }
+  *frames=entries;
+  return nframes;
+}
+
 /* PYTHON WRAPPER FOLLOWS */
 
 static PyObject *get_frame(PyObject *self, PyObject *args, PyObject *kwargs) {
-  char *buff=NULL;
-  int bufflen=0;
-  char *argnames[]={"buff", NULL};
+  Py_buffer buff;
+  Py_ssize_t offset=0;
+  char *argnames[]={"buff", "offset", NULL};
   int frlen=0;
-  int version=0;
-  int layer=0;
-  PyObject *rettuple;
-  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#", argnames, &buff, &bufflen)) {
+  frame_header hdr={0, 0, 0, 0, 0};
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s*|n", argnames,
+				   &buff, &offset)) {
+    return NULL;
+  }
+  if (offset >= 0 && offset < buff.len) {
+    frlen=parse_header((const unsigned char*)buff.buf + offset,
+		       buff.len - offset,
+		       &hdr);
+  }
+  PyBuffer_Release(&buff);
+  if (frlen == 0) {
+    hdr.version=hdr.layer=0;
+  }
+  return Py_BuildValue("iii", frlen, hdr.version, hdr.layer);
+}
+
+static PyObject *walk_frames(PyObject *self, PyObject *args, PyObject *kwargs) {
+  Py_buffer buff;
+  Py_ssize_t offset=0, maxframes=-1, nframes, end=0, i;
+  int resync=0;
+  char *argnames[]={"buff", "offset", "maxframes", "resync", NULL};
+  frame_entry *frames=NULL;
+  PyObject *framelist, *item, *rettuple;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s*|nni", argnames,
+				   &buff, &offset, &maxframes, &resync)) {
     return NULL;
   }
-  frlen=frame_length((const char*)buff, (const int)bufflen, &version, &layer);
-  rettuple=Py_BuildValue("iii", frlen, version, layer);
+  if (offset < 0 || offset > buff.len) {
+    PyBuffer_Release(&buff);
+    PyErr_SetString(PyExc_ValueError, "offset out of range");
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  nframes=walk_buffer((const unsigned char*)buff.buf, buff.len, offset,
+		      maxframes, resync, &frames, &end);
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&buff);
+  if (nframes < 0) {
+    return PyErr_NoMemory();
+  }
+  framelist=PyList_New(nframes);
+  if (framelist == NULL) {
+    free(frames);
+    return NULL;
+  }
+  for (i=0; i < nframes; i++) {
+    item=Py_BuildValue("(niiiiii)",
+		       frames[i].offset,
+		       frames[i].length,
+		       frames[i].hdr.version,
+		       frames[i].hdr.layer,
+		       frames[i].hdr.bitrate,
+		       frames[i].hdr.samplerate,
+		       frames[i].hdr.mode);
+    if (item == NULL) {
+      Py_DECREF(framelist);
+      free(frames);
+      return NULL;
+    }
+    PyList_SET_ITEM(framelist, i, item);
+  }
+  free(frames);
+  rettuple=Py_BuildValue("(nnN)", nframes, end, framelist);
   return rettuple;
 }
 
-static char docstring[]="get_frame(buff): for a buffer of bytes from an mp3 file aligned \n"
-"at a frame header, returns the length of the frame.";
+static char docstring[]="get_frame(buff, offset=0): for a buffer of bytes from an mp3\n"
+"file aligned at a frame header at offset, returns the length of the\n"
+"frame, its version and its layer.";
+
+static char walk_docstring[]="walk_frames(buff, offset=0, maxframes=-1, resync=0):\n"
+"walks the frames in buff starting at offset, stopping at the first\n"
+"position that doesn't hold a complete frame (or, if resync is true,\n"
+"skipping ahead to the next one), or after maxframes frames.  Returns\n"
+"a tuple (nframes, end, frames), where end is the end of the last\n"
+"complete frame and frames is a list of tuples (offset, length,\n"
+"version, layer, bitrate, samplerate, mode).  buff can be any object\n"
+"supporting the buffer protocol; the GIL is released while walking.";
 
 static PyMethodDef funcs[]={
   {"get_frame", (PyCFunction)get_frame, METH_KEYWORDS, docstring},
+  {"walk_frames", (PyCFunction)walk_frames, METH_KEYWORDS, walk_docstring},
   {NULL}
 };
 
 void initframeinfo(void) {
   Py_InitModule3("frameinfo", funcs, "find mp3 frame length");
 }
-  
-  
-  
-  
-  
-
-
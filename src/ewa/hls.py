@@ -0,0 +1,88 @@
+"""
+
+HTTP Live Streaming playlists for combined files.
+
+Instead of one combined file per main file, an HLS playlist lists the
+audio of the main file and of its extras as byte ranges of the
+original files, cut at frame boundaries into segments of roughly equal
+length.  Every episode that uses the same intro then refers to the
+same URL and the same byte ranges for it, so a cache in front of ewa
+stores the intro once rather than once per episode.
+
+"""
+
+import math
+import urllib
+
+from ewa.mp3 import get_segment_info, samples_per_frame, SEEK_INTERVAL
+from ewa.pyframeinfo import parse_header
+
+M3U8_MIMETYPE = 'application/vnd.apple.mpegurl'
+
+M3U8_SUFFIX = '.m3u8'
+
+# the default length of a segment, in seconds
+TARGET_DURATION = 10
+
+
+def file_segments(filename, target=TARGET_DURATION):
+    """
+    returns a list of (offset, length, duration) tuples dividing the
+    audio of filename into frame-aligned segments of about target
+    seconds each.
+    """
+    info = get_segment_info(filename, frames=True)
+    fields = parse_header(info.header)
+    if not fields[0] or not info.nframes:
+        return []
+    frametime = samples_per_frame(fields[1], fields[2]) / float(fields[4])
+    # cut at every k-th seekpoint
+    k = max(1, int(target / (SEEK_INTERVAL * frametime)))
+    points = info.seekpoints[::k]
+    ends = points[1:] + [info.audio_end]
+    segments = []
+    for i, (start, end) in enumerate(zip(points, ends)):
+        nframes = min(k * SEEK_INTERVAL, info.nframes - i * k * SEEK_INTERVAL)
+        segments.append((start, end - start, nframes * frametime))
+    return segments
+
+
+def make_playlist(files, url_for, target=TARGET_DURATION):
+    """
+    returns the text of an HLS playlist for files played one after
+    the other; url_for is called with each file's path to get the URL
+    its segments are fetched from.
+    """
+    entries = []
+    longest = 0
+    for filename in files:
+        segments = file_segments(filename, target)
+        if not segments:
+            continue
+        if entries:
+            entries.append('#EXT-X-DISCONTINUITY')
+        url = url_for(filename)
+        for offset, length, duration in segments:
+            longest = max(longest, duration)
+            entries.extend(['#EXTINF:%.3f,' % duration,
+                            '#EXT-X-BYTERANGE:%d@%d' % (length, offset),
+                            url])
+    lines = ['#EXTM3U',
+             '#EXT-X-VERSION:4',
+             '#EXT-X-TARGETDURATION:%d' % int(math.ceil(longest)),
+             '#EXT-X-MEDIA-SEQUENCE:0',
+             '#EXT-X-PLAYLIST-TYPE:VOD']
+    lines.extend(entries)
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def media_url(base, relpath):
+    """
+    returns the URL under base of the file at relpath.
+    """
+    return '%s/%s' % (base.rstrip('/'), urllib.quote(relpath))
+
+
+__all__ = ['file_segments', 'make_playlist', 'media_url', 'M3U8_MIMETYPE',
+           'M3U8_SUFFIX', 'TARGET_DURATION']
@@ -0,0 +1,172 @@
+"""
+
+Hints to the kernel about how ewa uses the files it reads and writes.
+
+A batch run reads every main file once and writes every combined file
+once, which, left to itself, the kernel caches at the expense of the
+extras and recent episodes that a server needs.  The IOHints policy
+can ask for aggressive read-ahead on the files being spliced
+(posix_fadvise SEQUENTIAL and WILLNEED), drop a main file and a
+combined file from the cache once they are done with (DONTNEED), and
+preallocate combined files at their known final size
+(posix_fallocate).  Every hint is optional and failures are ignored:
+they are only hints.
+
+"""
+
+import os
+
+from ewa.logutil import debug
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# the values of the POSIX_FADV_* constants on Linux
+FADV_SEQUENTIAL = 2
+FADV_WILLNEED = 3
+FADV_DONTNEED = 4
+
+HINTS = ('sequential', 'willneed', 'dontneed', 'preallocate')
+
+
+def _load_libc_func(name, argtypes):
+    if ctypes is None:
+        return None
+    libname = ctypes.util.find_library('c')
+    if not libname:
+        return None
+    try:
+        func = getattr(ctypes.CDLL(libname), name)
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = argtypes
+    func.restype = ctypes.c_int
+    return func
+
+if hasattr(os, 'posix_fadvise'):
+    _posix_fadvise = os.posix_fadvise
+elif ctypes is not None:
+    _posix_fadvise = _load_libc_func('posix_fadvise',
+                                     [ctypes.c_int,
+                                      ctypes.c_int64,
+                                      ctypes.c_int64,
+                                      ctypes.c_int])
+else:
+    _posix_fadvise = None
+
+if hasattr(os, 'posix_fallocate'):
+    _posix_fallocate = os.posix_fallocate
+elif ctypes is not None:
+    _posix_fallocate = _load_libc_func('posix_fallocate',
+                                       [ctypes.c_int,
+                                        ctypes.c_int64,
+                                        ctypes.c_int64])
+else:
+    _posix_fallocate = None
+
+
+def _call(func, *args):
+    # the libc versions return an error number rather than
+    # setting errno; the os versions raise OSError
+    if func is None:
+        return False
+    try:
+        res = func(*args)
+    except OSError, e:
+        res = e.errno
+    if res:
+        debug("%s%r failed: %s", func.__name__, args, os.strerror(res))
+    return not res
+
+
+def fadvise(fd, offset, length, advice):
+    return _call(_posix_fadvise, fd, offset, length, advice)
+
+
+def fallocate(fd, offset, length):
+    return _call(_posix_fallocate, fd, offset, length)
+
+
+class IOHints(object):
+    """
+    a policy of I/O hints, given as a sequence of names from HINTS.
+    With no hints, all its methods do nothing.
+    """
+
+    def __init__(self, hints=()):
+        for h in hints:
+            if h not in HINTS:
+                raise ValueError("unknown I/O hint: %s" % h)
+        self.hints = tuple(hints)
+        self.sequential = 'sequential' in hints
+        self.willneed = 'willneed' in hints
+        self.dontneed = 'dontneed' in hints
+        self.preallocate = 'preallocate' in hints
+
+    def start_reading(self, fd, offset, length):
+        """
+        called before reading length bytes at offset from fd.
+        """
+        if self.sequential:
+            fadvise(fd, offset, length, FADV_SEQUENTIAL)
+        if self.willneed:
+            fadvise(fd, offset, length, FADV_WILLNEED)
+
+    def done_reading(self, path):
+        """
+        called when the file at path won't be read again soon.
+        """
+        if not self.dontneed:
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            fadvise(fd, 0, 0, FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def start_writing(self, fd, length):
+        """
+        called before writing a file of length bytes to fd.
+        """
+        if self.preallocate and length:
+            fallocate(fd, 0, length)
+
+    def done_writing(self, fd):
+        """
+        called when the file open on fd has been written and won't be
+        read again soon.  Its data has to reach the disk before the
+        kernel can drop it from the cache, so this waits for that.
+        """
+        if not self.dontneed:
+            return
+        try:
+            os.fdatasync(fd)
+        except (OSError, AttributeError):
+            return
+        fadvise(fd, 0, 0, FADV_DONTNEED)
+
+
+_io_hints = IOHints()
+
+
+def get_io_hints():
+    return _io_hints
+
+
+def initIOHints(hints=()):
+    """
+    sets the process-wide I/O hint policy.
+    """
+    global _io_hints
+    _io_hints = IOHints(hints)
+    return _io_hints
+
+
+__all__ = ['fadvise', 'fallocate', 'get_io_hints', 'initIOHints',
+           'IOHints', 'HINTS']
@@ -0,0 +1,151 @@
+"""
+
+A thread-safe LRU cache with hit, miss and eviction counters.
+
+"""
+
+import threading
+
+
+class _Link(object):
+    __slots__ = ('prev', 'next', 'key', 'value', 'weight')
+
+
+class LRUCache(object):
+    """
+    a dictionary-like cache holding at most maxsize entries, evicting
+    the least recently used when full.  A maxsize of 0 disables the
+    cache.  If maxweight is given, the entries' total weight, as
+    measured by calling weigh (by default, len) on each value, is also
+    kept within it; a value heavier than maxweight is not stored at
+    all.  All operations are protected by a lock, so a single cache
+    can be shared by the threads of a server.
+    """
+
+    def __init__(self, maxsize=1000, maxweight=None, weigh=len):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self._map = {}
+        root = self._root = _Link()
+        root.prev = root.next = root
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link.value
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        if self.maxweight is not None:
+            weight = self.weigh(value)
+            if weight > self.maxweight:
+                self.discard(key)
+                return
+        else:
+            weight = 0
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                self.weight -= link.weight
+            else:
+                if self.maxsize <= 0:
+                    return
+                link = _Link()
+                link.key = key
+                self._map[key] = link
+            link.value = value
+            link.weight = weight
+            self.weight += weight
+            self._append(link)
+            self._trim()
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        self._lock.acquire()
+        try:
+            link = self._map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.weight -= link.weight
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            self.weight = 0
+            self._root.prev = self._root.next = self._root
+        finally:
+            self._lock.release()
+
+    def resize(self, maxsize, maxweight=None):
+        self._lock.acquire()
+        try:
+            self.maxsize = maxsize
+            if maxweight is not None:
+                self.maxweight = maxweight
+            self._trim()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def stats(self):
+        """
+        returns a dictionary of the cache's counters.
+        """
+        self._lock.acquire()
+        try:
+            stats = dict(size=len(self._map),
+                         maxsize=self.maxsize,
+                         hits=self.hits,
+                         misses=self.misses,
+                         evictions=self.evictions)
+            if self.maxweight is not None:
+                stats.update(weight=self.weight, maxweight=self.maxweight)
+            return stats
+        finally:
+            self._lock.release()
+
+    def _trim(self):
+        while (len(self._map) > self.maxsize
+               or (self.maxweight is not None
+                   and self.weight > self.maxweight)):
+            oldest = self._root.next
+            self._unlink(oldest)
+            del self._map[oldest.key]
+            self.weight -= oldest.weight
+            self.evictions += 1
+
+    def _unlink(self, link):
+        link.prev.next = link.next
+        link.next.prev = link.prev
+
+    def _append(self, link):
+        last = self._root.prev
+        link.prev = last
+        link.next = self._root
+        last.next = self._root.prev = link
+
+
+__all__ = ['LRUCache']
@@ -0,0 +1,181 @@
+"""
+
+Manifests of combined files.
+
+Rather than a full copy of a combined file, a manifest records how to
+produce it: its splice plan (see ewa.mp3.splice_plan), with the tags
+of the main file held inline, together with the size and modification
+time of every file the plan reads from, so that a manifest whose
+sources have since changed is recognized as stale instead of serving
+the wrong bytes.  A manifest is a few hundred bytes however long the
+combined file is.
+
+"""
+
+import errno
+import marshal
+import os
+import thread
+import time
+from hashlib import md5
+
+# bump this whenever the format of manifests changes;
+# manifests with a different version are treated as stale.
+MANIFEST_VERSION = 1
+
+MANIFEST_SUFFIX = '.manifest'
+
+# how long a literal (see spill_literals) that no manifest refers to
+# is kept after it was last used, in seconds; streamed responses use
+# literals too, and a web server may still be sending one
+LITERAL_MAX_AGE = 7 * 86400
+
+
+def _plan_sources(plan):
+    paths = []
+    for piece in plan:
+        if not isinstance(piece, str) and piece[0] not in paths:
+            paths.append(piece[0])
+    sources = []
+    for p in paths:
+        stats = os.stat(p)
+        sources.append((p, stats.st_size, stats.st_mtime))
+    return sources
+
+
+def write_manifest(target, plan):
+    """
+    atomically writes a manifest for plan to target.
+    """
+    parent = os.path.dirname(target)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    renamed = '%s%d~%d~' % (target,
+                            os.getpid(),
+                            thread.get_ident())
+    fp = open(renamed, 'wb')
+    try:
+        marshal.dump((MANIFEST_VERSION, plan, _plan_sources(plan)), fp)
+    finally:
+        fp.close()
+    os.rename(renamed, target)
+
+
+def _load_manifest(path):
+    fp = open(path, 'rb')
+    try:
+        try:
+            version, plan, sources = marshal.load(fp)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        fp.close()
+    if version != MANIFEST_VERSION:
+        return None
+    return plan, sources
+
+
+def read_manifest(path):
+    """
+    returns the plan stored in the manifest at path, or None if the
+    manifest is unreadable or any of the files it refers to has
+    changed since it was written.  Raises IOError if path doesn't
+    exist.
+    """
+    loaded = _load_manifest(path)
+    if loaded is None:
+        return None
+    plan, sources = loaded
+    for p, size, mtime in sources:
+        try:
+            stats = os.stat(p)
+        except OSError:
+            return None
+        if stats.st_size != size or stats.st_mtime != mtime:
+            return None
+    return plan
+
+
+def _literal_path(dirname, piece):
+    digest = md5(piece).hexdigest()
+    return os.path.join(dirname, digest[:2], digest)
+
+
+def spill_literals(plan, dirname):
+    """
+    returns plan with every string in it replaced by the range of a
+    file in dirname holding the same bytes, so that the whole output
+    can be described as file ranges (as for an X-Sendfile2 header).
+    The files are named after a digest of their contents and are
+    written only once; using one again updates its modification
+    time, which find_stale_literals() goes by.
+    """
+    spilled = []
+    for piece in plan:
+        if not isinstance(piece, str):
+            spilled.append(piece)
+            continue
+        if not piece:
+            continue
+        target = _literal_path(dirname, piece)
+        try:
+            os.utime(target, None)
+            exists = True
+        except OSError, e:
+            # one we may not touch is still there to be used
+            exists = e.errno != errno.ENOENT
+        if not exists:
+            parent = os.path.dirname(target)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            renamed = '%s%d~%d~' % (target,
+                                    os.getpid(),
+                                    thread.get_ident())
+            fp = open(renamed, 'wb')
+            try:
+                fp.write(piece)
+            finally:
+                fp.close()
+            os.rename(renamed, target)
+        spilled.append((target, 0, len(piece)))
+    return spilled
+
+
+def find_stale_literals(dirname, manifestdir, max_age=LITERAL_MAX_AGE):
+    """
+    yields the paths of the literals in dirname (see spill_literals)
+    that no manifest under manifestdir refers to and that haven't
+    been used for max_age seconds.
+    """
+    if not os.path.isdir(dirname):
+        return
+    used = set()
+    for root, dirs, files in os.walk(manifestdir):
+        for f in files:
+            if not f.endswith(MANIFEST_SUFFIX):
+                continue
+            try:
+                loaded = _load_manifest(os.path.join(root, f))
+            except (IOError, OSError):
+                continue
+            if loaded is None:
+                continue
+            for piece in loaded[0]:
+                if isinstance(piece, str):
+                    used.add(_literal_path(dirname, piece))
+    cutoff = time.time() - max_age
+    for root, dirs, files in os.walk(dirname):
+        for f in files:
+            path = os.path.join(root, f)
+            if f.endswith('~') or path in used:
+                # temp files are left alone, as by ewabatch --delete
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    yield path
+            except OSError:
+                pass
+
+
+__all__ = ['LITERAL_MAX_AGE', 'MANIFEST_SUFFIX', 'find_stale_literals',
+           'read_manifest', 'spill_literals', 'write_manifest']
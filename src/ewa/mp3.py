@@ -1,26 +1,37 @@
+from array import array
+from cStringIO import StringIO
+import mmap
 import os
 from struct import unpack
-import subprocess
+import sys
 
-import eyed3
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 from ewa.logutil import debug
-from ewa.frameinfo import get_frame
-from ewa.buffutil import buff_chunk_string, buff_chunk_file
+try:
+    from ewa.frameinfo import get_frame, walk_frames
+except ImportError:
+    from ewa.pyframeinfo import get_frame, walk_frames
+from ewa.pyframeinfo import parse_header
+from ewa.buffutil import buff_chunk_string, buff_chunk_file, buff_chunk_view
+from ewa.iohints import get_io_hints
+from ewa.lru import LRUCache
+from ewa.prefetch import prefetched
+from ewa.procutil import stream_pipeline
+from ewa.segcache import get_segment_cache
+from ewa.spliceindex import SegmentInfo, get_splice_index
+from ewa.xing import make_info_frame, xing_offset
+from ewa.zerocopy import copy_range, get_fileno
 
 
 def _sox_splicer(files,
                  buffsize,
                  sox_path='/usr/bin/sox'):
-    pipe=subprocess.Popen([sox_path, ]+ files + ['-t', 'mp3', '-'],
-                          stdout=subprocess.PIPE)
-    while 1:
-        stuff=pipe.stdout.read(buffsize)
-        if stuff=='':
-            break
-        yield stuff
-    # and we mean wait
-    pipe.wait()
+    return stream_pipeline([[sox_path, ]+ files + ['-t', 'mp3', '-']],
+                           buffsize)
 
 
 def _mp3cat_splicer(files,
@@ -31,68 +42,388 @@ def _mp3cat_splicer(files,
     splicing engine that uses Tom Clegg's mp3cat.
     """
 
-    p1=subprocess.Popen(["cat"]+ files,
-                        stdout=subprocess.PIPE)
-    p2=subprocess.Popen([mp3cat_path, "-", "-"],
-                        stdin=p1.stdout,
-                        stdout=subprocess.PIPE)
-    while 1:
-        stuff=p2.stdout.read(buffsize)
-        if stuff=='':
-            break
-        yield stuff
+    return stream_pipeline([["cat"]+ files,
+                            [mp3cat_path, "-", "-"]],
+                           buffsize)
 
-    p1.wait()
-    p2.wait()
+def _default_splicer(files, buffsize, xing=False):
+    for filename in files:
+        data=_cached_audio(filename, xing)
+        if data is not None:
+            for chunk in buff_chunk_string(data, buffsize):
+                yield chunk
+            continue
+        fp=open(filename, 'rb')
+        try:
+            # skip the tags (and, if writing a new
+            # Xing header, any old ones)
+            info=get_segment_info(filename, fp, frames=xing)
+            start, end=info.audio_range(xing)
+            get_io_hints().start_reading(fp.fileno(), start, end-start)
+            fp.seek(start)
+            for chunk in buff_chunk_file(fp, end, buffsize):
+                yield chunk
+        finally:
+            fp.close()
 
-def _default_splicer(files, buffsize):
+def _mmap_splicer(files, buffsize, xing=False):
+    """
+    splicing engine that maps each file read-only and yields views of
+    its audio rather than copies, so concurrent streams of the same
+    files are all served from the page cache.  Each chunk keeps its
+    map alive, so chunks may be held on to; a map is released once
+    the generator has moved past its file and no chunk of it is
+    left.
+    """
     for filename in files:
+        data=_cached_audio(filename, xing)
+        if data is not None:
+            for chunk in buff_chunk_view(data, 0, len(data), buffsize):
+                yield chunk
+            continue
         fp=open(filename, 'rb')
-        # discard tag
-        tag=get_id3v2_tags(fp)
-        endoffset, endtag=get_id3v1_offset_and_tag(filename, True)
-        for chunk in buff_chunk_file(fp, endoffset, buffsize):
+        try:
+            info=get_segment_info(filename, fp, frames=xing)
+            start, end=info.audio_range(xing)
+            if end <= start:
+                continue
+            m=mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        # not closed explicitly: that would invalidate the chunks
+        # already handed out, which refer to the map
+        for chunk in buff_chunk_view(m, start, end, buffsize):
             yield chunk
+        del m
+
+def _resync_splicer(files, buffsize):
+    """
+    splicing engine that, much as mp3cat does, outputs only the
+    complete frames of each file, dropping tags and any junk,
+    partial frames and false syncs around and between them.
+    """
+    for filename in files:
+        data=_cached_audio(filename)
+        if data is not None:
+            fp=StringIO(data)
+            start, end=0, len(data)
+        else:
+            fp=open(filename, 'rb')
+        try:
+            if data is None:
+                start, end=get_segment_info(filename, fp).audio_range()
+                get_io_hints().start_reading(fp.fileno(), start, end-start)
+            for run in _frame_runs(fp, start, end, buffsize):
+                for chunk in buff_chunk_string(run, buffsize):
+                    yield chunk
+        finally:
+            fp.close()
+
+def _frame_runs(fp, start, end, blocksize=2**20):
+    """
+    yields the complete frames between start and end in the open file
+    fp, as strings of consecutive frames.  After anything that isn't
+    a frame, a frame is only believed if another frame header or the
+    end follows it.
+    """
+    fp.seek(start)
+    base=start
+    buff=''
+    eof=False
+    synced=False
+    while not eof:
+        data=fp.read(min(blocksize, end-base-len(buff)))
+        eof=not data
+        buff+=data
+        off=0
+        while off < len(buff):
+            nframes, stop, frames=walk_frames(buff, off)
+            if nframes==1 and not synced:
+                if len(buff)-stop < 4 and not eof:
+                    # can't tell yet what follows it
+                    break
+                if stop < len(buff) and not get_frame(buff, stop)[0]:
+                    # a false sync
+                    nframes=-1
+            if nframes > 0:
+                yield buff[off:stop]
+                synced=True
+                off=stop
+                if off >= len(buff):
+                    break
+            if (nframes >= 0 and not eof
+                and (len(buff)-off < 4 or get_frame(buff, off)[0])):
+                # a frame, or what may be one, continues into the
+                # next block
+                break
+            # junk; look for the next sync
+            synced=False
+            off=buff.find('\xff', off+1)
+            if off < 0:
+                off=len(buff)
+        buff=buff[off:]
+        base+=off
+
+def _pipe_splicer(files, buffsize):
+    """
+    splicing engine for inputs that can't be seeked, such as pipes:
+    each of files may be a path, '-' for standard input, or an open
+    file.  The ID3v2 tags are skipped as they are read, and only the
+    last BUFFMAX+128 bytes are held back, to drop an ID3v1 tag and
+    any partial frame at the end, so memory use doesn't grow with
+    the inputs.
+    """
+    for f in files:
+        if f=='-':
+            fp=sys.stdin
+        elif isinstance(f, basestring):
+            fp=open(f, 'rb')
+        else:
+            fp=f
+        try:
+            for chunk in _strip_stream(fp, buffsize):
+                yield chunk
+        finally:
+            if fp is not f and fp is not sys.stdin:
+                fp.close()
+
+def _strip_stream(fp, buffsize):
+    window=BUFFMAX+128
+    buff=fp.read(10)
+    if len(buff)==10 and buff[:3]=='ID3':
+        _skip(fp, calculate_id3v2_size(buff))
+        buff=fp.read(14)
+        # as in get_id3v2_tags, infer a footer that wasn't flagged
+        if len(buff)==14 and get_frame(buff)[0]==0 and get_frame(buff, 10)[0]:
+            buff=buff[10:]
+    while 1:
+        data=fp.read(buffsize)
+        if not data:
+            break
+        buff+=data
+        if len(buff) > window:
+            for chunk in buff_chunk_string(buff[:-window], buffsize):
+                yield chunk
+            buff=buff[-window:]
+    if len(buff) >= 128 and buff[-128:-125]=='TAG':
+        buff=buff[:-128]
+    held=max(0, len(buff)-BUFFMAX)
+    end=held+_last_sync_end(buff[held:])
+    for chunk in buff_chunk_string(buff[:end], buffsize):
+        yield chunk
+
+def _skip(fp, nbytes):
+    while nbytes > 0:
+        data=fp.read(min(nbytes, 2**16))
+        if not data:
+            break
+        nbytes-=len(data)
+
+def _sendfile_splicer(files, buffsize, xing=False):
+    """
+    splicing engine that copies audio from file to file inside the
+    kernel when used through splice_to_file() with an output that has
+    a file descriptor; otherwise it is just the default splicer.
+    """
+    return _default_splicer(files, buffsize, xing)
+
+def _prefetch_splicer(files, buffsize, xing=False):
+    """
+    splicing engine that opens, indexes and starts reading the next
+    few files in background threads while the current one is being
+    consumed (see ewa.prefetch), for filesystems where opening a
+    file is slow.
+    """
+    return prefetched([_audio_job(f, xing) for f in files], buffsize)
+
+def _audio_job(filename, xing):
+    def job():
+        data=_cached_audio(filename, xing)
+        if data is not None:
+            return data
+        start, end=get_segment_info(filename, frames=xing).audio_range(xing)
+        return (filename, start, max(0, end-start))
+    return job
+
+def _piece_job(piece):
+    def job():
+        if isinstance(piece, str):
+            return piece
+        path, offset, length=piece
+        data=_cached_range(path, offset, offset+length)
+        if data is not None:
+            return data
+        return piece
+    return job
+
+def _sendfile_to_fd(outfd, files, tagfile=None, xing=False):
+    out=os.fdopen(os.dup(outfd), 'wb')
+    try:
+        if tagfile:
+            taginfo=_copy_audio_range(tagfile, outfd, tags=True)
+        if xing:
+            out.write(combined_info_frame(files))
+            out.flush()
+        for filename in files:
+            _copy_audio_range(filename, outfd, xing=xing)
+        if tagfile and taginfo.id3v1:
+            out.write(taginfo.id3v1)
+    finally:
+        out.close()
+
+def _copy_audio_range(filename, outfd, tags=False, xing=False):
+    """
+    copies the audio of filename (or, if tags is true, its ID3v2
+    tag) to outfd and returns its SegmentInfo.
+    """
+    fp=open(filename, 'rb')
+    try:
+        info=get_segment_info(filename, fp, frames=xing)
+        if tags:
+            offset, length=0, info.audio_start
+        else:
+            start, end=info.audio_range(xing)
+            offset, length=start, end-start
+        get_io_hints().start_reading(fp.fileno(), offset, length)
+        copied=copy_range(fp.fileno(), outfd, offset, length)
+    finally:
         fp.close()
+    if copied != length:
+        raise IOError("%s is shorter than expected" % filename)
+    return info
+
+
+PROBE_FIELDS=('vbr', 'bitrate', 'samplerate', 'mode')
+
+class SanityCheckResult(object):
+    """
+    the outcome of check_mp3s().  template is the probe result of the
+    first file; mismatches is a list of (file, field, expected, got)
+    for every field of every file that differs from it; errors is a
+    list of (file, exception) for every file that couldn't be probed.
+    """
+
+    def __init__(self, files, results):
+        self.files=files
+        self.template=None
+        self.mismatches=[]
+        self.errors=[]
+        for f, (ok, res) in zip(files, results):
+            if not ok:
+                self.errors.append((f, res))
+            elif self.template is None:
+                self.template=res
+            else:
+                for idx, field in enumerate(PROBE_FIELDS):
+                    if res[idx]!=self.template[idx]:
+                        self.mismatches.append((f,
+                                                field,
+                                                self.template[idx],
+                                                res[idx]))
+
+    ok=property(lambda x: not (x.mismatches or x.errors))
+
+    def messages(self):
+        msgs=["%s: %s" % (f, e) for f, e in self.errors]
+        for f, field, expected, got in self.mismatches:
+            msgs.append("%s: %s does not match; expected %s, got %s" % \
+                        (f, field, expected, got))
+        return msgs
+
+def _probe_for_check(path):
+    # runs in the worker processes
+    try:
+        stats=os.stat(path)
+        res=probe_mp3(path)
+    except (Mp3Error, EnvironmentError), e:
+        return False, e, None
+    return True, res, (path, stats.st_size, stats.st_mtime)
+
+def check_mp3s(files, jobs=1):
+    """
+    probes all the files, using a pool of jobs worker processes if
+    jobs is greater than 1, and returns a SanityCheckResult
+    comparing them to the first.
+    """
+    files=list(files)
+    return SanityCheckResult(files, probe_mp3s(files, jobs))
 
+def probe_mp3s(files, jobs=1):
+    """
+    probes all the files, using a pool of jobs worker processes if
+    jobs is greater than 1.  Returns a list with, for each file, a
+    tuple (True, probe) where probe is as returned by
+    get_vbr_bitrate_samplerate_mode(), or (False, exception).
+    """
+    files=list(files)
+    if jobs > 1 and multiprocessing is not None and len(files) > 1:
+        pool=multiprocessing.Pool(min(jobs, len(files)))
+        try:
+            probed=pool.map(_probe_for_check, files)
+        finally:
+            pool.close()
+            pool.join()
+        results=[]
+        for ok, res, key in probed:
+            if ok:
+                # let this process benefit from the workers' probes
+                _probe_cache.put(key, res)
+            results.append((ok, res))
+    else:
+        results=[]
+        for f in files:
+            try:
+                results.append((True, get_vbr_bitrate_samplerate_mode(f)))
+            except (Mp3Error, EnvironmentError), e:
+                results.append((False, e))
+    return results
 
-def mp3_sanity_check(files):
+def mp3_sanity_check(files, jobs=1):
     """
     if all files are mp3 files and
     are of the same bitrate, samplerate, and mode,
-    do nothing; otherwise raise an exception
+    do nothing; otherwise raise an exception.
+    Files are probed by a pool of jobs worker
+    processes if jobs is greater than 1.
     """
     if not files:
         return
-    res=[]
-    for f in files:
-        res.append(get_vbr_bitrate_samplerate_mode(f))
-    template=res[0]
-    fields=['vbr', 'bitrate', 'samplerate', 'mode']
-    for r in res[1:]:
-        diffs=[r[x]==template[x] for x in range(4)]
-        if False in diffs:
-            msg="%s does not match; expected %s, got %s"
-            idx=diffs.index(False)
-            raise ValueError, msg % (fields[idx],
-                                     template[idx],
-                                     r[idx])
+    result=check_mp3s(files, jobs)
+    if result.errors:
+        raise result.errors[0][1]
+    if result.mismatches:
+        f, field, expected, got=result.mismatches[0]
+        msg="%s does not match; expected %s, got %s"
+        raise ValueError, msg % (field, expected, got)
 
 
+# splicers that splice by copying byte ranges of the files
+RANGE_SPLICERS=(_default_splicer, _mmap_splicer, _sendfile_splicer,
+                _prefetch_splicer)
+
 def splice(files,
            tagfile=None,
            buffsize=2**20,
            splicer=_default_splicer,
+           xing=False,
            **splicerKwargs):
     """ Returns an iterator that supplies the spliced data from the files listed
     in chunks not larger than buffsize.  ID3 v2 and v1 tags are supplied from
-    the tagfile if provided.
+    the tagfile if provided.  If xing is true, the Xing or Info headers of
+    the files are replaced by one describing the whole spliced stream (this
+    requires one of the RANGE_SPLICERS).
     """
+    if xing:
+        if splicer not in RANGE_SPLICERS:
+            raise ValueError("xing headers need a range splicer")
+        splicerKwargs['xing']=True
 
     if tagfile:
         fp=open(tagfile, 'rb')
         try:
-            data=get_id3v2_tags(fp)
+            taginfo=get_segment_info(tagfile, fp)
+            fp.seek(0)
+            data=fp.read(taginfo.audio_start)
         finally:
             fp.close()
 
@@ -100,21 +431,593 @@ def splice(files,
             for chunk in buff_chunk_string(data, buffsize):
                 yield chunk
 
+    if xing:
+        infoframe=combined_info_frame(files)
+        if infoframe:
+            yield infoframe
+
     for chunk in splicer(files, buffsize, **splicerKwargs):
         yield chunk
 
+    if tagfile and taginfo.id3v1:
+        yield taginfo.id3v1
+
+def splice_to_file(fp,
+                   files,
+                   tagfile=None,
+                   buffsize=2**20,
+                   splicer=_default_splicer,
+                   xing=False,
+                   **splicerKwargs):
+    """ Writes the spliced data from the files listed to the open file
+    fp.  With the sendfile splicer and an fp that has a file descriptor,
+    the audio is copied inside the kernel; otherwise the chunks supplied
+    by splice() are written out.
+    """
+    outfd=None
+    if splicer is _sendfile_splicer:
+        outfd=get_fileno(fp)
+    if outfd is None:
+        for chunk in splice(files,
+                            tagfile,
+                            buffsize,
+                            splicer,
+                            xing,
+                            **splicerKwargs):
+            fp.write(chunk)
+    else:
+        fp.flush()
+        _sendfile_to_fd(outfd, files, tagfile, xing)
+
+def splice_plan(files, tagfile=None, xing=False, inline_tags=False):
+    """
+    returns a plan of the output splice() would produce with a range
+    splicer: a list whose items are either strings, to be output as
+    is, or tuples (path, offset, length) of byte ranges of files.  If
+    inline_tags is true, the tags of tagfile are included as strings
+    rather than as ranges.
+    """
+    plan=[]
     if tagfile:
-        endoffset, tag=get_id3v1_offset_and_tag(tagfile)
-        if tag:
-            yield tag
+        taginfo=get_segment_info(tagfile)
+        if taginfo.audio_start and inline_tags:
+            fp=open(tagfile, 'rb')
+            try:
+                plan.append(fp.read(taginfo.audio_start))
+            finally:
+                fp.close()
+        elif taginfo.audio_start:
+            plan.append((tagfile, 0, taginfo.audio_start))
+    if xing:
+        infoframe=combined_info_frame(files)
+        if infoframe:
+            plan.append(infoframe)
+    for filename in files:
+        info=get_segment_info(filename, frames=xing)
+        start, end=info.audio_range(xing)
+        if end > start:
+            plan.append((filename, start, end-start))
+    if tagfile and taginfo.id3v1 and inline_tags:
+        plan.append(taginfo.id3v1)
+    elif tagfile and taginfo.id3v1:
+        plan.append((tagfile, taginfo.size-len(taginfo.id3v1),
+                     len(taginfo.id3v1)))
+    return plan
+
+def _piece_length(piece):
+    if isinstance(piece, str):
+        return len(piece)
+    return piece[2]
+
+def plan_length(plan):
+    """
+    returns the number of bytes in the output described by plan.
+    """
+    return sum([_piece_length(p) for p in plan])
+
+def slice_plan(plan, start=0, end=None):
+    """
+    returns a plan describing bytes start to end (exclusive) of the
+    output described by plan.
+    """
+    if end is None:
+        end=plan_length(plan)
+    sliced=[]
+    pos=0
+    for piece in plan:
+        length=_piece_length(piece)
+        if pos >= end:
+            break
+        if pos+length > start:
+            lo=max(start-pos, 0)
+            hi=min(end-pos, length)
+            if isinstance(piece, str):
+                sliced.append(piece[lo:hi])
+            else:
+                sliced.append((piece[0], piece[1]+lo, hi-lo))
+        pos+=length
+    return sliced
+
+def read_plan(plan, buffsize=2**20, start=0, end=None,
+              splicer=_default_splicer):
+    """
+    returns an iterator that supplies bytes start to end (exclusive)
+    of the output described by plan, in chunks not larger than
+    buffsize, reading only the parts of the files that are needed.
+    The files are read the way splicer, one of the RANGE_SPLICERS,
+    reads them: with the mmap splicer the chunks are views of the
+    mapped files, and with the prefetch splicer the next pieces are
+    opened and read ahead in background threads.  The sendfile
+    splicer can only have the kernel copy to a file, so it reads
+    like the default splicer here.
+    """
+    if splicer is _prefetch_splicer:
+        return prefetched([_piece_job(p) for p in slice_plan(plan, start, end)],
+                          buffsize)
+    if splicer is _mmap_splicer:
+        return _map_plan(plan, buffsize, start, end)
+    return _read_plan(plan, buffsize, start, end)
+
+def _map_plan(plan, buffsize, start, end):
+    for piece in slice_plan(plan, start, end):
+        if isinstance(piece, str):
+            for chunk in buff_chunk_string(piece, buffsize):
+                yield chunk
+            continue
+        path, offset, length=piece
+        data=_cached_range(path, offset, offset+length)
+        if data is not None:
+            for chunk in buff_chunk_view(data, 0, len(data), buffsize):
+                yield chunk
+            continue
+        fp=open(path, 'rb')
+        try:
+            m=mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        # as in the mmap splicer, the map lives as long as its views
+        for chunk in buff_chunk_view(m, offset, offset+length, buffsize):
+            yield chunk
+        del m
+
+def _read_plan(plan, buffsize, start, end):
+    for piece in slice_plan(plan, start, end):
+        if isinstance(piece, str):
+            for chunk in buff_chunk_string(piece, buffsize):
+                yield chunk
+        else:
+            path, offset, length=piece
+            data=_cached_range(path, offset, offset+length)
+            if data is not None:
+                for chunk in buff_chunk_string(data, buffsize):
+                    yield chunk
+                continue
+            fp=open(path, 'rb')
+            try:
+                fp.seek(offset)
+                for chunk in buff_chunk_file(fp, offset+length, buffsize):
+                    yield chunk
+            finally:
+                fp.close()
+
+def combined_info_frame(files):
+    """
+    returns a Xing or Info frame describing the audio of the files
+    spliced together, without their own Xing or Info frames; or ''
+    if the files aren't layer III.
+    """
+    infos=[get_segment_info(f, frames=True) for f in files]
+    headers=[i.header for i in infos if i.header]
+    if not headers:
+        return ''
+    bitrates=set([parse_header(h)[3] for h in headers])
+    vbr=len(bitrates) > 1 or True in [i.vbr for i in infos]
+    segments=[(i.nframes, i.audio_length-i.info_frame) for i in infos]
+    return make_info_frame(headers[0], segments, vbr)
+
+def segment_duration(info):
+    """
+    returns the play time in seconds of the audio described by info,
+    a SegmentInfo whose frames have been walked.
+    """
+    length, version, layer, bitrate, samplerate, mode=parse_header(info.header)
+    if not length:
+        return 0.0
+    return info.nframes*samples_per_frame(version, layer)/float(samplerate)
+
+def splice_timing(files):
+    """
+    returns a tuple (duration, offsets) for the files spliced
+    together: the total play time in seconds, and a list of the times
+    at which each file starts.  Counts frames rather than decoding,
+    and only the first time a file is seen.
+    """
+    offsets=[]
+    duration=0.0
+    for filename in files:
+        offsets.append(duration)
+        duration+=segment_duration(get_segment_info(filename, frames=True))
+    return duration, offsets
+
+def _audio_pieces(plan):
+    # the indexes in plan, as made by splice_plan(), of the pieces
+    # that are the audio of a file, each with a SegmentInfo describing
+    # the file's frames
+    found=[]
+    for idx, piece in enumerate(plan):
+        if isinstance(piece, str):
+            continue
+        filename, offset, length=piece
+        info=get_segment_info(filename)
+        if (length and info.audio_start <= offset
+            and offset+length <= info.audio_end):
+            found.append((idx, get_segment_info(filename, frames=True)))
+    return found
+
+def plan_timing(plan):
+    """
+    like splice_timing(), but for the output described by plan, as
+    made by splice_plan(): returns its play time in seconds and a
+    list of the times at which the audio of each file in it starts.
+    """
+    offsets=[]
+    duration=0.0
+    for idx, info in _audio_pieces(plan):
+        offsets.append(duration)
+        duration+=segment_duration(info)
+    return duration, offsets
+
+# how many frames apart the seekpoints recorded for each file are
+SEEK_INTERVAL=32
+
+def seek_plan(plan, seconds=0.0):
+    """
+    returns a plan of the output described by plan, as made by
+    splice_plan(), starting from the audio frame at or just before
+    the given play time, and the time at which that frame starts.
+    The tags are kept; a Xing or Info frame for the whole output is
+    not, as it would no longer describe it.
+    """
+    pieces=[p for p in _audio_pieces(plan) if p[1].nframes]
+    if not pieces or seconds <= 0:
+        return plan, 0.0
+    start=0.0
+    for n, (idx, info) in enumerate(pieces):
+        duration=segment_duration(info)
+        if seconds < start+duration or n==len(pieces)-1:
+            break
+        start+=duration
+    fields=parse_header(info.header)
+    spf=samples_per_frame(fields[1], fields[2])
+    frame=int((seconds-start)*fields[4]/spf)
+    frame=max(0, min(frame, info.nframes-1))
+    filename, offset, length=plan[idx]
+    pos=_frame_offset(filename, info, frame)
+    head=[p for p in plan[:pieces[0][0]]
+          if not (isinstance(p, str) and get_frame(p)[0])]
+    seeked=head+[(filename, pos, offset+length-pos)]+plan[idx+1:]
+    return seeked, start+frame*spf/float(fields[4])
+
+def _frame_offset(filename, info, n):
+    # the offset in filename of its n-th audio frame, walking from
+    # the seekpoint before it
+    offset=info.seekpoints[n // SEEK_INTERVAL]
+    skip=n % SEEK_INTERVAL
+    if not skip:
+        return offset
+    fp=open(filename, 'rb')
+    try:
+        for frame in iter_frames(fp, offset, info.audio_end, 2**16):
+            if not skip:
+                return frame[0]
+            skip-=1
+    finally:
+        fp.close()
+    return offset
+
+def _load_segment(filename, cache):
+    fp=open(filename, 'rb')
+    try:
+        info=get_segment_info(filename, fp)
+        fp.seek(info.audio_start)
+        data=fp.read(info.audio_length)
+        stats=os.fstat(fp.fileno())
+    finally:
+        fp.close()
+    cache.store(filename, stats, info.audio_start, data)
+    return info.audio_start, data
+
+def _cached_range(filename, start, end):
+    """
+    returns bytes start to end of filename from the segment cache,
+    loading the file's audio into the cache first if need be, or None
+    if the file isn't eligible for the cache, its audio is larger
+    than the cache, or the range isn't within its audio.
+    """
+    cache=get_segment_cache()
+    if not cache.covers(filename):
+        return None
+    entry=cache.lookup(filename, os.stat(filename))
+    if entry is None:
+        if get_segment_info(filename).audio_length > cache.maxbytes:
+            # it would be dropped again as soon as it was stored
+            return None
+        entry=_load_segment(filename, cache)
+    astart, data=entry
+    if start < astart or end > astart+len(data):
+        return None
+    return data[start-astart:end-astart]
+
+def _cached_audio(filename, xing=False):
+    # the audio a splicer should output for filename, if it can
+    # come from the segment cache
+    if not get_segment_cache().covers(filename):
+        return None
+    start, end=get_segment_info(filename, frames=xing).audio_range(xing)
+    return _cached_range(filename, start, end)
+
+def preload_segments(dirname, frames=False):
+    """
+    loads the audio of the mp3 files under dirname into the segment
+    cache, until it is full.  If frames is true, the files' frames
+    are also walked, as needed for Xing headers.  Returns the number
+    of files loaded.
+    """
+    cache=get_segment_cache()
+    loaded=0
+    for root, dirs, files in os.walk(dirname):
+        for f in files:
+            if not f.lower().endswith('.mp3'):
+                continue
+            path=os.path.join(root, f)
+            if not cache.covers(path):
+                continue
+            info=get_segment_info(path, frames=frames)
+            if cache.stats()['weight'] + info.audio_length > cache.maxbytes:
+                return loaded
+            _load_segment(path, cache)
+            loaded+=1
+    return loaded
+
+def get_segment_info(filename, fp=None, index=None, frames=False):
+    """
+    returns a SegmentInfo describing where the audio in filename
+    starts and ends and what its ID3v1 tag is, consulting the splice
+    index first and scanning the file only if the index has no
+    current entry for it.  If frames is true, the SegmentInfo also
+    describes the frames of the audio, which means reading all of it
+    the first time.  If fp is given it should be filename opened for
+    reading; its position is not preserved.
+    """
+    if index is None:
+        index=get_splice_index()
+    if fp is None:
+        stats=os.stat(filename)
+    else:
+        stats=os.fstat(fp.fileno())
+    info=index.lookup(filename, stats)
+    if info is None or (frames and not info.has_frames):
+        if fp is None:
+            fp=open(filename, 'rb')
+            try:
+                info=_scan_segment(filename, fp, stats, info, frames)
+            finally:
+                fp.close()
+        else:
+            info=_scan_segment(filename, fp, stats, info, frames)
+        index.store(info)
+    return info
+
+def _scan_segment(filename, fp, stats, info=None, frames=False):
+    if info is None:
+        fp.seek(0)
+        start=len(get_id3v2_tags(fp))
+        end, tag=_get_id3v1_offset_and_tag(fp, stats.st_size, True)
+        # a file that is nothing but tags
+        end=max(start, end)
+        info=SegmentInfo(filename,
+                         stats.st_size,
+                         stats.st_mtime,
+                         dict(audio_start=start,
+                              audio_end=end,
+                              id3v1=tag))
+    if frames:
+        info.__dict__.update(_scan_frames(fp, info))
+    return info
+
+def iter_frames(fp, start, end, blocksize=2**20):
+    """
+    yields a tuple (offset, length, version, layer, bitrate,
+    samplerate, mode) for every frame between start and end in the
+    open file fp, skipping over anything that isn't a frame.
+    """
+    fp.seek(start)
+    base=start
+    buff=''
+    eof=False
+    while not eof:
+        data=fp.read(min(blocksize, end-base-len(buff)))
+        eof=not data
+        buff+=data
+        off=0
+        while off < len(buff):
+            nframes, off, frames=walk_frames(buff, off)
+            for f in frames:
+                yield (base+f[0],)+f[1:]
+            if off >= len(buff):
+                break
+            frlen=get_frame(buff, off)[0]
+            if frlen and not eof:
+                # a frame continues into the next block
+                break
+            # junk; look for the next sync
+            off=buff.find('\xff', off+1)
+            if off < 0:
+                off=len(buff)
+        buff=buff[off:]
+        base+=off
+
+def _scan_frames(fp, info):
+    """
+    walks the frames of the audio described by info, returning a
+    dictionary of:
+
+      * nframes: the number of audio frames.
+      * header: the first frame header, or '' if there are no frames.
+      * info_frame: the length of the first frame if it holds a Xing,
+        Info or VBRI header rather than audio (it isn't counted in
+        nframes), otherwise 0.
+      * vbr: whether the frames' bitrates vary.
+      * seekpoints: the offsets of every SEEK_INTERVAL-th audio
+        frame, starting with the first.
+    """
+    offsets=array('l')
+    first=None
+    bitrates=set()
+    for frame in iter_frames(fp, info.audio_start, info.audio_end):
+        if first is None:
+            first=frame
+        offsets.append(frame[0])
+        bitrates.add(frame[4])
+    nframes=len(offsets)
+    header=''
+    info_frame=0
+    if first is not None:
+        fp.seek(first[0])
+        data=fp.read(first[1])
+        header=data[:4]
+        if first[0]==info.audio_start and is_info_frame(data):
+            info_frame=first[1]
+            nframes-=1
+            offsets=offsets[1:]
+    return dict(nframes=nframes,
+                header=header,
+                info_frame=info_frame,
+                vbr=len(bitrates) > 1,
+                seekpoints=offsets[::SEEK_INTERVAL].tolist())
+
+def is_info_frame(frame):
+    """
+    returns whether frame, a complete frame, holds a Xing,
+    Info or VBRI header.
+    """
+    fields=parse_header(frame[:4])
+    pos=xing_offset(fields[1], fields[5])
+    return frame[pos:pos+4] in ('Xing', 'Info') or frame[36:40]=='VBRI'
+
+class Mp3Error(RuntimeError):
+    pass
+
+# channel modes, as abbreviated in transcoded paths and for lame's -m
+MODES=('s', 'j', 'd', 'm')
+
+# how much audio to read looking for the first frame
+PROBE_SIZE=16384
+
+def samples_per_frame(version, layer):
+    """
+    returns the number of samples in a frame of the given version
+    and layer, as returned by get_frame().
+    """
+    if layer==3:
+        # layer I
+        return 384
+    elif layer==1 and version!=3:
+        # MPEG 2 and 2.5 layer III
+        return 576
+    return 1152
+
+def _find_first_frame(buff):
+    """
+    returns the offset in buff of the first frame that is followed by
+    another valid frame header (or by the end of buff), followed by
+    its fields as returned by parse_header(); or None.
+    """
+    idx=buff.find('\xff')
+    while idx >= 0:
+        fields=parse_header(buff[idx:idx+4])
+        frlen=fields[0]
+        if frlen:
+            nxt=idx+frlen
+            if nxt+4 > len(buff) or get_frame(buff, nxt)[0]:
+                return (idx,)+fields
+        idx=buff.find('\xff', idx+1)
+    return None
+
+def probe_mp3(path):
+    """
+    reads just enough of the mp3 file at path -- the ID3v2 header, the
+    first frame and any Xing, Info or VBRI header -- to determine its
+    format.  Returns a 4-tuple: whether the file is VBR, the bitrate in
+    kbps (the average bitrate for a VBR file), the samplerate, and the
+    mode.  Raises Mp3Error if no mp3 frame can be found.
+    """
+    fp=open(path, 'rb')
+    try:
+        header=fp.read(10)
+        start=0
+        if len(header)==10 and header[:3]=='ID3':
+            start=10+calculate_id3v2_size(header)
+        fp.seek(start)
+        buff=fp.read(PROBE_SIZE)
+    finally:
+        fp.close()
+    first=_find_first_frame(buff)
+    if first is None:
+        raise Mp3Error("Unable to find a valid mp3 frame in '%s'" % path)
+    idx, frlen, version, layer, bitrate, samplerate, mode=first
+    frame=buff[idx:idx+frlen]
+    vbr=False
+    bitrate=bitrate // 1000
+    nframes=nbytes=0
+    pos=xing_offset(version, mode)
+    if frame[pos:pos+4]=='Xing':
+        vbr=True
+        flags,=unpack('>I', frame[pos+4:pos+8].rjust(4, '\x00'))
+        pos+=8
+        if flags & 1 and len(frame) >= pos+4:
+            nframes,=unpack('>I', frame[pos:pos+4])
+            pos+=4
+        if flags & 2 and len(frame) >= pos+4:
+            nbytes,=unpack('>I', frame[pos:pos+4])
+    elif frame[36:40]=='VBRI' and len(frame) >= 54:
+        vbr=True
+        nbytes, nframes=unpack('>II', frame[46:54])
+    if vbr and nframes and nbytes:
+        tpf=float(samples_per_frame(version, layer)) / samplerate
+        bitrate=int((nbytes * 8) / (tpf * nframes * 1000))
+    return vbr, bitrate, samplerate, MODES[mode]
+
+_probe_cache=LRUCache(1000)
+
+def get_probe_cache():
+    """
+    returns the process-wide cache of probe results, whose stats()
+    method reports its hits, misses and evictions.
+    """
+    return _probe_cache
+
+def initProbeCache(maxsize):
+    """
+    sets the maximum number of entries in the probe cache;
+    0 disables it.
+    """
+    _probe_cache.resize(maxsize)
 
 def get_vbr_bitrate_samplerate_mode(path):
     """
     returns a 4-tuple: whether the file is VBR,
     the bitrate, the samplerate, and the mode.
+    Results are cached for as long as the file's
+    size and modification time stay the same.
     """
-    af = eyed3.Mp3AudioFile(path)
-    return af.getBitRate() + (af.getSampleFreq(), af.header.mode[0].lower())
+    stats=os.stat(path)
+    key=(path, stats.st_size, stats.st_mtime)
+    res=_probe_cache.get(key)
+    if res is None:
+        res=probe_mp3(path)
+        _probe_cache.put(key, res)
+    return res
 
 def calculate_id3v2_size(header):
     """
@@ -152,7 +1055,7 @@ def get_id3v2_tags(fp):
         buff=fp.read(8192)
         fp.seek(idx)
         fr=get_frame(buff)
-        nxfr=get_frame(buff[10:])
+        nxfr=get_frame(buff, 10)
 
         if fr[0]==0 and nxfr[0]!=0:
             # we'll conclude that there was a footer
@@ -162,23 +1065,26 @@ def get_id3v2_tags(fp):
 
 def get_id3v1_offset_and_tag(filename, correct_offset=False):
     size=os.path.getsize(filename)
-    tagidx=size-128
     fp=open(filename, 'rb')
     try:
-        fp.seek(tagidx)
-        tag=fp.read(128)
-        if tag[:3]=='TAG':
-            if correct_offset:
-                return _check_last_sync(fp, tagidx), tag
-            else:
-                return tagidx, tag
-        if correct_offset:
-            return _check_last_sync(fp, size), ''
-        else:
-            return size, ''
+        return _get_id3v1_offset_and_tag(fp, size, correct_offset)
     finally:
         fp.close()
 
+def _get_id3v1_offset_and_tag(fp, size, correct_offset=False):
+    tagidx=max(0, size-128)
+    fp.seek(tagidx)
+    tag=fp.read(128)
+    if tag[:3]=='TAG':
+        if correct_offset:
+            return _check_last_sync(fp, tagidx), tag
+        else:
+            return tagidx, tag
+    if correct_offset:
+        return _check_last_sync(fp, size), ''
+    else:
+        return size, ''
+
 
 BUFFMAX=8192
 
@@ -194,10 +1100,18 @@ def _check_last_sync(fp, idx):
     fp.seek(newidx)
     stuff=fp.read(buffsize)
     fp.seek(where)
+    return idx-(buffsize-_last_sync_end(stuff))
+
+def _last_sync_end(stuff):
+    """
+    returns the end of the last complete frame in stuff, the last
+    bytes before the end of an mp3's audio, or len(stuff) if no
+    frame is found.
+    """
     prevend=end=len(stuff)
     while end >= 0:
         end=stuff.rfind('\xff', 0, end)
-        frlen, frver, frlayer=get_frame(stuff[end:])
+        frlen, frver, frlayer=get_frame(stuff, end)
         if frlen==0:
             # invalid, not a sync at all
             continue
@@ -206,13 +1120,12 @@ def _check_last_sync(fp, idx):
             # do we have a full frame?
             if frlen == prevend-end:
                 # perfect
-                newidx=idx-(buffsize-prevend)
-                #debug("valid frame ends at %d", newidx)
-                return newidx
+                #debug("valid frame ends at %d", prevend)
+                return prevend
             else:
                 #debug("frlen: %d, prevend-end: %d", frlen, prevend-end)
                 # fragmentary frame, delete it
-                #debug("invalid frame at %d", idx-(buffsize-end))
+                #debug("invalid frame at %d", end)
                 prevend=end
                 continue
 
@@ -223,4 +1136,4 @@ def _check_last_sync(fp, idx):
          'no cleanup attempted'),
         BUFFMAX)
 
-    return idx
+    return len(stuff)
@@ -0,0 +1,241 @@
+"""
+
+Overlapping the reading of the next parts of a splice with the sending
+of the current one.
+
+Splicing handles its inputs in order, and on a slow filesystem each
+new file costs an open, a look at its tags and a first read before its
+first byte can be sent.  prefetched() hands that work for the next few
+parts to a small pool of threads while the current part is being
+consumed, keeping at most a fixed number of bytes read ahead per
+splice, and records how long the consumer had to wait at each part
+boundary anyway.
+
+The pool is shared by every splice in the process, so it is only
+trusted with work that nobody is waiting for yet: a part that is
+needed before a thread has got round to it is prepared by the
+consumer itself, and the thread skips it.
+
+"""
+
+from collections import deque
+import os
+import sys
+import threading
+import time
+
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    ThreadPool = None
+
+from ewa.buffutil import buff_chunk_string, buff_chunk_file
+from ewa.iohints import get_io_hints
+from ewa.logutil import debug
+
+_settings = dict(segments=2, maxbytes=2**22, threads=4)
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_stats = dict(segments=0, gap_total=0.0, gap_max=0.0)
+
+
+def initPrefetch(segments=2, maxbytes=2**22, threads=4):
+    """
+    sets how many parts beyond the current one are prefetched, how
+    many bytes may be read ahead in all for one splice, and how many
+    threads do the prefetching in each process.
+    """
+    global _pool
+    _lock.acquire()
+    try:
+        _settings.update(segments=segments, maxbytes=maxbytes,
+                         threads=threads)
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = None
+    finally:
+        _lock.release()
+
+
+def _get_pool():
+    # threads don't survive a fork, so each process makes its own
+    global _pool, _pool_pid
+    if ThreadPool is None:
+        return None
+    _lock.acquire()
+    try:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(_settings['threads'])
+            _pool_pid = os.getpid()
+        return _pool
+    finally:
+        _lock.release()
+
+
+def get_prefetch_stats():
+    """
+    returns a dictionary of the number of parts prefetched and the
+    total and longest times, in seconds, that a consumer waited for
+    a part to be ready.
+    """
+    _lock.acquire()
+    try:
+        return _stats.copy()
+    finally:
+        _lock.release()
+
+
+def _record(gap):
+    _lock.acquire()
+    try:
+        _stats['segments'] += 1
+        _stats['gap_total'] += gap
+        _stats['gap_max'] = max(_stats['gap_max'], gap)
+    finally:
+        _lock.release()
+
+
+def _fetch(job, headsize):
+    piece = job()
+    if isinstance(piece, str):
+        return piece
+    path, offset, length = piece
+    fp = open(path, 'rb')
+    try:
+        get_io_hints().start_reading(fp.fileno(), offset, length)
+        fp.seek(offset)
+        head = fp.read(min(length, headsize))
+    except:
+        fp.close()
+        raise
+    return fp, head, offset + length
+
+
+def _close(result):
+    if result is not None and not isinstance(result, str):
+        result[0].close()
+
+
+class _Part(object):
+    """
+    one part of a splice, prepared by whichever comes first: a
+    prefetching thread or the consumer.
+    """
+
+    def __init__(self, job, headsize):
+        self.job = job
+        self.headsize = headsize
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.claimed = False
+        self.abandoned = False
+        self.result = None
+        self.error = None
+
+    def _claim(self):
+        self.lock.acquire()
+        try:
+            if self.claimed:
+                return False
+            self.claimed = True
+            return True
+        finally:
+            self.lock.release()
+
+    def prefetch(self):
+        # run in a pool thread
+        if not self._claim():
+            return
+        try:
+            result = _fetch(self.job, self.headsize)
+        except:
+            self.error = sys.exc_info()
+            result = None
+        self.lock.acquire()
+        try:
+            self.result = result
+            abandoned = self.abandoned
+        finally:
+            self.lock.release()
+        if abandoned:
+            _close(result)
+        self.done.set()
+
+    def get(self):
+        # run by the consumer
+        if self._claim():
+            return _fetch(self.job, self.headsize)
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+    def abandon(self):
+        # closes the file opened for this part, now or, if it is
+        # still being opened, when it is
+        self.lock.acquire()
+        try:
+            self.abandoned = True
+            self.claimed = True
+            result = self.result
+            self.result = None
+        finally:
+            self.lock.release()
+        _close(result)
+
+
+def prefetched(jobs, buffsize):
+    """
+    yields the bytes described by jobs, a sequence of callables each
+    returning either a string or a tuple (path, offset, length) of a
+    range of a file, in chunks of at most buffsize bytes.  The jobs
+    for the parts after the current one are run, and the start of
+    their ranges read, in background threads.
+    """
+    pool = _get_pool()
+    ahead = _settings['segments']
+    headsize = max(1, _settings['maxbytes'] // (ahead + 1))
+    jobs = iter(jobs)
+    pending = deque()
+
+    def submit():
+        for job in jobs:
+            part = _Part(job, headsize)
+            pending.append(part)
+            if pool is not None and len(pending) > 1:
+                # the first is needed right away
+                pool.apply_async(part.prefetch)
+            return
+
+    try:
+        for i in xrange(ahead + 1):
+            submit()
+        while pending:
+            part = pending[0]
+            t = time.time()
+            res = part.get()
+            gap = time.time() - t
+            pending.popleft()
+            _record(gap)
+            debug("waited %.4fs for the next part", gap)
+            submit()
+            if isinstance(res, str):
+                for chunk in buff_chunk_string(res, buffsize):
+                    yield chunk
+                continue
+            fp, head, end = res
+            try:
+                for chunk in buff_chunk_string(head, buffsize):
+                    yield chunk
+                for chunk in buff_chunk_file(fp, end, buffsize):
+                    yield chunk
+            finally:
+                fp.close()
+    finally:
+        for part in pending:
+            part.abandon()
+
+
+__all__ = ['get_prefetch_stats', 'initPrefetch', 'prefetched']
@@ -0,0 +1,126 @@
+"""
+
+Running pipelines of external programs whose output is streamed.
+
+The external splicing engines (sox, mp3cat) are read from a generator
+that a WSGI server may abandon at any time, when the client goes away.
+stream_pipeline() makes sure that closing or discarding the generator
+terminates and reaps every process in the pipeline and closes its
+pipes, and counts the processes it has running so that leaks show up.
+Output is read no faster than it is consumed: the only buffering is
+the pipe itself, so a slow client simply blocks the pipeline.
+
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from ewa.logutil import debug, warn
+
+# how long to wait for a terminated process before killing it
+TERMINATE_TIMEOUT = 2.0
+
+_lock = threading.Lock()
+_counts = dict(live=0, started=0, terminated=0, failed=0)
+
+
+def _count(key, n=1):
+    _lock.acquire()
+    try:
+        _counts[key] += n
+    finally:
+        _lock.release()
+
+
+def get_process_stats():
+    """
+    returns a dictionary of counters: the number of external
+    processes now running ('live'), and how many have been started,
+    terminated before finishing, and have exited with an error.
+    """
+    _lock.acquire()
+    try:
+        return _counts.copy()
+    finally:
+        _lock.release()
+
+
+def _reap(proc, timeout=TERMINATE_TIMEOUT):
+    # returns True if the process had to be terminated
+    if proc.poll() is not None:
+        return False
+    try:
+        proc.terminate()
+    except OSError:
+        # already gone
+        pass
+    deadline = time.time() + timeout
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.01)
+    if proc.poll() is None:
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        proc.wait()
+    return True
+
+
+def _restore_sigpipe():
+    # Python ignores SIGPIPE and children inherit that, so a process
+    # whose reader went away would get EPIPE and exit with an error
+    # rather than die quietly
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def stream_pipeline(commands, buffsize):
+    """
+    runs commands, a list of argument lists, as a pipeline, each
+    reading the output of the one before, and yields the output of
+    the last in chunks of at most buffsize bytes.  When the generator
+    is exhausted, closed or garbage-collected, any process still
+    running is terminated, all of them are reaped and all pipes are
+    closed.
+    """
+    procs = []
+    try:
+        stdin = None
+        for args in commands:
+            proc = subprocess.Popen(args,
+                                    stdin=stdin,
+                                    stdout=subprocess.PIPE,
+                                    close_fds=True,
+                                    preexec_fn=_restore_sigpipe)
+            procs.append(proc)
+            _count('started')
+            _count('live')
+            if stdin is not None:
+                # only the next process should hold the read end,
+                # so that it sees EOF and the writer sees SIGPIPE
+                stdin.close()
+            stdin = proc.stdout
+        fd = procs[-1].stdout.fileno()
+        while 1:
+            stuff = os.read(fd, buffsize)
+            if not stuff:
+                break
+            yield stuff
+    finally:
+        for proc in reversed(procs):
+            if proc.stdout and not proc.stdout.closed:
+                proc.stdout.close()
+            if _reap(proc):
+                _count('terminated')
+                debug("terminated process %d", proc.pid)
+            # one killed by SIGPIPE only lost its reader, which
+            # isn't a failure
+            elif proc.returncode and proc.returncode != -signal.SIGPIPE:
+                _count('failed')
+                warn("process %d exited with %d", proc.pid, proc.returncode)
+            _count('live', -1)
+
+
+__all__ = ['get_process_stats', 'stream_pipeline']
@@ -0,0 +1,242 @@
+"""
+
+A pure Python implementation of the ewa.frameinfo extension, used when
+the extension isn't available.
+
+get_frame() and walk_frames() have the same contract as their C
+counterparts.  If NumPy is installed, walk_frames() finds sync-word
+candidates and decodes their headers for a whole block of the buffer
+at once, and then only has to chain frame lengths in Python; otherwise
+every header is decoded in Python.
+
+"""
+
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# these mirror the tables in frameinfo.c
+V1L1_BITRATE = (-1, 32, 64, 96, 128, 160, 192, 224,
+                256, 288, 320, 352, 384, 416, 448, -1)
+V1L2_BITRATE = (-1, 32, 48, 56, 64, 80, 96, 112,
+                128, 160, 192, 224, 256, 320, 384, -1)
+V1L3_BITRATE = (-1, 32, 40, 48, 56, 64, 80, 96,
+                112, 128, 160, 192, 224, 256, 320, -1)
+V2L1_BITRATE = (-1, 32, 48, 56, 64, 80, 96, 112,
+                128, 144, 160, 176, 192, 224, 256, -1)
+V2L2OR3_BITRATE = (-1, 8, 16, 24, 32, 40, 48, 56,
+                   64, 80, 96, 112, 128, 144, 160, -1)
+NO_BITRATE = (-1,) * 16
+
+VERSION_1 = 3
+VERSION_2 = 2
+VERSION_25 = 0
+
+LAYER_I = 3
+LAYER_II = 2
+LAYER_III = 1
+
+# indexed by [version][layer]
+BITRATE_TABLE = ((NO_BITRATE, V2L2OR3_BITRATE, V2L2OR3_BITRATE, V2L1_BITRATE),
+                 (NO_BITRATE,) * 4,
+                 (NO_BITRATE, V2L2OR3_BITRATE, V2L2OR3_BITRATE, V2L1_BITRATE),
+                 (NO_BITRATE, V1L3_BITRATE, V1L2_BITRATE, V1L1_BITRATE))
+
+# indexed by [version][samplerate index]
+SAMPLERATE_TABLE = ((11025, 12000, 8000, -1),
+                    (-1, -1, -1, -1),
+                    (22050, 24000, 16000, -1),
+                    (44100, 48000, 32000, -1))
+
+# how much of the buffer to decode at once with NumPy
+BLOCKSIZE = 2**20
+
+# the buffer last walked and its decoded blocks by start offset, so
+# that walking a buffer a few frames per call (as ewa.mp3 does after
+# junk) decodes each block once rather than once per call
+_decoded = (None, {})
+
+
+def _frame_length(version, layer, bitrate, samplerate, padding):
+    if layer == LAYER_I:
+        return (12 * bitrate // samplerate + padding) * 4
+    elif version == VERSION_1 or layer != LAYER_III:
+        return 144 * bitrate // samplerate + padding
+    else:
+        return 72 * bitrate // samplerate + padding
+
+
+def parse_header(header):
+    """
+    decodes the four bytes of header; returns a tuple (length,
+    version, layer, bitrate, samplerate, mode), with a length of 0 if
+    the header is invalid.
+    """
+    if len(header) < 4:
+        return (0, 0, 0, 0, 0, 0)
+    b0, b1, b2, b3 = [ord(c) for c in header[:4]]
+    if b0 != 0xff or (b1 & 0xe0) != 0xe0:
+        return (0, 0, 0, 0, 0, 0)
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    bitrate = BITRATE_TABLE[version][layer][(b2 >> 4) & 15]
+    samplerate = SAMPLERATE_TABLE[version][(b2 >> 2) & 3]
+    if bitrate <= 0 or samplerate <= 0:
+        return (0, 0, 0, 0, 0, 0)
+    bitrate *= 1000
+    length = _frame_length(version, layer, bitrate, samplerate,
+                           (b2 >> 1) & 1)
+    return (length, version, layer, bitrate, samplerate, (b3 >> 6) & 3)
+
+
+def get_frame(buff, offset=0):
+    """
+    for a buffer of bytes from an mp3 file aligned at a frame header
+    at offset, returns the length of the frame, its version and its
+    layer.
+    """
+    if offset < 0:
+        return (0, 0, 0)
+    frlen, version, layer = parse_header(buff[offset:offset + 4])[:3]
+    return (frlen, version, layer)
+
+
+def _decode_block(arr, start, stop):
+    """
+    decodes every sync candidate in arr[start:stop]; returns a list of
+    candidate offsets and a list of (length, version, layer, bitrate,
+    samplerate, mode) tuples for them, with a length of 0 for
+    candidates that aren't valid headers.
+    """
+    b0 = arr[start:stop]
+    b1 = arr[start + 1:stop + 1]
+    n = len(b1)
+    b0 = b0[:n]
+    cand = numpy.flatnonzero((b0 == 0xff) & ((b1 & 0xe0) == 0xe0))
+    # a header needs four bytes
+    cand = cand[cand + start + 4 <= len(arr)]
+    if not len(cand):
+        return [], []
+    pos = cand + start
+    h1 = arr[pos + 1].astype(numpy.int64)
+    h2 = arr[pos + 2].astype(numpy.int64)
+    h3 = arr[pos + 3].astype(numpy.int64)
+    version = (h1 >> 3) & 3
+    layer = (h1 >> 1) & 3
+    bitrate = _np_bitrates[version, layer, (h2 >> 4) & 15]
+    samplerate = _np_samplerates[version, (h2 >> 2) & 3]
+    padding = (h2 >> 1) & 1
+    valid = (bitrate > 0) & (samplerate > 0)
+    bitrate = numpy.where(valid, bitrate * 1000, 0)
+    safe_sr = numpy.where(valid, samplerate, 1)
+    length = numpy.where(
+        layer == LAYER_I,
+        (12 * bitrate // safe_sr + padding) * 4,
+        numpy.where((version == VERSION_1) | (layer != LAYER_III),
+                    144 * bitrate // safe_sr + padding,
+                    72 * bitrate // safe_sr + padding))
+    length = numpy.where(valid, length, 0)
+    mode = (h3 >> 6) & 3
+    fields = zip(length.tolist(), version.tolist(), layer.tolist(),
+                 bitrate.tolist(), samplerate.tolist(), mode.tolist())
+    return pos.tolist(), fields
+
+
+def scan_headers(buff, offset=0):
+    """
+    yields (offset, (length, version, layer, bitrate, samplerate,
+    mode)) for every valid frame header in buff at or after offset,
+    in order.  Uses NumPy if available, in which case buff mustn't
+    change between calls.
+    """
+    if numpy is None:
+        idx = buff.find('\xff', offset)
+        while idx >= 0:
+            fields = parse_header(buff[idx:idx + 4])
+            if fields[0]:
+                yield idx, fields
+            idx = buff.find('\xff', idx + 1)
+        return
+    arr = numpy.frombuffer(buff, dtype=numpy.uint8)
+    for start in xrange(offset - offset % BLOCKSIZE, len(arr), BLOCKSIZE):
+        positions, fields = _decoded_block(buff, arr, start)
+        for i in xrange(bisect_left(positions, offset), len(positions)):
+            if fields[i][0]:
+                yield positions[i], fields[i]
+
+
+def _decoded_block(buff, arr, start):
+    # the block of buff beginning at start, decoded by _decode_block()
+    global _decoded
+    last, blocks = _decoded
+    if last is not buff:
+        blocks = {}
+        _decoded = (buff, blocks)
+    if start not in blocks:
+        blocks[start] = _decode_block(arr, start,
+                                      min(start + BLOCKSIZE, len(arr)))
+    return blocks[start]
+
+def walk_frames(buff, offset=0, maxframes=-1, resync=False):
+    """
+    walks the frames in buff starting at offset, stopping at the first
+    position that doesn't hold a complete frame (or, if resync is
+    true, skipping ahead to the next one), or after maxframes frames.
+    Returns a tuple (nframes, end, frames), where end is the end of
+    the last complete frame and frames is a list of tuples (offset,
+    length, version, layer, bitrate, samplerate, mode).
+    """
+    if offset < 0 or offset > len(buff):
+        raise ValueError("offset out of range")
+    if numpy is None and not isinstance(buff, str):
+        # str() of an mmap or a memoryview is its repr, not its bytes
+        if isinstance(buff, memoryview):
+            buff = buff.tobytes()
+        else:
+            buff = buff[:]
+    size = len(buff)
+    frames = []
+    end = pos = offset
+    if numpy is None:
+        while pos < size and (maxframes < 0 or len(frames) < maxframes):
+            fields = parse_header(buff[pos:pos + 4])
+            length = fields[0]
+            if length <= 0 or length > size - pos:
+                if not resync:
+                    break
+                pos = buff.find('\xff', pos + 1)
+                if pos < 0:
+                    break
+                continue
+            frames.append((pos,) + fields)
+            pos += length
+            end = pos
+        return len(frames), end, frames
+
+    for cpos, fields in scan_headers(buff, offset):
+        if maxframes >= 0 and len(frames) >= maxframes:
+            break
+        if cpos < pos:
+            # inside the previous frame
+            continue
+        if cpos > pos and not resync:
+            break
+        length = fields[0]
+        if length > size - cpos:
+            if resync:
+                continue
+            break
+        frames.append((cpos,) + fields)
+        pos = end = cpos + length
+    return len(frames), end, frames
+
+
+if numpy is not None:
+    _np_bitrates = numpy.array(BITRATE_TABLE, dtype=numpy.int64)
+    _np_samplerates = numpy.array(SAMPLERATE_TABLE, dtype=numpy.int64)
+
+
+__all__ = ['get_frame', 'walk_frames', 'scan_headers', 'parse_header']
@@ -353,6 +353,77 @@ class FileRule(object):
         self._check()
         return self._rule(filename)
 
+
+def _is_timed(matcher):
+    # whether what matcher matches changes over time
+    if isinstance(matcher, CurrentTimeMatch):
+        return True
+    if isinstance(matcher, (And, Or)):
+        return any(_is_timed(m) for m in matcher.submatchers)
+    if isinstance(matcher, Not):
+        return _is_timed(matcher.matcher)
+    return False
+
+
+def _could_match(matcher, target):
+    # like matcher.match(target), but true if it matches target now or
+    # may at a later time
+    if isinstance(matcher, CurrentTimeMatch):
+        return datetime.datetime.now() <= matcher.end
+    if isinstance(matcher, And):
+        res = False
+        for m in matcher.submatchers:
+            res = _could_match(m, target)
+            if not res:
+                return False
+        return res
+    if isinstance(matcher, Or):
+        for m in matcher.submatchers:
+            res = _could_match(m, target)
+            if res:
+                return res
+        return False
+    if isinstance(matcher, Not):
+        return _is_timed(matcher.matcher) or not matcher.match(target)
+    return matcher.match(target)
+
+
+def _possible_symbols(rule, filename):
+    if isinstance(rule, FileRule):
+        rule._check()
+        rule = rule._rule
+    if isinstance(rule, RuleList):
+        if rule.cond and not _could_match(rule.cond, filename):
+            return
+        for r in rule.rules:
+            for x in _possible_symbols(r, filename):
+                yield x
+    elif isinstance(rule, MatchRule):
+        m = rule.matcher is None or _could_match(rule.matcher, filename)
+        if m:
+            for x in rule._gen_list(filename, m):
+                yield x
+    else:
+        for x in rule(filename) or ():
+            yield x
+
+
+def possible_extras(rule, filename):
+    """
+    returns the names of the extras that rule puts in the combined
+    file for filename, now or at any later time.  Unlike calling the
+    rule, this goes through every rule in a RuleList, not just the
+    first that matches, and counts a CurrentTimeMatch as matching
+    unless its time is past.  Rules other than RuleLists and
+    MatchRules are simply called.
+    """
+    res = []
+    for x in _possible_symbols(rule, filename):
+        if not isinstance(x, OriginalName) and x not in res:
+            res.append(x)
+    return res
+
+
 __all__ = [
     'RuleList',
     'DefaultRule',
@@ -370,4 +441,5 @@ __all__ = [
     'from_json',
     'to_json',
     'FileRule',
+    'possible_extras',
     ]
@@ -0,0 +1,93 @@
+"""
+
+An in-memory cache of the audio of frequently spliced files.
+
+Almost every combined file is made of one main file and a few of the
+same few dozen transcoded extras.  The segment cache keeps the audio
+of those extras -- everything between the ID3v2 and the ID3v1 tags --
+in memory, within a byte budget, so that splicing reads only the main
+file from disk.  Only files under the cache's roots (normally the
+extra/transcoded directory) are cached, and an entry is used only
+while the file's size and modification time are unchanged.
+
+Entries loaded before a forking server starts its children are shared
+by all of them copy-on-write.
+
+"""
+
+import os
+import sys
+
+from ewa.lru import LRUCache
+
+
+class SegmentCache(object):
+    """
+    a byte-budgeted LRU cache of (start, data) pairs, where data is
+    the audio of a file and start its offset in the file, keyed on
+    the file's path and validated by its size and mtime.  A maxbytes
+    of 0 disables the cache.
+    """
+
+    def __init__(self, maxbytes=0, roots=()):
+        self.roots = tuple([os.path.join(os.path.abspath(r), '')
+                            for r in roots])
+        self._cache = LRUCache(sys.maxint,
+                               maxweight=maxbytes,
+                               weigh=lambda v: len(v[3]))
+
+    maxbytes = property(lambda x: x._cache.maxweight)
+
+    def covers(self, path):
+        """
+        returns whether path is eligible for caching.
+        """
+        if not self.maxbytes:
+            return False
+        for root in self.roots:
+            if path.startswith(root):
+                return True
+        return False
+
+    def lookup(self, path, stats):
+        """
+        returns the cached (start, data) for path if it is current,
+        otherwise None.
+        """
+        entry = self._cache.get(path)
+        if entry is None:
+            return None
+        size, mtime, start, data = entry
+        if size != stats.st_size or mtime != stats.st_mtime:
+            self._cache.discard(path)
+            return None
+        return start, data
+
+    def store(self, path, stats, start, data):
+        self._cache.put(path, (stats.st_size, stats.st_mtime, start, data))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+_segment_cache = SegmentCache()
+
+
+def get_segment_cache():
+    return _segment_cache
+
+
+def initSegmentCache(maxbytes=0, roots=()):
+    """
+    sets up the process-wide segment cache, holding at most maxbytes
+    of audio from files under the directories in roots.
+    """
+    global _segment_cache
+    _segment_cache = SegmentCache(maxbytes, roots)
+    return _segment_cache
+
+
+__all__ = ['SegmentCache', 'get_segment_cache', 'initSegmentCache']
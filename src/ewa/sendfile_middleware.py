@@ -0,0 +1,71 @@
+"""
+
+A stand-in for the front-end web server's X-Sendfile support.
+
+SendfileMiddleware wraps ewa's WSGI application and does what lighttpd
+(or Apache's mod_xsendfile) would: when a response carries an
+X-Sendfile, X-LIGHTTPD-send-file or X-Sendfile2 header, the header is
+removed and the files or file ranges it names become the body.  It is
+meant for tests and for development servers that can't do this
+themselves.
+
+"""
+
+import os
+import urllib
+
+from ewa.mp3 import read_plan
+
+SENDFILE_HEADERS = ('x-sendfile', 'x-lighttpd-send-file')
+
+SENDFILE2_HEADER = 'x-sendfile2'
+
+
+def parse_sendfile2(value):
+    """
+    returns the file ranges named in an X-Sendfile2 header as a list
+    of (path, offset, length) tuples.
+    """
+    plan = []
+    for item in value.split(','):
+        path, byterange = item.strip().rsplit(' ', 1)
+        first, last = byterange.split('-')
+        plan.append((urllib.unquote(path),
+                     int(first),
+                     int(last) - int(first) + 1))
+    return plan
+
+
+class SendfileMiddleware(object):
+
+    def __init__(self, app, buffsize=2**16):
+        self.app = app
+        self.buffsize = buffsize
+
+    def __call__(self, environ, start_response):
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return lambda data: None
+        body = self.app(environ, capture)
+        status, headers = response
+        plan = None
+        kept = []
+        for name, value in headers:
+            if name.lower() in SENDFILE_HEADERS:
+                plan = [(value, 0, os.path.getsize(value))]
+            elif name.lower() == SENDFILE2_HEADER:
+                plan = parse_sendfile2(value)
+            else:
+                kept.append((name, value))
+        if plan is None:
+            start_response(status, headers)
+            return body
+        if hasattr(body, 'close'):
+            body.close()
+        start_response(status, kept)
+        return read_plan(plan, self.buffsize)
+
+
+__all__ = ['SendfileMiddleware', 'parse_sendfile2']
@@ -0,0 +1,165 @@
+"""
+
+Making sure that only one thread or process at a time generates a
+given file.
+
+When a new episode goes up, many requests for it arrive at once, and
+without coordination every server process (and every thread) that
+finds its combined file missing would make its own copy.
+single_flight() takes an exclusive flock() on a lock file next to the
+target before generating it; whoever gets the lock first generates
+the file, and the others wait for the lock and then use the file it
+made.  Since the lock is only taken once the file has been found
+to need generating, whether it still does is checked again, by a
+test the caller passes in, once the lock is held.
+
+flock() locks go away with the process that holds them, so a lock
+file left behind by a crash is simply reused.  A holder that hangs is
+waited for no longer than a timeout, after which the waiter generates
+the file itself (safely, since files are written under temporary
+names and renamed into place).  Where flock() isn't available, files
+are generated without coordination.
+
+"""
+
+import errno
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ewa.logutil import debug, warn
+
+# ends with '~' so that ewabatch --delete leaves it alone, as it does
+# temp files
+LOCK_SUFFIX = '.lock~'
+
+# how long to wait for another generator of the same file, in seconds
+LOCK_TIMEOUT = 60.0
+
+# how often to try for the lock while waiting
+POLL_INTERVAL = 0.05
+
+_lock = threading.Lock()
+_counts = dict(led=0, followed=0, timed_out=0)
+
+
+def _count(key):
+    _lock.acquire()
+    try:
+        _counts[key] += 1
+    finally:
+        _lock.release()
+
+
+def get_single_flight_stats():
+    """
+    returns a dictionary of counters: how many times a file was
+    generated under the lock ('led'), found already generated by
+    another holder of the lock ('followed'), and generated after
+    giving up waiting for the lock ('timed_out').
+    """
+    _lock.acquire()
+    try:
+        return _counts.copy()
+    finally:
+        _lock.release()
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _acquire(lockpath, timeout):
+    # returns an fd holding the lock, or None on timeout
+    deadline = time.time() + timeout
+    while 1:
+        fd = os.open(lockpath, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            while 1:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() >= deadline:
+                    os.close(fd)
+                    return None
+                time.sleep(POLL_INTERVAL)
+            # the holder we waited for may have removed the file; if
+            # so, our lock is on a file nobody else will open
+            try:
+                current = os.stat(lockpath).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(fd).st_ino:
+                return fd
+        except:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+def _release(lockpath, fd):
+    try:
+        os.unlink(lockpath)
+    except OSError:
+        pass
+    os.close(fd)
+
+
+def single_flight(target, create, timeout=LOCK_TIMEOUT, fresh=None):
+    """
+    calls create(), which generates the file at target and returns
+    its path, unless another thread or process is already generating
+    it, in which case this waits for that to finish and returns
+    target.  If the other generator takes longer than timeout seconds,
+    create() is called anyway.
+
+    Once the lock is held, fresh(), if given, is called to tell
+    whether target is current (as the caller found it wasn't before
+    calling this), and create() is called only if it isn't;
+    otherwise target is taken to be current if it has changed since
+    this was called.
+    """
+    if fcntl is None:
+        return create()
+    if fresh is None:
+        before = _mtime(target)
+        fresh = lambda: _mtime(target) != before
+    lockpath = target + LOCK_SUFFIX
+    parent = os.path.dirname(lockpath)
+    if not os.path.exists(parent):
+        try:
+            os.makedirs(parent)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    fd = _acquire(lockpath, timeout)
+    if fd is None:
+        _count('timed_out')
+        warn("gave up after %ss waiting for the lock on %s",
+             timeout, target)
+        return create()
+    try:
+        if fresh():
+            _count('followed')
+            debug("%s was generated by another holder of the lock",
+                  target)
+            return target
+        _count('led')
+        return create()
+    finally:
+        _release(lockpath, fd)
+
+
+__all__ = ['get_single_flight_stats', 'single_flight', 'LOCK_SUFFIX',
+           'LOCK_TIMEOUT']
@@ -0,0 +1,194 @@
+"""
+
+A persistent index of the layout of the mp3 files ewa splices.
+
+For every file the splicer touches, ewa needs to know where the audio
+starts (after any ID3v2 tag), where it ends (before any ID3v1 tag and
+any trailing fragmentary frame), and what the ID3v1 tag is.  Working
+that out means parsing tags and scanning backwards for a sync frame,
+which is wasteful when the same intros and outros are spliced over and
+over.  The index records that information, keyed on the file's path,
+size and modification time, both in memory and (optionally) in a
+directory on disk, so that it survives restarts and is shared by all
+the processes of a server or batch run.
+
+"""
+
+import marshal
+import os
+import sys
+import thread
+from hashlib import md5
+
+from ewa.logutil import debug, warn
+
+# bump this whenever the format of index entries changes;
+# entries with a different version are ignored.
+INDEX_VERSION = 2
+
+# maximum number of entries kept in memory before the
+# in-memory memo is flushed.
+MAX_MEMO = 10000
+
+
+class SegmentInfo(object):
+    """
+    the layout of a single mp3 file:
+
+      * audio_start: the offset at which the audio begins; the bytes
+        before it are the ID3v2 tag, if any.
+      * audio_end: the offset at which the audio ends.
+      * id3v1: the ID3v1 tag, or '' if there is none.
+
+    Once the frames of the audio have been walked (see has_frames), it
+    also has:
+
+      * nframes: the number of audio frames.
+      * header: the header of the first frame.
+      * info_frame: the length of the first frame if it is a Xing,
+        Info or VBRI frame, which is not counted in nframes, else 0.
+      * vbr: whether the bitrate varies.
+      * seekpoints: the offsets of every SEEK_INTERVAL-th audio frame
+        (see ewa.mp3), starting with the first.
+    """
+
+    def __init__(self, path, size, mtime, data):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.__dict__.update(data)
+
+    id3v2_range = property(lambda x: (0, x.audio_start))
+
+    audio_length = property(lambda x: x.audio_end - x.audio_start)
+
+    has_frames = property(lambda x: 'nframes' in x.__dict__)
+
+    def audio_range(self, strip_info_frame=False):
+        """
+        returns the (start, end) offsets of the audio, leaving out
+        any Xing, Info or VBRI frame if strip_info_frame is true.
+        """
+        if strip_info_frame:
+            return self.audio_start + self.info_frame, self.audio_end
+        return self.audio_start, self.audio_end
+
+    def todict(self):
+        d = self.__dict__.copy()
+        for k in ('path', 'size', 'mtime'):
+            del d[k]
+        return d
+
+
+class SpliceIndex(object):
+    """
+    an index of SegmentInfo objects, keyed on (path, size, mtime).
+    If indexdir is None, the index is kept in memory only.
+    """
+
+    def __init__(self, indexdir=None):
+        if indexdir is not None:
+            indexdir = os.path.abspath(indexdir)
+        self.indexdir = indexdir
+        self._memo = {}
+
+    def _entry_path(self, path):
+        if isinstance(path, unicode):
+            # hashed as the bytes of the name on disk, where the
+            # filesystem encoding can represent it
+            try:
+                path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+            except UnicodeError:
+                path = path.encode('utf-8')
+        digest = md5(path).hexdigest()
+        return os.path.join(self.indexdir, digest[:2], digest)
+
+    def lookup(self, path, stats=None):
+        """
+        returns the SegmentInfo for path if the index has a current
+        entry for it, otherwise None.
+        """
+        if stats is None:
+            stats = os.stat(path)
+        size, mtime = stats.st_size, stats.st_mtime
+        info = self._memo.get(path)
+        if info is not None and info.size == size and info.mtime == mtime:
+            return info
+        if self.indexdir is None:
+            return None
+        try:
+            fp = open(self._entry_path(path), 'rb')
+            try:
+                entry = marshal.load(fp)
+            finally:
+                fp.close()
+            # a truncated or corrupt entry is a miss
+            version, epath, esize, emtime, data = entry
+            if (version != INDEX_VERSION or epath != path
+                or esize != size or emtime != mtime):
+                return None
+            info = SegmentInfo(path, size, mtime, data)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        self._remember(info)
+        return info
+
+    def store(self, info):
+        """
+        adds info to the index, replacing any existing entry for
+        the same path.
+        """
+        self._remember(info)
+        if self.indexdir is None:
+            return
+        target = self._entry_path(info.path)
+        renamed = '%s%d~%d~' % (target,
+                                os.getpid(),
+                                thread.get_ident())
+        entry = (INDEX_VERSION, info.path, info.size, info.mtime,
+                 info.todict())
+        try:
+            parent = os.path.dirname(target)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            fp = open(renamed, 'wb')
+            try:
+                marshal.dump(entry, fp)
+            finally:
+                fp.close()
+            os.rename(renamed, target)
+        except (IOError, OSError), e:
+            # the index is only a cache; carry on without it
+            warn("could not write splice index entry for %s: %s",
+                 info.path, e)
+        else:
+            debug("stored splice index entry for %s", info.path)
+
+    def _remember(self, info):
+        if len(self._memo) >= MAX_MEMO:
+            self._memo.clear()
+        self._memo[info.path] = info
+
+    def clear(self):
+        self._memo.clear()
+
+
+_index = SpliceIndex()
+
+
+def get_splice_index():
+    return _index
+
+
+def initSpliceIndex(indexdir=None):
+    """
+    sets up the process-wide splice index.  If indexdir is None,
+    the index is kept in memory only.
+    """
+    global _index
+    _index = SpliceIndex(indexdir)
+    return _index
+
+
+__all__ = ['SegmentInfo', 'SpliceIndex', 'get_splice_index',
+           'initSpliceIndex']
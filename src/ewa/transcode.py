@@ -1,12 +1,80 @@
+import errno
 import os
 import subprocess
+import thread
+import threading
+
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    ThreadPool = None
 
 from ewa.logutil import debug, warn, exception
 from ewa.mp3 import get_vbr_bitrate_samplerate_mode
 from ewa.config import Config
+from ewa.singleflight import single_flight, LOCK_TIMEOUT
 
 class TranscodeError(RuntimeError): pass
 
+# how many transcodes each process runs at once, at what priority,
+# and how long to wait for another process's; see initTranscoder()
+_settings = dict(jobs=2, nice=0, ionice=None, lock_timeout=LOCK_TIMEOUT)
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+def initTranscoder(jobs=2, nice=0, ionice=None, lock_timeout=LOCK_TIMEOUT):
+    """
+    sets how many transcodes for one playlist may run at once in each
+    process, the niceness LAME runs at, its I/O scheduling class (as
+    for ionice -c: 1 realtime, 2 best-effort, 3 idle), or None to
+    leave it alone, and how many seconds to wait for another thread
+    or process transcoding the same file (see ewa.singleflight).
+    """
+    global _pool
+    _lock.acquire()
+    try:
+        _settings.update(jobs=jobs, nice=nice, ionice=ionice,
+                         lock_timeout=lock_timeout)
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = None
+    finally:
+        _lock.release()
+
+def _get_pool():
+    # threads don't survive a fork, so each process makes its own
+    global _pool, _pool_pid
+    _lock.acquire()
+    try:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(_settings['jobs'])
+            _pool_pid = os.getpid()
+        return _pool
+    finally:
+        _lock.release()
+
+def transcode_map(func, items):
+    """
+    returns [func(x) for x in items], calling func for several items
+    at once in the transcode worker pool.  func is expected to do
+    little but wait for transcodes, and items to be only those that
+    actually need transcoding, since each waits for a worker.
+    """
+    items = list(items)
+    if ThreadPool is None or _settings['jobs'] < 2 or len(items) < 2:
+        return map(func, items)
+    return _get_pool().map(func, items)
+
+def _priority_args():
+    args = []
+    if _settings['ionice'] is not None:
+        args += ['ionice', '-c', str(_settings['ionice'])]
+    if _settings['nice']:
+        args += ['nice', '-n', str(_settings['nice'])]
+    return args
+
 def lameTranscode(newBitRate, 
                   newSampleRate, 
                   newMode, 
@@ -34,20 +102,31 @@ def lameTranscode(newBitRate,
     
     if quiet:
         args.insert(1, "--quiet")
+    args = _priority_args() + args
 
     debug("lame transcode called with args: %s", args)
 
-    res = subprocess.call(args)
+    res = subprocess.call(args, close_fds=True)
     if res != 0:
         raise TranscodeError("LAME transcoder exploded, return code %d" % res)
 
+def is_current(masterPath, newPath):
+    """
+    returns whether newPath exists and is no older than masterPath,
+    i.e. needn't be transcoded again.
+    """
+    try:
+        return os.path.getmtime(masterPath) <= os.path.getmtime(newPath)
+    except OSError:
+        return False
+
 def transcode(masterPath, 
               newPath, 
               newBitRate,
               newSampleRate, 
               newMode, 
               allow_master=False,
-              transcodeFunc=lameTranscode,
+              transcodeFunc=None,
               **transcodeKwargs):
     """
     transcodes master file at masterPath to specified bitrate,
@@ -55,7 +134,15 @@ def transcode(masterPath,
     LAME, to perform the transcoding.  Returns either masterPath or
     newPath, depending on if the master path or new path should be
     used after possible transcoding.
+
+    The transcode is written under a temporary name and renamed to
+    newPath when complete, and only one thread or process at a time
+    transcodes to the same newPath (see ewa.singleflight); the others
+    wait for it and use its result unless it is older than
+    masterPath (see is_current()).
     """
+    if transcodeFunc is None:
+        transcodeFunc = lameTranscode
     # is this an mp3?
     if masterPath.endswith('.mp3') or masterPath.endswith('.MP3'):
         vbr, bitrate, samplerate, mode = get_vbr_bitrate_samplerate_mode(masterPath)
@@ -68,17 +155,35 @@ def transcode(masterPath,
         
     dirNewPath = os.path.dirname(newPath)
     if not os.path.exists(dirNewPath):
-        os.makedirs(dirNewPath)
+        try:
+            os.makedirs(dirNewPath)
+        except OSError, e:
+            # made at the same time for another extra
+            if e.errno != errno.EEXIST:
+                raise
 
-    debug('transcoding %s to %s', masterPath, newPath)
-    
-    transcodeFunc(newBitRate,
-                  newSampleRate,
-                  newMode,
-                  masterPath,
-                  newPath,
-                  **transcodeKwargs)
-    return newPath
+    def create():
+        debug('transcoding %s to %s', masterPath, newPath)
+        renamed = '%s%d~%d~' % (newPath,
+                                os.getpid(),
+                                thread.get_ident())
+        try:
+            transcodeFunc(newBitRate,
+                          newSampleRate,
+                          newMode,
+                          masterPath,
+                          renamed,
+                          **transcodeKwargs)
+            os.rename(renamed, newPath)
+        except:
+            if os.path.exists(renamed):
+                os.unlink(renamed)
+            raise
+        return newPath
+
+    return single_flight(newPath, create, _settings['lock_timeout'],
+                         lambda: is_current(masterPath, newPath))
 
 
-__all__ = ['transcode',  'lameTranscode']
+__all__ = ['initTranscoder', 'is_current', 'transcode', 'transcode_map',
+           'lameTranscode']
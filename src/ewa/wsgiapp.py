@@ -8,20 +8,33 @@ according to a ruleset.
 import mimetypes
 import os
 import time
-
-import eyed3
+import urllib
+import urlparse
 
 import ewa.audio
-from ewa.logutil import debug, info, error, exception
+import ewa.buffutil
+import ewa.hls
+import ewa.manifest
+import ewa.mp3
+import ewa.singleflight
+from ewa.logutil import debug, info, error, exception, warn
 
 _codes = {200:'200 OK',
+          206:'206 Partial Content',
           404:'404 Not Found',
+          416:'416 Requested Range Not Satisfiable',
           500:'500 Internal Server Error'}
 
 GENERIC_SENDFILE_HEADER = 'X-Sendfile'
 
 LIGHTTPD_SENDFILE_HEADER = 'X-LIGHTTPD-send-file'
 
+# lighttpd's header for serving a list of ranges of files
+SENDFILE2_HEADER = 'X-Sendfile2'
+
+# where the app serves the files HLS playlists refer to
+HLS_MEDIA_PATH = '/_media'
+
 MP3_MIMETYPE = 'audio/mpeg'
 
 mimetypes.init()
@@ -34,6 +47,86 @@ def guess_mime(filename):
     return mtype
 
 
+def format_sendfile2(plan):
+    """
+    returns the value of an X-Sendfile2 header for a plan made up
+    only of file ranges: comma-separated url-quoted paths, each
+    followed by an inclusive byte range.
+    """
+    return ', '.join(['%s %d-%d' % (urllib.quote(path),
+                                    offset,
+                                    offset + length - 1)
+                      for path, offset, length in plan if length])
+
+
+def get_start_time(environ):
+    """
+    returns the play time, in seconds, given by the start parameter
+    of the query string, or None if there isn't a valid one.
+    """
+    query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    try:
+        start = float(query['start'][0])
+    except (KeyError, ValueError):
+        return None
+    if start <= 0 or start != start or start == float('inf'):
+        return None
+    return start
+
+
+def as_strings(iterable):
+    """
+    yields the chunks of iterable as strings, as a WSGI response body
+    must be made of; views of mapped files (see ewa.mp3._mmap_splicer)
+    are copied here, at the last moment.
+    """
+    for chunk in iterable:
+        if type(chunk) is not str:
+            chunk = str(chunk)
+        yield chunk
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_range(header, length):
+    """
+    parses the value of a Range header for an entity of length bytes.
+    Returns a tuple (start, end), with end exclusive, or None if the
+    header is absent or should be ignored (it is malformed or asks
+    for several ranges); raises RangeNotSatisfiable if the range lies
+    outside the entity.
+    """
+    if not header:
+        return None
+    units, sep, spec = header.strip().partition('=')
+    if units.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            if last:
+                end = int(last) + 1
+                if end <= start:
+                    return None
+            else:
+                end = length
+        elif last:
+            start = max(0, length - int(last))
+            end = length
+        else:
+            return None
+    except ValueError:
+        return None
+    if start >= length or start < 0:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, length)
+
+
 class EwaApp(object):
 
     def __init__(self,
@@ -45,16 +138,47 @@ class EwaApp(object):
                  use_xsendfile=True,
                  sendfile_header=GENERIC_SENDFILE_HEADER,
                  content_disposition='',
+                 manifests=False,
+                 literaldir=None,
+                 write_size=2**16,
+                 duration_headers=False,
+                 hls=False,
+                 hls_media_url=None,
+                 hls_target_duration=ewa.hls.TARGET_DURATION,
+                 lock_timeout=ewa.singleflight.LOCK_TIMEOUT,
                  **spliceKwargs):
         self.rule = rule
         self.stream = stream
         if stream and targetdir:
             raise ValueError("in streaming mode but targetdir supplied")
+        if stream and manifests:
+            raise ValueError("in streaming mode but manifests requested")
         self.spliceKwargs = spliceKwargs
+        # in streaming mode with a range splicer, the output is
+        # planned first, so its length is known and ranges of it
+        # can be served
+        self.stream_plans = stream and spliceKwargs.get(
+            'splicer', ewa.mp3._default_splicer) in ewa.mp3.RANGE_SPLICERS
         self.refresh_rate = refresh_rate
         self.use_xsendfile = use_xsendfile
         self.sendfile_header = sendfile_header
         self.content_disposition = content_disposition
+        # where bytes that aren't in any file (the tags in a
+        # manifest, a Xing frame) are written so that an
+        # X-Sendfile2 header can name them
+        self.literaldir = literaldir
+        # streamed output is passed to the server in chunks of at
+        # least this size where possible, rather than one chunk per
+        # tag or file (see as_strings() for views of mapped files)
+        self.write_size = write_size
+        self.duration_headers = duration_headers
+        # if hls is true, <file>.m3u8 is an HLS playlist for <file>
+        # whose segments are byte ranges of the original files; they
+        # are fetched from hls_media_url, by default served by the
+        # app itself under HLS_MEDIA_PATH
+        self.hls = hls
+        self.hls_media_url = hls_media_url or HLS_MEDIA_PATH
+        self.hls_target_duration = hls_target_duration
         if self.stream:
             self.provider = ewa.audio.StreamAudioProvider(basedir,
                                                           tolerate_vbr=False,
@@ -63,7 +187,10 @@ class EwaApp(object):
             self.provider = ewa.audio.FSAudioProvider(basedir,
                                                       False,
                                                       False,
-                                                      targetdir)
+                                                      targetdir,
+                                                      manifests,
+                                                      lock_timeout,
+                                                      duration_headers)
 
     basedir = property(lambda x: x.provider.basedir)
 
@@ -80,6 +207,9 @@ class EwaApp(object):
             return iterable
 
     def _create_combined(self, mp3file):
+        # returns the output for mp3file, its mime type, and the
+        # files whose audio it is made of if its timing can't be
+        # found from the output itself (see _timing_headers())
         # strip leading '/'
         if mp3file.startswith('/'):
             mp3file = mp3file[1:]
@@ -93,60 +223,105 @@ class EwaApp(object):
 ##                 # check should be moved to __call__
 ##                 pass
             raise OSError
-        if self.stream:
+        if self.stream_plans:
             try:
+                return self.provider.get_combined_plan(
+                    mp3file,
+                    self.rule,
+                    self.spliceKwargs.get('xing', False)), MP3_MIMETYPE, None
+            except (ewa.audio.AudioProviderException,
+                    ewa.mp3.Mp3Error):
+                info("%s cannot be processed.  Serving statically", mainpath)
+                return ([(mainpath, 0, os.path.getsize(mainpath))],
+                        guess_mime(mainpath),
+                        [mainpath])
+        elif self.stream:
+            try:
+                playlist = self.provider.get_playlist(mp3file, self.rule)
                 return self.provider.create_combined(
                     mp3file,
                     self.rule,
-                    **self.spliceKwargs), MP3_MIMETYPE
+                    playlist,
+                    **self.spliceKwargs), MP3_MIMETYPE, playlist
             except (ewa.audio.AudioProviderException,
-                    eyed3.mp3.Mp3Exception):
+                    ewa.mp3.Mp3Error):
                 info("%s cannot be processed.  Serving statically", mainpath)
-                return open(mainpath), guess_mime(mainpath)
+                return open(mainpath), guess_mime(mainpath), [mainpath]
         else:
             path = self.provider.get_combined_path(mp3file)
-            try:
-                mtime = os.path.getmtime(path)
-            except OSError:
-                debug("OSError in getting mod time (ok)")
-                pass
-            else:
-                # if the main file modified?
-                regen = maintime > mtime
-                if not regen:
-                    if self.refresh_rate == 0:
-                        debug("no refresh, returning target path")
-                        return path, MP3_MIMETYPE
-                    else:
-                        t = time.time()
-                        if t-mtime < self.refresh_rate:
-                            debug("not necessary to refresh, "
-                                  "returning target path")
-                            return path, MP3_MIMETYPE
+            result = self._current_combined(mp3file, maintime, path)
+            if result is not None:
+                return result, MP3_MIMETYPE, None
 
             # if we get here we regenerate
             debug("need to regenerate combined file")
             try:
+                # another thread or process may have made it by the
+                # time we have the lock
                 path2 = self.provider.create_combined(
                     mp3file,
                     self.rule,
+                    fresh=lambda: self._current_combined(
+                        mp3file, maintime, path) is not None,
                     **self.spliceKwargs)
             except (ewa.audio.AudioProviderException,
-                    eyed3.mp3.Mp3Exception):
+                    ewa.mp3.Mp3Error):
                 info("%s cannot be processed.  Serving statically", mainpath)
-                return mainpath, guess_mime(mainpath)
+                return mainpath, guess_mime(mainpath), [mainpath]
             # should be the same
             debug("path returned from provider: %s", path2)
             debug("our calculated path: %s", path)
-            return path2, MP3_MIMETYPE
+            if self.provider.manifests:
+                plan = ewa.manifest.read_manifest(path2)
+                if plan is None:
+                    raise ValueError("fresh manifest is stale: %s" % path2)
+                return plan, MP3_MIMETYPE, None
+            return path2, MP3_MIMETYPE, None
+
+    def _current_combined(self, mp3file, maintime, path):
+        # returns the combined file at path (or the plan in its
+        # manifest) if it needn't be regenerated, otherwise None
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            debug("OSError in getting mod time (ok)")
+            return None
+        # if the main file modified?
+        if maintime > mtime:
+            return None
+        result = path
+        if self.provider.manifests:
+            # if anything it refers to has changed,
+            # the manifest is stale
+            result = ewa.manifest.read_manifest(path)
+            if result is None:
+                return None
+        if (self.duration_headers and
+            self.provider.read_sidecar(mp3file) is None):
+            # made before duration headers were turned on
+            return None
+        if self.refresh_rate == 0:
+            debug("no refresh, returning target path")
+            return result
+        if time.time()-mtime < self.refresh_rate:
+            debug("not necessary to refresh, returning target path")
+            return result
+        return None
 
     def __call__(self, environ, start_response):
         mp3file = environ['SCRIPT_NAME']+environ['PATH_INFO']
         info("mp3file: %s", mp3file)
         if not mp3file:
             return self.send(start_response, 404)
+        if self.hls and mp3file.startswith(HLS_MEDIA_PATH + '/'):
+            return self.send_media(mp3file[len(HLS_MEDIA_PATH) + 1:],
+                                   environ,
+                                   start_response)
+        if self.hls and mp3file.endswith(ewa.hls.M3U8_SUFFIX):
+            return self.send_hls_playlist(mp3file[:-len(ewa.hls.M3U8_SUFFIX)],
+                                          start_response)
         try:
-            result, mtype = self._create_combined(mp3file)
+            result, mtype, playlist = self._create_combined(mp3file)
         except (OSError, IOError):
             exception("Error in looking for file %s", mp3file)
             return self.send(start_response, 404)
@@ -155,12 +330,183 @@ class EwaApp(object):
             exception("internal server error")
             return self.send(start_response, 500)
         else:
-            return self.sendfile(result, start_response, mtype)
+            extra = []
+            if self.duration_headers and mtype == MP3_MIMETYPE:
+                extra = self._timing_headers(mp3file, result, playlist)
+            start = get_start_time(environ)
+            if (start and mtype == MP3_MIMETYPE
+                and isinstance(result, (list, str))):
+                try:
+                    if isinstance(result, str):
+                        # the file served, as a plan
+                        plan = ewa.mp3.splice_plan([result], result)
+                    else:
+                        plan = result
+                    plan, start = ewa.mp3.seek_plan(plan, start)
+                except (ewa.mp3.Mp3Error, OSError, IOError), e:
+                    warn("could not seek in %s: %s", mp3file, e)
+                else:
+                    result = plan
+                    extra.append(('X-Start-Time', '%.3f' % start))
+            if (isinstance(result, str) and self.use_xsendfile
+                and self.sendfile_header == SENDFILE2_HEADER):
+                result = [(result, 0, os.path.getsize(result))]
+            if isinstance(result, list):
+                return self.send_plan(result,
+                                      environ,
+                                      start_response,
+                                      mtype,
+                                      extra)
+            return self.sendfile(result, start_response, mtype, extra)
 
-    def sendfile(self, result, start_response, mtype):
+    def send_hls_playlist(self, mp3file, start_response):
+        if mp3file.startswith('/'):
+            mp3file = mp3file[1:]
+        mainpath = self.provider.get_main_path(mp3file)
+        if not os.path.isfile(mainpath):
+            return self.send(start_response, 404)
+        try:
+            files = self.provider.get_playlist(mp3file, self.rule)
+        except (ewa.audio.AudioProviderException,
+                ewa.mp3.Mp3Error):
+            info("%s cannot be processed.  Serving it alone", mainpath)
+            files = [mainpath]
+        url_for = lambda path: ewa.hls.media_url(
+            self.hls_media_url, os.path.relpath(path, self.basedir))
+        try:
+            playlist = ewa.hls.make_playlist(files,
+                                             url_for,
+                                             self.hls_target_duration)
+        except (OSError, IOError):
+            exception("Error in reading files for %s", mp3file)
+            return self.send(start_response, 404)
+        return self.send(start_response,
+                         200,
+                         [('Content-Type', ewa.hls.M3U8_MIMETYPE),
+                          ('Content-Length', '%d' % len(playlist))],
+                         [playlist])
+
+    def send_media(self, relpath, environ, start_response):
+        """
+        serves one of the main or transcoded extra files, as
+        referred to by HLS playlists.
+        """
+        path = os.path.normpath(os.path.join(self.basedir, relpath))
+        roots = [os.path.join(self.basedir, d, '')
+                 for d in ('main', os.path.join('extra', 'transcoded'))]
+        if (not [r for r in roots if path.startswith(r)]
+            or not os.path.isfile(path)):
+            return self.send(start_response, 404)
+        if self.use_xsendfile and self.sendfile_header != SENDFILE2_HEADER:
+            return self.sendfile(path, start_response, MP3_MIMETYPE)
+        return self.send_plan([(path, 0, os.path.getsize(path))],
+                              environ,
+                              start_response,
+                              MP3_MIMETYPE)
+
+    def _headers(self, mtype, extra=()):
         headers = [('Content-Type', mtype)]
         if mtype == MP3_MIMETYPE and self.content_disposition:
             headers.append(('Content-Disposition', self.content_disposition))
+        headers.extend(extra)
+        return headers
+
+    def _timing_headers(self, mp3file, result, playlist):
+        # the timing of the output being sent: from playlist if
+        # given, else from the plan, else from the sidecar written
+        # with the combined file
+        try:
+            if playlist is not None:
+                duration, offsets = ewa.mp3.splice_timing(playlist)
+            elif isinstance(result, list):
+                duration, offsets = ewa.mp3.plan_timing(result)
+            else:
+                sidecar = self.provider.read_sidecar(mp3file)
+                if sidecar is None:
+                    warn("no current timing for %s", mp3file)
+                    return []
+                duration = sidecar['duration']
+                offsets = [s['start'] for s in sidecar['segments']]
+        except (ewa.mp3.Mp3Error, OSError, IOError, ValueError), e:
+            warn("could not time %s: %s", mp3file, e)
+            return []
+        return [('X-Content-Duration', '%.3f' % duration),
+                ('X-Segment-Offsets', ','.join(['%.3f' % start
+                                                for start in offsets]))]
+
+    def send_plan(self, plan, environ, start_response, mtype, extra=()):
+        """
+        streams the output described by a splice plan, or the
+        byte range of it asked for by a Range header.
+        """
+        headers = self._headers(mtype, extra)
+        headers.append(('Accept-Ranges', 'bytes'))
+        length = ewa.mp3.plan_length(plan)
+        start, end, status = 0, length, 200
+        try:
+            byterange = parse_range(environ.get('HTTP_RANGE'), length)
+        except RangeNotSatisfiable:
+            return self.send(start_response,
+                             416,
+                             [('Content-Type', 'text/plain'),
+                              ('Content-Range', 'bytes */%d' % length)])
+        if byterange:
+            start, end = byterange
+            status = 206
+            headers.append(('Content-Range',
+                            'bytes %d-%d/%d' % (start, end - 1, length)))
+        headers.append(('Content-Length', '%d' % (end - start)))
+        if self.use_xsendfile and self.sendfile_header == SENDFILE2_HEADER:
+            # spilled whole and then sliced, so that every range
+            # asked for is made of the same literal files
+            ranges = self._sendfile2_plan(plan)
+            if ranges:
+                ranges = ewa.mp3.slice_plan(ranges, start, end)
+                headers.append((SENDFILE2_HEADER, format_sendfile2(ranges)))
+                debug('headers are: %s', headers)
+                return self.send(start_response, status, headers, [''])
+        debug('headers are: %s', headers)
+        return self.send(start_response,
+                         status,
+                         headers,
+                         self._coalesce(as_strings(
+                             ewa.mp3.read_plan(plan,
+                                               self.spliceKwargs.get(
+                                                   'buffsize', 2**20),
+                                               start,
+                                               end,
+                                               self.spliceKwargs.get(
+                                                   'splicer',
+                                                   ewa.mp3._default_splicer)))))
+
+    def _coalesce(self, iterable):
+        if not self.write_size:
+            return iterable
+        return ewa.buffutil.coalesce_chunks(iterable, self.write_size)
+
+    def _rechunk(self, iterable):
+        # output that is copied anyway (from the engines that don't
+        # plan) is cut into chunks of exactly write_size
+        if not self.write_size:
+            return iterable
+        return ewa.buffutil.buff_chunk_iterator(iterable, self.write_size)
+
+    def _sendfile2_plan(self, plan):
+        # returns plan as file ranges only, or None if that
+        # can't be done and the bytes have to be sent by us
+        if not [p for p in plan if isinstance(p, str)]:
+            return plan
+        if self.literaldir is None:
+            return None
+        try:
+            return ewa.manifest.spill_literals(plan, self.literaldir)
+        except (IOError, OSError), e:
+            warn("could not write literal bytes to %s: %s",
+                 self.literaldir, e)
+            return None
+
+    def sendfile(self, result, start_response, mtype, extra=()):
+        headers = self._headers(mtype, extra)
         if self.use_xsendfile:
             length = os.path.getsize(result)
             headers.extend([(self.sendfile_header, result),
@@ -173,6 +519,8 @@ class EwaApp(object):
         else:
             if not self.stream:
                 result = open(result, 'rb')
+            elif not isinstance(result, file):
+                result = self._rechunk(as_strings(result))
             return self.send(start_response,
                              200,
                              headers,
@@ -0,0 +1,101 @@
+"""
+
+Building the Xing or Info frame that tells players how long a spliced
+stream is and where to seek in it.
+
+An Info frame (or, for a stream whose bitrate varies, a Xing frame) is
+a silent layer III frame at the start of the audio whose payload gives
+the number of frames, the number of bytes, and a table of contents
+mapping percentages of the play time to byte positions.  A spliced
+file would otherwise carry whatever such frame its first segment had,
+describing only that segment, or none at all.
+
+"""
+
+from struct import pack
+
+from ewa.pyframeinfo import parse_header, LAYER_III, VERSION_1
+
+FRAMES_FLAG = 1
+BYTES_FLAG = 2
+TOC_FLAG = 4
+
+# the tag, the flags, the frame count, the byte count and the TOC
+XING_SIZE = 4 + 4 + 4 + 4 + 100
+
+
+def xing_offset(version, mode):
+    """
+    returns the offset within a layer III frame of the given version
+    and mode at which a Xing header starts: just after the side
+    information.
+    """
+    if version == VERSION_1:
+        side = (mode == 3) and 17 or 32
+    else:
+        side = (mode == 3) and 9 or 17
+    return 4 + side
+
+
+def make_toc(segments, offset, total_bytes):
+    """
+    returns the 100 entries of a Xing table of contents for audio made
+    up of segments, a list of (nframes, nbytes) tuples, preceded by
+    offset bytes.  Frames are assumed to be of equal size within a
+    segment.
+    """
+    total_frames = sum([s[0] for s in segments])
+    toc = []
+    for i in xrange(100):
+        target = total_frames * i / 100.0
+        pos = offset
+        done = 0
+        for nframes, nbytes in segments:
+            if nframes and target < done + nframes:
+                pos += nbytes * (target - done) / nframes
+                break
+            done += nframes
+            pos += nbytes
+        toc.append(min(255, int(256.0 * pos / total_bytes)))
+    return toc
+
+
+def make_info_frame(header, segments, vbr=False):
+    """
+    returns a Xing frame (if vbr is true) or an Info frame describing
+    the audio made up of segments, a list of (nframes, nbytes) tuples,
+    with the format given by header, the header of its first frame.
+    The frame's bitrate is raised if the original is too small to hold
+    the header.  Returns '' if header isn't a layer III header.
+    """
+    length, version, layer, bitrate, samplerate, mode = parse_header(header)
+    if not length or layer != LAYER_III:
+        return ''
+    offset = xing_offset(version, mode)
+    # no CRC, no padding
+    b1 = ord(header[1]) | 1
+    b2 = ord(header[2]) & 0xfd
+    bitrate_index = b2 >> 4
+    for idx in [bitrate_index] + range(bitrate_index + 1, 15):
+        hdr = '\xff%s%s%s' % (chr(b1), chr((b2 & 0x0f) | (idx << 4)),
+                              header[3])
+        frlen = parse_header(hdr)[0]
+        if frlen >= offset + XING_SIZE:
+            break
+    else:
+        return ''
+    nframes = sum([s[0] for s in segments])
+    nbytes = frlen + sum([s[1] for s in segments])
+    toc = make_toc(segments, frlen, nbytes)
+    frame = ''.join([hdr,
+                     '\x00' * (offset - 4),
+                     vbr and 'Xing' or 'Info',
+                     pack('>III',
+                          FRAMES_FLAG | BYTES_FLAG | TOC_FLAG,
+                          nframes,
+                          nbytes),
+                     ''.join([chr(t) for t in toc])])
+    return frame.ljust(frlen, '\x00')
+
+
+__all__ = ['make_info_frame', 'make_toc', 'xing_offset']
@@ -0,0 +1,158 @@
+"""
+
+Kernel-side copying of byte ranges between file descriptors.
+
+copy_range() copies a range of one file to the current position of
+another file descriptor without bringing the bytes into Python, using
+copy_file_range(2) for file-to-file copies and sendfile(2) otherwise.
+The system calls are taken from the os module when it has them and
+from libc through ctypes when it doesn't; if neither works for a
+particular pair of descriptors, a plain read/write loop is used.
+
+"""
+
+import errno
+import os
+
+from ewa.logutil import debug
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# largest count passed to a single system call
+MAXCOUNT = 2**30
+
+# errors that mean "this method doesn't work for these descriptors"
+_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EXDEV,
+                errno.EBADF, errno.ESPIPE, errno.EOPNOTSUPP)
+
+
+def _load_libc():
+    if ctypes is None:
+        return None
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    try:
+        return ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+
+def _libc_func(name, argtypes):
+    if _libc is None:
+        return None
+    func = getattr(_libc, name, None)
+    if func is not None:
+        func.argtypes = argtypes
+        func.restype = ctypes.c_ssize_t
+    return func
+
+if ctypes is not None:
+    _c_copy_file_range = _libc_func('copy_file_range',
+                                    [ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_int64),
+                                     ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_int64),
+                                     ctypes.c_size_t,
+                                     ctypes.c_uint])
+    _c_sendfile = _libc_func('sendfile64',
+                             [ctypes.c_int,
+                              ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64),
+                              ctypes.c_size_t])
+else:
+    _c_copy_file_range = _c_sendfile = None
+
+
+def _call_libc(func, *args):
+    res = func(*args)
+    if res < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return res
+
+
+def _copy_file_range(infd, outfd, offset, count):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(infd, outfd, count, offset)
+    if _c_copy_file_range is None:
+        raise OSError(errno.ENOSYS, 'copy_file_range not available')
+    off = ctypes.c_int64(offset)
+    return _call_libc(_c_copy_file_range, infd, ctypes.byref(off),
+                      outfd, None, count, 0)
+
+
+def _sendfile(infd, outfd, offset, count):
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(outfd, infd, offset, count)
+    if _c_sendfile is None:
+        raise OSError(errno.ENOSYS, 'sendfile not available')
+    off = ctypes.c_int64(offset)
+    return _call_libc(_c_sendfile, outfd, infd, ctypes.byref(off), count)
+
+
+def _readwrite(infd, outfd, offset, count):
+    os.lseek(infd, offset, 0)
+    data = os.read(infd, min(count, 2**20))
+    if not data:
+        return 0
+    written = 0
+    while written < len(data):
+        written += os.write(outfd, data[written:])
+    return written
+
+
+_methods = [_copy_file_range, _sendfile, _readwrite]
+
+
+def copy_range(infd, outfd, offset, count):
+    """
+    copies count bytes starting at offset in infd to outfd, which is
+    written at its current position.  Returns the number of bytes
+    copied, which is less than count only if infd is too short.
+    """
+    copied = 0
+    methods = list(_methods)
+    while copied < count:
+        method = methods[0]
+        try:
+            n = method(infd,
+                       outfd,
+                       offset + copied,
+                       min(count - copied, MAXCOUNT))
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                continue
+            if e.errno in _UNSUPPORTED and len(methods) > 1:
+                debug("%s not usable (%s), falling back",
+                      method.__name__, e)
+                methods.pop(0)
+                continue
+            raise
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def get_fileno(fp):
+    """
+    returns the file descriptor underlying fp, or None if it
+    doesn't have one.
+    """
+    try:
+        fd = fp.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+    if not isinstance(fd, (int, long)) or fd < 0:
+        return None
+    return fd
+
+
+__all__ = ['copy_range', 'get_fileno']
@@ -0,0 +1,69 @@
+"""
+compares the old rechunker, which re-sliced its backlog for every
+chunk it produced, with buff_chunk_iterator, and shows how many writes
+coalesce_chunks saves for the chunks splice() produces.  Run it
+directly:
+
+  python tests/bench_buffutil.py [megabytes]
+"""
+
+import sys
+import time
+
+from ewa.buffutil import buff_chunk_iterator, coalesce_chunks
+
+
+def old_buff_chunk_iterator(iterator, bsize):
+    # the implementation buff_chunk_iterator replaced
+    buff = []
+    buffsize = 0
+    while 1:
+        while buffsize < bsize:
+            try:
+                chunkie = iterator.next()
+            except StopIteration:
+                if buffsize:
+                    yield ''.join(buff)
+                return
+            buff.append(chunkie)
+            buffsize += len(chunkie)
+        flattened = ''.join(buff)
+        while len(flattened) >= bsize:
+            chunk = flattened[:bsize]
+            flattened = flattened[bsize:]
+            yield chunk
+        buff = [flattened]
+        buffsize = len(flattened)
+
+
+def timeit(func, chunks, bsize):
+    best = None
+    for i in xrange(3):
+        t = time.time()
+        n = 0
+        for c in func(iter(chunks), bsize):
+            n += 1
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best, n
+
+
+def main(megabytes=16):
+    total = megabytes * 2**20
+    for insize, outsize in ((2**20, 4096), (417, 2**16), (2**22, 1024)):
+        chunks = ['x' * insize] * (total // insize)
+        print "%d MB in %d-byte chunks to %d-byte chunks:" % (
+            megabytes, insize, outsize)
+        for name, func in (('old', old_buff_chunk_iterator),
+                           ('new', buff_chunk_iterator)):
+            t, n = timeit(func, chunks, outsize)
+            print "  %s: %d chunks in %.3fs" % (name, n, t)
+    # what splice() yields for a file with both tags
+    chunks = ['i' * 1000] + ['a' * 2**20] * megabytes + ['t' * 128]
+    print "splice output: %d chunks, %d after coalescing" % (
+        len(chunks), len(list(coalesce_chunks(iter(chunks), 2**16))))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,63 @@
+"""
+compares the speed of the frameinfo extension with the pure Python
+fallback, with and without NumPy.  Run it directly:
+
+  python tests/bench_frameinfo.py [megabytes]
+"""
+
+import os
+import sys
+import time
+
+import ewa.pyframeinfo
+
+try:
+    import ewa.frameinfo as cframeinfo
+except ImportError:
+    cframeinfo = None
+
+from tests.mp3data import HEADER_128, FRAMELEN_128
+
+
+def timeit(func, *args, **kwargs):
+    best = None
+    for i in xrange(3):
+        t = time.time()
+        res = func(*args, **kwargs)
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best, res
+
+
+def main(megabytes=10):
+    nframes = megabytes * 2**20 // FRAMELEN_128
+    # random payloads, like real audio, are full of false syncs
+    payload = os.urandom(FRAMELEN_128 - len(HEADER_128))
+    buff = 'junk' + (HEADER_128 + payload) * nframes
+    print "walking %d frames (%.1f MB)" % (nframes, len(buff) / 2.0**20)
+    impls = []
+    if cframeinfo is not None:
+        impls.append(('C extension', cframeinfo))
+    impls.append(('Python + NumPy', ewa.pyframeinfo))
+    results = []
+    for name, impl in impls:
+        if name == 'Python + NumPy' and ewa.pyframeinfo.numpy is None:
+            continue
+        results.append((name,) + timeit(impl.walk_frames, buff, resync=True))
+    numpy = ewa.pyframeinfo.numpy
+    ewa.pyframeinfo.numpy = None
+    try:
+        results.append(('pure Python',) +
+                       timeit(ewa.pyframeinfo.walk_frames, buff, resync=True))
+    finally:
+        ewa.pyframeinfo.numpy = numpy
+    base = results[0][1]
+    for name, t, res in results:
+        assert res[:2] == results[0][2][:2]
+        print "%-16s %8.3fs  %6.1f MB/s  %6.1fx" % (
+            name, t, len(buff) / 2.0**20 / t, t / base)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
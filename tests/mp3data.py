@@ -0,0 +1,68 @@
+"""
+helpers for building small synthetic mp3 files for tests.
+"""
+
+import os
+import struct
+import tempfile
+
+# MPEG 1 layer III, 128kbps, 44100Hz, no padding, joint stereo
+HEADER_128 = '\xff\xfb\x90\x40'
+FRAMELEN_128 = 417
+
+
+def frame(header=HEADER_128, length=FRAMELEN_128, fill='\x00'):
+    return header + fill * (length - len(header))
+
+
+def frames(n, header=HEADER_128, length=FRAMELEN_128):
+    # make each frame distinguishable without creating false syncs
+    return ''.join(frame(header, length, chr(1 + (i % 100)))
+                   for i in xrange(n))
+
+
+def xing_frame(nframes, nbytes, header=HEADER_128, length=FRAMELEN_128,
+               tag='Xing', side=32):
+    payload = (tag + struct.pack('>III', 3, nframes, nbytes)).rjust(
+        side + len(tag) + 12, '\x00')
+    return header + payload.ljust(length - len(header), '\x00')
+
+
+def vbri_frame(nframes, nbytes, header=HEADER_128, length=FRAMELEN_128):
+    # the VBRI header always sits 32 bytes after the frame header
+    fields = struct.pack('>HHHII', 1, 0, 75, nbytes, nframes)
+    payload = ('VBRI' + fields).rjust(32 + 4 + len(fields), '\x00')
+    return header + payload.ljust(length - len(header), '\x00')
+
+
+def id3v2(payload='TIT2\x00\x00\x00\x05\x00\x00\x00test'):
+    size = len(payload)
+    syncsafe = ''.join(chr((size >> shift) & 127)
+                       for shift in (21, 14, 7, 0))
+    return 'ID3\x03\x00\x00' + syncsafe + payload
+
+
+def id3v1(title='test'):
+    return 'TAG' + title.ljust(125, '\x00')
+
+
+def write_mp3(dirname, name, nframes=10, v2=True, v1=True, junk='',
+              header=HEADER_128, length=FRAMELEN_128, first=''):
+    data = ''
+    if v2:
+        data += id3v2()
+    data += first + frames(nframes, header, length) + junk
+    if v1:
+        data += id3v1(name)
+    path = os.path.join(dirname, name)
+    parent = os.path.dirname(path)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    fp = open(path, 'wb')
+    fp.write(data)
+    fp.close()
+    return path
+
+
+def mkdtemp():
+    return tempfile.mkdtemp(prefix='ewatest')
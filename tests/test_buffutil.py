@@ -0,0 +1,23 @@
+from ewa.buffutil import buff_chunk_iterator, coalesce_chunks
+
+
+def test_buff_chunk_iterator():
+    chunks = ['ab', 'cde', '', 'f', 'ghij', 'klm']
+    res = list(buff_chunk_iterator(iter(chunks), 3))
+    assert res == ['abc', 'def', 'ghi', 'jkl', 'm']
+    assert list(buff_chunk_iterator(iter(['abc', buffer('de')]), 3)) == \
+           ['abc', 'de']
+    assert list(buff_chunk_iterator(iter([]), 3)) == []
+
+
+def test_coalesce_chunks():
+    # a tag either side of the audio
+    res = list(coalesce_chunks(iter(['tag', 'a' * 10, 'b' * 10, 'v1']), 8))
+    assert res == ['tag' + 'a' * 10, 'b' * 10 + 'v1']
+    res = list(coalesce_chunks(iter(['x', 'y', 'z', '']), 2))
+    assert res == ['xy', 'z']
+    # views are neither held back nor copied
+    view = buffer('aaaa')
+    res = list(coalesce_chunks(iter(['t', view, 'v']), 4))
+    assert res == ['t', view, 'v']
+    assert res[1] is view
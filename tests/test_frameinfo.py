@@ -0,0 +1,124 @@
+import mmap
+import random
+import tempfile
+
+import pytest
+
+from ewa.frameinfo import get_frame, walk_frames
+import ewa.pyframeinfo
+
+from tests.mp3data import frame, frames, HEADER_128, FRAMELEN_128
+
+
+def test_get_frame_offset():
+    buff = 'junk' + frame()
+    assert get_frame(buff) == (0, 0, 0)
+    assert get_frame(buff, 4) == (FRAMELEN_128, 3, 1)
+    assert get_frame(buffer(buff), 4) == (FRAMELEN_128, 3, 1)
+    assert get_frame(buff, len(buff)) == (0, 0, 0)
+
+
+def test_walk_frames():
+    buff = frames(5) + HEADER_128 + 'partial'
+    nframes, end, found = walk_frames(buff)
+    assert nframes == 5
+    assert end == 5 * FRAMELEN_128
+    assert found[1] == (FRAMELEN_128, FRAMELEN_128, 3, 1, 128000, 44100, 1)
+    assert walk_frames(buff, FRAMELEN_128, maxframes=2)[:2] == \
+           (2, 3 * FRAMELEN_128)
+
+
+def test_walk_frames_resync():
+    buff = 'junk' + frames(2) + 'more junk' + frames(3)
+    assert walk_frames(buff)[:2] == (0, 0)
+    nframes, end, found = walk_frames(buff, resync=True)
+    assert nframes == 5
+    assert end == len(buff)
+    assert found[2][0] == 4 + 2 * FRAMELEN_128 + len('more junk')
+
+
+def _random_stream(seed):
+    # a mixture of valid frames of several kinds and random junk,
+    # which also contains plenty of false syncs
+    rand = random.Random(seed)
+    headers = ['\xff\xfb\x90\x40', '\xff\xfb\x92\xc0',
+               '\xff\xf3\x48\x00', '\xff\xfd\xa4\x80',
+               '\xff\xe3\x18\x44']
+    parts = []
+    for i in xrange(200):
+        if rand.random() < 0.2:
+            parts.append(''.join(chr(rand.choice((0xff, 0xfb, 0xe3, 0x90,
+                                                  rand.randrange(256))))
+                                 for j in xrange(rand.randrange(1, 40))))
+        else:
+            h = rand.choice(headers)
+            parts.append(frame(h, get_frame(h)[0], chr(rand.randrange(256))))
+    return ''.join(parts)
+
+
+def _check_same(impl):
+    for seed in xrange(5):
+        buff = _random_stream(seed)
+        for offset in (0, 1, 4, 100):
+            for resync in (False, True):
+                assert impl.walk_frames(buff, offset, resync=resync) == \
+                       walk_frames(buff, offset, resync=resync)
+            assert impl.walk_frames(buff, offset, 7, True) == \
+                   walk_frames(buff, offset, 7, True)
+        for offset in xrange(0, len(buff), 97):
+            assert impl.get_frame(buff, offset) == get_frame(buff, offset)
+
+
+def test_pyframeinfo():
+    _check_same(ewa.pyframeinfo)
+
+
+def test_pyframeinfo_without_numpy():
+    numpy = ewa.pyframeinfo.numpy
+    ewa.pyframeinfo.numpy = None
+    try:
+        _check_same(ewa.pyframeinfo)
+    finally:
+        ewa.pyframeinfo.numpy = numpy
+
+
+def test_pyframeinfo_mmap():
+    buff = _random_stream(0)
+    tmp = tempfile.TemporaryFile()
+    tmp.write(buff)
+    tmp.flush()
+    mapped = mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+    numpy = ewa.pyframeinfo.numpy
+    ewa.pyframeinfo.numpy = None
+    try:
+        for view in (mapped, buffer(buff), memoryview(buff)):
+            assert ewa.pyframeinfo.walk_frames(view, 4, resync=True) == \
+                   walk_frames(buff, 4, resync=True)
+    finally:
+        ewa.pyframeinfo.numpy = numpy
+        mapped.close()
+        tmp.close()
+
+
+def test_pyframeinfo_blocks():
+    # each block is decoded once however many calls walk through it
+    if ewa.pyframeinfo.numpy is None:
+        pytest.skip("needs NumPy")
+    buff = _random_stream(1)
+    blocksize = ewa.pyframeinfo.BLOCKSIZE
+    decode = ewa.pyframeinfo._decode_block
+    calls = []
+
+    def counting(arr, start, stop):
+        calls.append(start)
+        return decode(arr, start, stop)
+    ewa.pyframeinfo.BLOCKSIZE = 256
+    ewa.pyframeinfo._decode_block = counting
+    try:
+        for offset in xrange(0, len(buff), 13):
+            assert ewa.pyframeinfo.walk_frames(buff, offset, 3, True) == \
+                   walk_frames(buff, offset, 3, True)
+    finally:
+        ewa.pyframeinfo.BLOCKSIZE = blocksize
+        ewa.pyframeinfo._decode_block = decode
+    assert sorted(calls) == sorted(set(calls))
@@ -0,0 +1,49 @@
+import os
+import shutil
+
+from ewa.audio import FSAudioProvider
+from ewa.iohints import fadvise, fallocate, initIOHints, IOHints
+from ewa.rules import GlobMatcher, MatchRule
+
+from tests.mp3data import frames, id3v1, id3v2, mkdtemp, write_mp3
+
+
+def setup_module(module):
+    module.tmpdir = mkdtemp()
+
+
+def teardown_module(module):
+    shutil.rmtree(module.tmpdir)
+    initIOHints()
+
+
+def test_hints():
+    try:
+        IOHints(['sequential', 'bogus'])
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+    path = os.path.join(tmpdir, 'alloc')
+    fp = open(path, 'wb')
+    try:
+        # may be unsupported, but mustn't raise
+        if fallocate(fp.fileno(), 0, 4096):
+            assert os.path.getsize(path) == 4096
+        fadvise(fp.fileno(), 0, 0, 4)
+    finally:
+        fp.close()
+
+
+def test_create_combined_with_hints():
+    write_mp3(tmpdir, 'main/show.mp3', 6)
+    for d in ('extra/master', 'extra/transcoded/128/44100/j'):
+        intro = write_mp3(tmpdir, d + '/intro.mp3', 2, v2=False, v1=False)
+        os.utime(intro, (0, 0))
+    rule = MatchRule(GlobMatcher('*'), pre=['intro.mp3'])
+    provider = FSAudioProvider(tmpdir)
+    initIOHints(['sequential', 'willneed', 'dontneed', 'preallocate'])
+    target = provider.create_combined('show.mp3', rule, xing=True)
+    data = open(target, 'rb').read()
+    assert data.startswith(id3v2())
+    assert data.endswith(frames(2) + frames(6) + id3v1('main/show.mp3'))
@@ -0,0 +1,36 @@
+from ewa.lru import LRUCache
+
+
+def test_lru():
+    c = LRUCache(2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    c.put('c', 3)
+    # b was least recently used
+    assert c.get('b') is None
+    assert c.get('a') == 1 and c.get('c') == 3
+    assert c.stats() == dict(size=2, maxsize=2, hits=3, misses=1,
+                             evictions=1)
+    c.resize(1)
+    assert len(c) == 1 and 'c' in c
+
+
+def test_lru_disabled():
+    c = LRUCache(0)
+    c.put('a', 1)
+    assert c.get('a') is None
+    assert len(c) == 0
+
+
+def test_lru_weight():
+    c = LRUCache(10, maxweight=10)
+    c.put('a', 'x' * 4)
+    c.put('b', 'x' * 4)
+    c.put('c', 'x' * 4)
+    assert 'a' not in c and c.weight == 8
+    # too heavy to cache at all
+    c.put('b', 'x' * 11)
+    assert 'b' not in c and c.weight == 4
+    c.resize(10, 3)
+    assert len(c) == 0 and c.stats()['weight'] == 0
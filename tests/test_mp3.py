@@ -0,0 +1,396 @@
+import marshal
+import os
+import shutil
+import struct
+import threading
+import time
+from hashlib import md5
+
+import pytest
+
+import ewa.mp3
+import ewa.prefetch
+from ewa.prefetch import get_prefetch_stats, initPrefetch
+from ewa.segcache import initSegmentCache
+from ewa.spliceindex import SegmentInfo, SpliceIndex, initSpliceIndex
+
+from tests.mp3data import (frame, frames, id3v1, id3v2, mkdtemp, write_mp3,
+                           vbri_frame, xing_frame, FRAMELEN_128, HEADER_128)
+
+try:
+    import eyed3.mp3
+except ImportError:
+    eyed3 = None
+
+
+def setup_module(module):
+    module.tmpdir = mkdtemp()
+
+
+def teardown_module(module):
+    shutil.rmtree(module.tmpdir)
+    initSpliceIndex()
+
+
+def test_segment_info():
+    path = write_mp3(tmpdir, 'info.mp3', 5, junk='\xff\xfb\x90\x40abc')
+    info = ewa.mp3.get_segment_info(path, index=SpliceIndex())
+    assert info.audio_start == len(id3v2())
+    assert info.audio_end == len(id3v2()) + 5 * FRAMELEN_128
+    assert info.id3v1 == id3v1('info.mp3')
+
+
+def test_splice():
+    a = write_mp3(tmpdir, 'a.mp3', 3)
+    b = write_mp3(tmpdir, 'b.mp3', 4, v2=False, v1=False)
+    initSpliceIndex()
+    res = ''.join(ewa.mp3.splice([a, b, a], tagfile=b, buffsize=1000))
+    assert res == frames(3) + frames(4) + frames(3)
+    res = ''.join(ewa.mp3.splice([b, a], tagfile=a, buffsize=1000))
+    assert res == id3v2() + frames(4) + frames(3) + id3v1('a.mp3')
+
+
+def test_persistent_index():
+    indexdir = os.path.join(tmpdir, 'index')
+    path = write_mp3(tmpdir, 'persist.mp3', 3)
+    info = ewa.mp3.get_segment_info(path, index=SpliceIndex(indexdir))
+    # a fresh index over the same directory must not rescan the file
+    scan = ewa.mp3._scan_segment
+    ewa.mp3._scan_segment = None
+    try:
+        info2 = ewa.mp3.get_segment_info(path, index=SpliceIndex(indexdir))
+    finally:
+        ewa.mp3._scan_segment = scan
+    assert info2.todict() == info.todict()
+    # a changed file invalidates the entry
+    write_mp3(tmpdir, 'persist.mp3', 4, v1=False)
+    os.utime(path, (0, 0))
+    info3 = ewa.mp3.get_segment_info(path, index=SpliceIndex(indexdir))
+    assert info3.id3v1 == ''
+    assert info3.audio_end == len(id3v2()) + 4 * FRAMELEN_128
+    # damaged entries are misses
+    index = SpliceIndex(indexdir)
+    for junk in ('', marshal.dumps((2, path)), marshal.dumps([1, 2, 3, 4, 5]),
+                 marshal.dumps((2, path, info3.size, info3.mtime, 'junk'))):
+        open(index._entry_path(path), 'wb').write(junk)
+        assert index.lookup(path) is None
+    # non-ASCII unicode paths can be indexed
+    upath = u'/nowhere/caf\xe9.mp3'
+    SpliceIndex(indexdir).store(SegmentInfo(upath, info3.size, info3.mtime,
+                                            info3.todict()))
+    info4 = SpliceIndex(indexdir).lookup(upath, os.stat(path))
+    assert info4.todict() == info3.todict()
+
+
+def test_splice_to_file_sendfile():
+    from cStringIO import StringIO
+    a = write_mp3(tmpdir, 'a.mp3', 3)
+    b = write_mp3(tmpdir, 'b.mp3', 4, v2=False, v1=False)
+    expected = ''.join(ewa.mp3.splice([b, a, b], tagfile=a))
+    out = os.path.join(tmpdir, 'out.mp3')
+    fp = open(out, 'wb')
+    ewa.mp3.splice_to_file(fp, [b, a, b], a,
+                           splicer=ewa.mp3._sendfile_splicer)
+    fp.close()
+    assert open(out, 'rb').read() == expected
+    # not a real file: falls back to the generator path
+    sio = StringIO()
+    ewa.mp3.splice_to_file(sio, [b, a, b], a,
+                           splicer=ewa.mp3._sendfile_splicer)
+    assert sio.getvalue() == expected
+
+
+def test_mmap_splicer():
+    a = write_mp3(tmpdir, 'a.mp3', 3)
+    b = write_mp3(tmpdir, 'b.mp3', 4, v2=False, v1=False)
+    expected = ''.join(ewa.mp3.splice([b, a, b], tagfile=a, buffsize=1000))
+    # chunks stay valid after the generator has moved on
+    chunks = list(ewa.mp3.splice([b, a, b], tagfile=a, buffsize=1000,
+                                 splicer=ewa.mp3._mmap_splicer))
+    assert ''.join([str(c) for c in chunks]) == expected
+    assert max(len(c) for c in chunks) <= 1000
+    # plans, as streamed, are mapped too
+    plan = ewa.mp3.splice_plan([b, a, b], a)
+    chunks = list(ewa.mp3.read_plan(plan, 1000, 10, 2000,
+                                    splicer=ewa.mp3._mmap_splicer))
+    assert ''.join([str(c) for c in chunks]) == expected[10:2000]
+    assert [c for c in chunks if not isinstance(c, str)]
+    # abandoning the generator releases the map
+    gen = ewa.mp3._mmap_splicer([a], 100)
+    gen.next()
+    gen.close()
+
+
+def test_prefetch_splicer():
+    a = write_mp3(tmpdir, 'a.mp3', 3)
+    b = write_mp3(tmpdir, 'b.mp3', 4, v2=False, v1=False)
+    files = [b, a, b, a]
+    expected = ''.join(ewa.mp3.splice(files, tagfile=a, buffsize=1000))
+    # read ahead no more than a frame per file, so most of each
+    # file is read after its head
+    initPrefetch(segments=2, maxbytes=3 * FRAMELEN_128, threads=2)
+    try:
+        before = get_prefetch_stats()['segments']
+        chunks = list(ewa.mp3.splice(files, tagfile=a, buffsize=1000,
+                                     splicer=ewa.mp3._prefetch_splicer))
+        assert ''.join(chunks) == expected
+        assert max(len(c) for c in chunks) <= 1000
+        assert get_prefetch_stats()['segments'] == before + len(files)
+        plan = ewa.mp3.splice_plan(files, a)
+        assert ''.join(ewa.mp3.read_plan(
+            plan, 1000, 10, 2000,
+            splicer=ewa.mp3._prefetch_splicer)) == expected[10:2000]
+        # abandoning the generator closes the files prepared so far,
+        # including those still being opened
+        nfds = len(os.listdir('/proc/self/fd'))
+        gen = ewa.mp3._prefetch_splicer(files, 100)
+        gen.next()
+        gen.close()
+        for i in xrange(100):
+            if len(os.listdir('/proc/self/fd')) == nfds:
+                break
+            time.sleep(0.01)
+        assert len(os.listdir('/proc/self/fd')) == nfds
+        # with every prefetching thread busy elsewhere, the consumer
+        # prepares each part itself rather than waiting
+        busy = threading.Event()
+        for i in xrange(2):
+            ewa.prefetch._get_pool().apply_async(busy.wait)
+        try:
+            assert ''.join(ewa.mp3.read_plan(
+                plan, 1000, splicer=ewa.mp3._prefetch_splicer)) == expected
+        finally:
+            busy.set()
+    finally:
+        initPrefetch()
+
+
+def _write_resync_corpus():
+    d = os.path.join(tmpdir, 'resync')
+    return [
+        # a partial frame at the end
+        write_mp3(d, 'a.mp3', 3, junk=frame()[:200]),
+        # junk with a false sync at the start
+        write_mp3(d, 'b.mp3', 4, v2=False, first='junk\xff\xfbjunk'),
+        # a lone false sync in the middle
+        write_mp3(d, 'c.mp3', 2, v1=False,
+                  first=frames(2) + 'ab' + HEADER_128 + 'z' * 500),
+        # a Xing frame is a frame
+        write_mp3(d, 'd.mp3', 2, first=xing_frame(2, 2 * FRAMELEN_128)),
+        ]
+
+
+# md5 digests of the resync engine's output for each file of the
+# resync corpus, as a regression snapshot; they come from ewa itself,
+# not from mp3cat
+RESYNC_DIGESTS = [
+    'a5a0412a87b46467e7e60c309b1325a9',
+    'bbdb3979d9df57c850d5c376c1c500ed',
+    'bf9ec198cf3aa10e9e080002017dfec9',
+    'cdddb4fa959a7a256c1829e859d2123b',
+    ]
+
+
+def test_resync_splicer():
+    files = _write_resync_corpus()
+    initSpliceIndex()
+    expected = (frames(3) + frames(4) + frames(2) + frames(2)
+                + xing_frame(2, 2 * FRAMELEN_128) + frames(2))
+    # including blocks that end within a few bytes of a frame boundary
+    for buffsize in [100, 1000, 2**20] + range(380, 1300):
+        chunks = list(ewa.mp3._resync_splicer(files, buffsize))
+        assert ''.join(chunks) == expected, buffsize
+        assert max(len(c) for c in chunks) <= buffsize
+    for path, digest in zip(files, RESYNC_DIGESTS):
+        res = ''.join(ewa.mp3._resync_splicer([path], 2**16))
+        assert md5(res).hexdigest() == digest, path
+
+
+def test_pipe_splicer():
+    import subprocess
+    a = write_mp3(tmpdir, 'a.mp3', 3)
+    b = write_mp3(tmpdir, 'b.mp3', 40, v2=False, junk=frame()[:200])
+    expected = ''.join(ewa.mp3.splice([b, a, b], tagfile=a, buffsize=1000))
+    procs = [subprocess.Popen(['cat', f], stdout=subprocess.PIPE)
+             for f in (b, a, b)]
+    try:
+        chunks = list(ewa.mp3.splice([p.stdout for p in procs], tagfile=a,
+                                     buffsize=1000,
+                                     splicer=ewa.mp3._pipe_splicer))
+    finally:
+        for p in procs:
+            p.stdout.close()
+            p.wait()
+    assert ''.join(chunks) == expected
+    assert max(len(c) for c in chunks) <= 1000
+
+
+# (name, header, frame length, first frame, expected probe result,
+#  what eyed3 0.8.12 makes of the file)
+PROBE_CORPUS = [
+    ('cbr128j.mp3', '\xff\xfb\x90\x40', 417, '',
+     (False, 128, 44100, 'j'), (False, 128, 44100, 'j')),
+    ('cbr64m.mp3', '\xff\xfb\x50\xc0', 208, '',
+     (False, 64, 44100, 'm'), (False, 64, 44100, 'm')),
+    ('cbr160s.mp3', '\xff\xfb\xa4\x00', 480, '',
+     (False, 160, 48000, 's'), (False, 160, 48000, 's')),
+    ('cbr32d.mp3', '\xff\xfb\x18\x80', 144, '',
+     (False, 32, 32000, 'd'), (False, 32, 32000, 'd')),
+    ('mpeg2.mp3', '\xff\xf3\x80\x40', 208, '',
+     (False, 64, 22050, 'j'), (False, 64, 22050, 'j')),
+    ('xing.mp3', '\xff\xfb\x90\x40', 417, xing_frame(100, 100 * 300),
+     (True, 91, 44100, 'j'), (True, 91, 44100, 'j')),
+    ('info.mp3', '\xff\xfb\x90\x40', 417, xing_frame(10, 4170, tag='Info'),
+     (False, 128, 44100, 'j'), (False, 128, 44100, 'j')),
+    # eyed3 takes the first plausible header at face value, while the
+    # probe checks that another frame follows it
+    ('junk.mp3', '\xff\xfb\x90\x40', 417, 'junk\xff\xfbjunk',
+     (False, 128, 44100, 'j'), (False, 80, 32000, 'j')),
+    # eyed3 ignores VBRI headers
+    ('vbri.mp3', '\xff\xfb\x90\x40', 417, vbri_frame(100, 100 * 300),
+     (True, 91, 44100, 'j'), (False, 128, 44100, 'j')),
+    ]
+
+
+def _write_probe_corpus():
+    paths = []
+    for name, header, length, first, expected, eyed3ed in PROBE_CORPUS:
+        path = write_mp3(tmpdir, 'corpus/' + name, 10,
+                         header=header, length=length, first=first)
+        paths.append((path, expected, eyed3ed))
+    return paths
+
+
+def test_probe():
+    for path, expected, eyed3ed in _write_probe_corpus():
+        assert ewa.mp3.probe_mp3(path) == expected, path
+    path = os.path.join(tmpdir, 'corpus', 'notmp3.mp3')
+    open(path, 'wb').write(id3v2() + 'not an mp3' * 100)
+    try:
+        ewa.mp3.probe_mp3(path)
+    except ewa.mp3.Mp3Error:
+        pass
+    else:
+        assert False, 'expected Mp3Error'
+
+
+def _eyed3_probe(path):
+    info = eyed3.mp3.Mp3AudioFile(path).info
+    return info.bit_rate + (info.sample_freq, info.mode[0].lower())
+
+
+def test_eyed3_results():
+    # checks that the recorded eyed3 results are still what eyed3 says
+    if eyed3 is None:
+        pytest.skip('eyed3 is not installed')
+    for path, expected, eyed3ed in _write_probe_corpus():
+        assert _eyed3_probe(path) == eyed3ed, path
+
+
+def test_probe_cache():
+    path = write_mp3(tmpdir, 'cached.mp3', 3)
+    cache = ewa.mp3.get_probe_cache()
+    cache.clear()
+    before = cache.stats()
+    assert ewa.mp3.get_vbr_bitrate_samplerate_mode(path) == \
+           (False, 128, 44100, 'j')
+    assert ewa.mp3.get_vbr_bitrate_samplerate_mode(path) == \
+           (False, 128, 44100, 'j')
+    after = cache.stats()
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == 1
+    # a changed file is probed again
+    write_mp3(tmpdir, 'cached.mp3', 3, header='\xff\xfb\x50\xc0', length=208)
+    os.utime(path, (0, 0))
+    assert ewa.mp3.get_vbr_bitrate_samplerate_mode(path) == \
+           (False, 64, 44100, 'm')
+
+
+def test_sanity_check():
+    a = write_mp3(tmpdir, 'sane/a.mp3', 3)
+    b = write_mp3(tmpdir, 'sane/b.mp3', 3, header='\xff\xfb\x50\xc0',
+                  length=208)
+    missing = os.path.join(tmpdir, 'sane', 'missing.mp3')
+    ewa.mp3.mp3_sanity_check([a, a])
+    for jobs in (1, 2):
+        try:
+            ewa.mp3.mp3_sanity_check([a, a, b], jobs)
+        except ValueError, e:
+            assert str(e) == 'bitrate does not match; expected 128, got 64'
+        else:
+            assert False, 'expected ValueError'
+        result = ewa.mp3.check_mp3s([a, b, missing, b], jobs)
+        assert not result.ok
+        assert result.template == (False, 128, 44100, 'j')
+        assert [m[:2] for m in result.mismatches] == \
+               [(b, 'bitrate'), (b, 'mode'), (b, 'bitrate'), (b, 'mode')]
+        assert [e[0] for e in result.errors] == [missing]
+
+
+def test_xing_header():
+    from ewa.pyframeinfo import walk_frames
+    a = write_mp3(tmpdir, 'xing/a.mp3', 3, first=xing_frame(3, 4 * 417,
+                                                             tag='Info'))
+    b = write_mp3(tmpdir, 'xing/b.mp3', 5, v2=False, v1=False)
+    for splicer in ewa.mp3.RANGE_SPLICERS:
+        res = ''.join([str(c) for c in ewa.mp3.splice([a, b], tagfile=a,
+                                                      splicer=splicer,
+                                                      xing=True)])
+        audio = res[len(id3v2()):-128]
+        nframes, end, found = walk_frames(audio)
+        assert end == len(audio)
+        # one new Info frame, and the old one is gone
+        assert nframes == 1 + 3 + 5
+        assert audio[36:40] == 'Info'
+        assert audio[found[1][0]:] == frames(3) + frames(5)
+        flags, count, size = struct.unpack('>III', audio[40:52])
+        assert (flags, count, size) == (7, 8, len(audio))
+        toc = [ord(c) for c in audio[52:152]]
+        assert toc == sorted(toc) and toc[0] == int(256.0 * 417 / size)
+    out = os.path.join(tmpdir, 'xing', 'out.mp3')
+    fp = open(out, 'wb')
+    ewa.mp3.splice_to_file(fp, [a, b], a, xing=True,
+                           splicer=ewa.mp3._sendfile_splicer)
+    fp.close()
+    assert open(out, 'rb').read() == res
+
+
+def test_segment_cache():
+    extras = os.path.join(tmpdir, 'cached')
+    a = write_mp3(extras, 'a.mp3', 3)
+    b = write_mp3(extras, 'b.mp3', 2, v2=False)
+    main = write_mp3(tmpdir, 'uncached.mp3', 4)
+    initSpliceIndex()
+    cache = initSegmentCache(10 * FRAMELEN_128, [extras])
+    try:
+        assert ewa.mp3.preload_segments(extras) == 2
+        assert cache.stats()['weight'] == 5 * FRAMELEN_128
+        # the extras come from memory
+        before = cache.stats()
+        expected = frames(3) + frames(4) + frames(2)
+        for splicer in ewa.mp3.RANGE_SPLICERS:
+            res = ''.join([str(c) for c in ewa.mp3.splice([a, main, b],
+                                                          splicer=splicer)])
+            assert res == expected
+        plan = ewa.mp3.splice_plan([a, main])
+        assert ''.join(ewa.mp3.read_plan(plan)) == frames(3) + frames(4)
+        assert not cache.covers(main)
+        after = cache.stats()
+        assert after['misses'] == before['misses']
+        assert after['hits'] == before['hits'] + 2 * 4 + 1
+        # a file too big for the cache is read from disk
+        big = write_mp3(extras, 'big.mp3', 11)
+        plan = ewa.mp3.splice_plan([big])
+        for splicer in ewa.mp3.RANGE_SPLICERS:
+            res = ''.join([str(c) for c in ewa.mp3.read_plan(
+                plan, 1000, 10, 2000, splicer=splicer)])
+            assert res == frames(11)[10:2000]
+        assert cache.stats()['evictions'] == after['evictions']
+        assert cache.stats()['weight'] == 5 * FRAMELEN_128
+        # a changed file is reloaded
+        write_mp3(extras, 'a.mp3', 1)
+        os.utime(a, (1, 1))
+        res = ''.join(ewa.mp3.splice([a, main]))
+        assert res == frames(1) + frames(4)
+    finally:
+        initSegmentCache()
@@ -0,0 +1,37 @@
+from ewa.procutil import get_process_stats, stream_pipeline
+
+
+def test_pipeline_output():
+    live = get_process_stats()['live']
+    out = ''.join(stream_pipeline([['printf', 'abcdef'], ['tr', 'a-f', 'A-F']],
+                                  4))
+    assert out == 'ABCDEF'
+    assert get_process_stats()['live'] == live
+
+
+def test_close_terminates():
+    before = get_process_stats()
+    gen = stream_pipeline([['yes'], ['cat']], 1024)
+    assert gen.next()
+    assert get_process_stats()['live'] == before['live'] + 2
+    gen.close()
+    after = get_process_stats()
+    assert after['live'] == before['live']
+    assert after['terminated'] > before['terminated']
+
+
+def test_abandoned_generator():
+    live = get_process_stats()['live']
+    gen = stream_pipeline([['yes']], 16)
+    gen.next()
+    del gen
+    assert get_process_stats()['live'] == live
+
+
+def test_closed_reader_is_not_failure():
+    # yes dies of SIGPIPE when head stops reading
+    before = get_process_stats()
+    out = ''.join(stream_pipeline([['yes'], ['head', '-c', '10']], 1024))
+    assert out == 'y\n' * 5
+    after = get_process_stats()
+    assert after['failed'] == before['failed']
@@ -1,3 +1,4 @@
+import datetime
 import tempfile
 
 import ewa.rules
@@ -15,3 +16,24 @@ def test_filerule1():
     orig='blather.mp3'
     assert list(fr(orig))==[orig]
     
+
+
+def test_possible_extras():
+    R=ewa.rules
+    now=datetime.datetime.now()
+    day=datetime.timedelta(days=1)
+    rule=R.RuleList([
+        R.MatchRule(R.And(R.GlobMatcher('show*'),
+                          R.CurrentTimeMatch(now+day, now+2*day)),
+                    pre=['promo.mp3']),
+        R.MatchRule(R.And(R.GlobMatcher('show*'),
+                          R.CurrentTimeMatch(now-2*day, now-day)),
+                    pre=['old.mp3']),
+        R.RegexRule(r'show(\d+)', pre=['intro.mp3'], post=['\\1.mp3']),
+        R.GlobMatchRule('*', pre=['intro.mp3'], post=['generic.mp3']),
+        ])
+    # only the rule that matches now is applied
+    assert list(rule('show7.mp3'))==['intro.mp3', 'show7.mp3', '7.mp3']
+    assert R.possible_extras(rule, 'show7.mp3')==['promo.mp3', 'intro.mp3',
+                                                  '7.mp3', 'generic.mp3']
+    assert R.possible_extras(rule, 'news.mp3')==['intro.mp3', 'generic.mp3']
@@ -0,0 +1,111 @@
+import os
+import shutil
+import threading
+import time
+
+from ewa.singleflight import (get_single_flight_stats, single_flight,
+                              LOCK_SUFFIX)
+
+from tests.mp3data import mkdtemp
+
+
+def setup_module(module):
+    module.tmpdir = mkdtemp()
+
+
+def teardown_module(module):
+    shutil.rmtree(module.tmpdir)
+
+
+def _creator(target, calls, delay):
+    def create():
+        calls.append(threading.currentThread().getName())
+        time.sleep(delay)
+        renamed = target + '%d~' % len(calls)
+        open(renamed, 'wb').write('combined')
+        os.rename(renamed, target)
+        return target
+    return create
+
+
+def _run(target, calls, delay, timeout, nthreads):
+    results = []
+
+    def run():
+        results.append(single_flight(target,
+                                     _creator(target, calls, delay),
+                                     timeout))
+    threads = [threading.Thread(target=run) for i in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_followers_wait_for_leader():
+    target = os.path.join(tmpdir, 'sub', 'show.mp3')
+    before = get_single_flight_stats()
+    calls = []
+    results = _run(target, calls, 0.3, 10, 8)
+    assert results == [target] * 8
+    assert len(calls) == 1
+    after = get_single_flight_stats()
+    assert after['led'] == before['led'] + 1
+    assert after['followed'] == before['followed'] + 7
+    assert not os.path.exists(target + LOCK_SUFFIX)
+
+
+def test_timeout():
+    target = os.path.join(tmpdir, 'slow.mp3')
+    before = get_single_flight_stats()
+    calls = []
+    results = _run(target, calls, 0.5, 0.1, 2)
+    assert results == [target] * 2
+    # the follower gave up and made its own
+    assert len(calls) == 2
+    after = get_single_flight_stats()
+    assert after['timed_out'] == before['timed_out'] + 1
+
+
+def test_fresh_checked_under_lock():
+    # made by another process after we found it stale but before we
+    # got the lock
+    target = os.path.join(tmpdir, 'made.mp3')
+    open(target, 'wb').write('combined')
+    before = get_single_flight_stats()
+    calls = []
+    assert single_flight(target, _creator(target, calls, 0), 10,
+                         lambda: os.path.exists(target)) == target
+    assert not calls
+    after = get_single_flight_stats()
+    assert after['followed'] == before['followed'] + 1
+    assert after['led'] == before['led']
+
+
+def test_two_processes():
+    target = os.path.join(tmpdir, 'forked.mp3')
+    log = os.path.join(tmpdir, 'forked.log')
+
+    def create():
+        open(log, 'ab').write('%d\n' % os.getpid())
+        time.sleep(0.3)
+        open(target + '~', 'wb').write('combined')
+        os.rename(target + '~', target)
+        return target
+
+    def run():
+        return single_flight(target, create, 10,
+                             lambda: os.path.exists(target))
+    pid = os.fork()
+    if not pid:
+        status = 1
+        try:
+            if run() == target:
+                status = 0
+        finally:
+            os._exit(status)
+    assert run() == target
+    assert os.waitpid(pid, 0)[1] == 0
+    assert len(open(log).readlines()) == 1
+    assert open(target).read() == 'combined'
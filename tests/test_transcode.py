@@ -0,0 +1,169 @@
+import fcntl
+import os
+import shutil
+import threading
+import time
+
+import ewa.transcode
+from ewa.audio import FSAudioProvider
+from ewa.rules import GlobMatcher, MatchRule
+from ewa.singleflight import get_single_flight_stats, LOCK_SUFFIX
+from ewa.transcode import initTranscoder
+
+from tests.mp3data import mkdtemp, write_mp3
+
+
+def setup_module(module):
+    module.tmpdir = mkdtemp()
+
+
+def teardown_module(module):
+    shutil.rmtree(module.tmpdir)
+    initTranscoder()
+
+
+def test_parallel_single_flight():
+    write_mp3(tmpdir, 'main/show.mp3', 6)
+    for name in ('intro.mp3', 'outro.mp3'):
+        write_mp3(tmpdir, 'extra/master/' + name, 2)
+    rule = MatchRule(GlobMatcher('*'), pre=['intro.mp3'], post=['outro.mp3'])
+    calls = []
+    running = []
+    overlapped = []
+
+    def fake_lame(bitrate, samplerate, mode, master, new):
+        calls.append(os.path.basename(master))
+        running.append(master)
+        time.sleep(0.2)
+        overlapped.append(len(running) > 1)
+        # written under a temporary name
+        assert new.endswith('~')
+        shutil.copy(master, new)
+        running.remove(master)
+
+    lame = ewa.transcode.lameTranscode
+    ewa.transcode.lameTranscode = fake_lame
+    initTranscoder(jobs=2)
+    try:
+        provider = FSAudioProvider(tmpdir)
+        results = []
+
+        def run():
+            results.append(provider.get_playlist('show.mp3', rule))
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        ewa.transcode.lameTranscode = lame
+    # each extra transcoded once, the two at the same time
+    assert sorted(calls) == ['intro.mp3', 'outro.mp3']
+    assert True in overlapped
+    assert len(results) == 4 and results.count(results[0]) == 4
+    transcoded = os.path.join(tmpdir, 'extra', 'transcoded', '128', '44100',
+                              'j')
+    assert sorted(os.listdir(transcoded)) == ['intro.mp3', 'outro.mp3']
+
+
+def test_warm_extras():
+    basedir = os.path.join(tmpdir, 'warm')
+    write_mp3(basedir, 'main/a.mp3', 3)
+    write_mp3(basedir, 'main/b.mp3', 3)
+    write_mp3(basedir, 'main/c.mp3', 3, header='\xff\xfb\x50\xc0',
+              length=208)
+    open(os.path.join(basedir, 'main', 'broken.mp3'), 'wb').write('junk')
+    write_mp3(basedir, 'extra/master/intro.mp3', 2)
+    rule = MatchRule(GlobMatcher('*'), pre=['intro.mp3'],
+                     post=['nosuch.mp3'])
+    names = ['a.mp3', 'b.mp3', 'c.mp3', 'broken.mp3']
+    calls = []
+
+    def fake_lame(bitrate, samplerate, mode, master, new):
+        calls.append((bitrate, samplerate, mode))
+        shutil.copy(master, new)
+
+    lame = ewa.transcode.lameTranscode
+    ewa.transcode.lameTranscode = fake_lame
+    try:
+        provider = FSAudioProvider(basedir)
+        formats, skipped, extras = provider.warm_extras(names, rule,
+                                                        dryrun=True)
+        assert formats == {'a.mp3': (128, 44100, 'j'),
+                           'b.mp3': (128, 44100, 'j'),
+                           'c.mp3': (64, 44100, 'm')}
+        assert skipped == ['broken.mp3']
+        assert extras == {('intro.mp3', 'j', 128, 44100): 'needed',
+                          ('intro.mp3', 'm', 64, 44100): 'needed',
+                          ('nosuch.mp3', 'j', 128, 44100): 'missing',
+                          ('nosuch.mp3', 'm', 64, 44100): 'missing'}
+        assert not calls
+        extras = provider.warm_extras(names, rule, jobs=2)[2]
+        assert sorted(calls) == [(64, 44100, 'm'), (128, 44100, 'j')]
+        assert extras[('intro.mp3', 'j', 128, 44100)] == 'transcoded'
+        extras = provider.warm_extras(names, rule)[2]
+        assert extras[('intro.mp3', 'm', 64, 44100)] == 'current'
+        assert len(calls) == 2
+    finally:
+        ewa.transcode.lameTranscode = lame
+
+
+def test_current_extras_skip_pool():
+    basedir = os.path.join(tmpdir, 'busy')
+    write_mp3(basedir, 'main/show.mp3', 6)
+    for name in ('intro.mp3', 'outro.mp3'):
+        write_mp3(basedir, 'extra/master/' + name, 2)
+    rule = MatchRule(GlobMatcher('*'), pre=['intro.mp3'], post=['outro.mp3'])
+
+    def fake_lame(bitrate, samplerate, mode, master, new):
+        shutil.copy(master, new)
+
+    lame = ewa.transcode.lameTranscode
+    ewa.transcode.lameTranscode = fake_lame
+    initTranscoder(jobs=2)
+    release = threading.Event()
+    try:
+        provider = FSAudioProvider(basedir)
+        playlist = provider.get_playlist('show.mp3', rule)
+        # every worker busy with someone else's transcodes
+        busy = ewa.transcode._get_pool().map_async(lambda x: release.wait(),
+                                                   range(2))
+        done = []
+        t = threading.Thread(
+            target=lambda: done.append(provider.get_playlist('show.mp3',
+                                                             rule)))
+        t.start()
+        t.join(2)
+        assert done == [playlist]
+    finally:
+        release.set()
+        busy.wait()
+        ewa.transcode.lameTranscode = lame
+
+
+def test_lock_timeout():
+    basedir = os.path.join(tmpdir, 'locked')
+    write_mp3(basedir, 'main/show.mp3', 6)
+    write_mp3(basedir, 'extra/master/intro.mp3', 2)
+    rule = MatchRule(GlobMatcher('*'), pre=['intro.mp3'])
+    provider = FSAudioProvider(basedir)
+    path = provider.get_extra_transcoded_path('intro.mp3', 'j', 128, 44100)
+    os.makedirs(os.path.dirname(path))
+    # held by a transcode that hangs
+    fd = os.open(path + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def fake_lame(bitrate, samplerate, mode, master, new):
+        shutil.copy(master, new)
+
+    lame = ewa.transcode.lameTranscode
+    ewa.transcode.lameTranscode = fake_lame
+    initTranscoder(lock_timeout=0.2)
+    before = get_single_flight_stats()
+    try:
+        assert provider.get_playlist('show.mp3', rule)[0] == path
+    finally:
+        ewa.transcode.lameTranscode = lame
+        os.close(fd)
+    after = get_single_flight_stats()
+    assert after['timed_out'] == before['timed_out'] + 1
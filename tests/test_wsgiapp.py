@@ -0,0 +1,310 @@
+import json
+import os
+import shutil
+import urllib
+
+import ewa.mp3
+from ewa.manifest import find_stale_literals
+from ewa.rules import GlobMatcher, MatchRule
+from ewa.sendfile_middleware import SendfileMiddleware
+from ewa.spliceindex import initSpliceIndex
+from ewa.wsgiapp import (EwaApp, format_sendfile2, parse_range,
+                         RangeNotSatisfiable, SENDFILE2_HEADER)
+
+from tests.mp3data import (frames, id3v1, id3v2, mkdtemp, write_mp3,
+                           xing_frame, FRAMELEN_128)
+
+
+def setup_module(module):
+    module.tmpdir = mkdtemp()
+    write_mp3(tmpdir, 'main/show.mp3', 6)
+    for d in ('extra/master', 'extra/transcoded/128/44100/j'):
+        path = write_mp3(tmpdir, d + '/intro.mp3', 2, v2=False, v1=False)
+        # keep the master older than the transcode
+        os.utime(path, (0, 0))
+    module.rule = MatchRule(GlobMatcher('*'), pre=['intro.mp3'])
+    module.expected = id3v2() + frames(2) + frames(6) + id3v1('main/show.mp3')
+    initSpliceIndex()
+
+
+def teardown_module(module):
+    shutil.rmtree(module.tmpdir)
+
+
+def _get(app, range=None, path='/show.mp3', query=''):
+    environ = {'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': query}
+    if range:
+        environ['HTTP_RANGE'] = range
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+        response['headers'] = dict(headers)
+    chunks = list(app(environ, start_response))
+    for chunk in chunks:
+        # as WSGI requires
+        assert type(chunk) is str
+    body = ''.join(chunks)
+    return response['status'], response['headers'], body
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range('bytes=10-19', 100) == (10, 20)
+    assert parse_range('bytes=90-', 100) == (90, 100)
+    assert parse_range('bytes=-10', 100) == (90, 100)
+    assert parse_range('bytes=50-1000', 100) == (50, 100)
+    assert parse_range('bytes=0-1,5-6', 100) is None
+    assert parse_range('bytes=a-b', 100) is None
+    assert parse_range('items=0-1', 100) is None
+    try:
+        parse_range('bytes=100-', 100)
+    except RangeNotSatisfiable:
+        pass
+    else:
+        assert False, "expected RangeNotSatisfiable"
+
+
+def test_stream_ranges():
+    app = EwaApp(rule, tmpdir, stream=True, buffsize=100)
+    status, headers, body = _get(app)
+    assert status.startswith('200')
+    assert body == expected
+    assert headers['Content-Length'] == str(len(expected))
+    assert headers['Accept-Ranges'] == 'bytes'
+
+    # a range straddling the end of the intro and the start of the show
+    start = len(id3v2()) + 700
+    status, headers, body = _get(app, 'bytes=%d-%d' % (start, start + 499))
+    assert status.startswith('206')
+    assert body == expected[start:start + 500]
+    assert headers['Content-Range'] == 'bytes %d-%d/%d' % (
+        start, start + 499, len(expected))
+    assert headers['Content-Length'] == '500'
+
+    status, headers, body = _get(app, 'bytes=-128')
+    assert body == id3v1('main/show.mp3')
+
+    status, headers, body = _get(app, 'bytes=%d-' % len(expected))
+    assert status.startswith('416')
+    assert headers['Content-Range'] == 'bytes */%d' % len(expected)
+
+
+def test_stream_rechunked():
+    # engines that don't plan are cut into chunks of write_size
+    app = EwaApp(rule, tmpdir, stream=True, use_xsendfile=False,
+                 buffsize=100, write_size=1000,
+                 splicer=ewa.mp3._resync_splicer)
+    environ = {'SCRIPT_NAME': '', 'PATH_INFO': '/show.mp3',
+               'QUERY_STRING': ''}
+    chunks = list(app(environ, lambda status, headers: None))
+    assert ''.join(chunks) == expected
+    assert [len(c) for c in chunks[:-1]] == [1000] * (len(chunks) - 1)
+
+
+def test_stream_mmap():
+    # views of the mapped files are sent as strings
+    for write_size in (0, 1000):
+        app = EwaApp(rule, tmpdir, stream=True, use_xsendfile=False,
+                     buffsize=100, write_size=write_size,
+                     splicer=ewa.mp3._mmap_splicer)
+        status, headers, body = _get(app)
+        assert body == expected
+        status, headers, body = _get(app, 'bytes=10-1009')
+        assert body == expected[10:1010]
+
+
+def test_stream_static_fallback():
+    # a file that can't be spliced (here, a VBR one) is sent as it
+    # is, trailing fragment and all
+    raw = (id3v2() + xing_frame(3, 3 * FRAMELEN_128) + frames(3)
+           + frames(1)[:100])
+    open(os.path.join(tmpdir, 'main', 'broken.mp3'), 'wb').write(raw)
+    app = EwaApp(rule, tmpdir, stream=True, use_xsendfile=False)
+    status, headers, body = _get(app, path='/broken.mp3')
+    assert status.startswith('200')
+    assert body == raw
+    status, headers, body = _get(app, 'bytes=0-9', path='/broken.mp3')
+    assert body == raw[:10]
+
+
+def test_plan_matches_splice():
+    main = os.path.join(tmpdir, 'main', 'show.mp3')
+    files = [os.path.join(tmpdir, 'extra/transcoded/128/44100/j/intro.mp3'),
+             main]
+    plan = ewa.mp3.splice_plan(files, main)
+    assert ewa.mp3.plan_length(plan) == len(expected)
+    assert ''.join(ewa.mp3.splice(files, main)) == expected
+    assert ''.join(ewa.mp3.read_plan(plan, 64, 3, 1000)) == expected[3:1000]
+
+
+def test_manifests():
+    targetdir = os.path.join(tmpdir, 'combined')
+    app = EwaApp(rule, tmpdir, targetdir, use_xsendfile=False,
+                 manifests=True)
+    status, headers, body = _get(app)
+    assert status.startswith('200')
+    assert body == expected
+    manifest = os.path.join(targetdir, 'show.mp3.manifest')
+    assert os.path.getsize(manifest) < 1000
+    assert not os.path.exists(os.path.join(targetdir, 'show.mp3'))
+    status, headers, body = _get(app, 'bytes=10-99')
+    assert body == expected[10:100]
+
+    # changing an extra makes the manifest stale
+    intro = write_mp3(tmpdir, 'extra/transcoded/128/44100/j/intro.mp3', 3,
+                      v2=False, v1=False)
+    os.utime(intro, (1, 1))
+    status, headers, body = _get(app)
+    assert body == id3v2() + frames(3) + frames(6) + id3v1('main/show.mp3')
+    write_mp3(tmpdir, 'extra/transcoded/128/44100/j/intro.mp3', 2,
+              v2=False, v1=False)
+    os.utime(intro, (0, 0))
+
+
+def test_sendfile2():
+    literaldir = os.path.join(tmpdir, 'literals')
+    for kw in (dict(stream=True, xing=True),
+               dict(targetdir=os.path.join(tmpdir, 'combined2'),
+                    manifests=True)):
+        app = EwaApp(rule, tmpdir, sendfile_header=SENDFILE2_HEADER,
+                     literaldir=literaldir, **kw)
+        status, headers, body = _get(app)
+        # ewa itself sends no audio
+        assert body == ''
+        ranges = headers[SENDFILE2_HEADER].split(', ')
+        assert ranges[-1].startswith(urllib.quote(tmpdir))
+        status, headers2, body = _get(SendfileMiddleware(app))
+        assert SENDFILE2_HEADER not in headers2
+        assert len(body) == int(headers['Content-Length'])
+        assert body.endswith(frames(6) + id3v1('main/show.mp3'))
+        status, headers, body = _get(SendfileMiddleware(app), 'bytes=-200')
+        assert status.startswith('206')
+        assert body == (frames(6) + id3v1('main/show.mp3'))[-200:]
+        # ranges reuse the files the whole output spilled
+        spilled = sorted(os.walk(literaldir))
+        for r in ('bytes=0-9', 'bytes=5-20', 'bytes=-100', 'bytes=-3'):
+            status, headers, body = _get(SendfileMiddleware(app), r)
+            assert status.startswith('206')
+        assert sorted(os.walk(literaldir)) == spilled
+    # the Xing frame and the manifest's two tags had to be written out
+    assert len(os.listdir(literaldir)) == 3
+    for root, dirs, files in os.walk(literaldir):
+        for f in files:
+            os.utime(os.path.join(root, f), (0, 0))
+    # only the streamed Xing frame isn't in a manifest
+    stale = list(find_stale_literals(literaldir,
+                                     os.path.join(tmpdir, 'combined2')))
+    assert len(stale) == 1
+    assert open(stale[0], 'rb').read()[36:40] in ('Xing', 'Info')
+    # but it was used just now
+    _get(EwaApp(rule, tmpdir, sendfile_header=SENDFILE2_HEADER,
+                literaldir=literaldir, stream=True, xing=True))
+    assert not list(find_stale_literals(literaldir,
+                                        os.path.join(tmpdir, 'combined2')))
+
+
+def test_format_sendfile2():
+    assert format_sendfile2([('/a b,c', 0, 10), ('/d', 5, 0),
+                             ('/e', 20, 1)]) == '/a%20b%2Cc 0-9, /e 20-20'
+
+
+def test_timing():
+    targetdir = os.path.join(tmpdir, 'combined3')
+    app = EwaApp(rule, tmpdir, targetdir, use_xsendfile=False,
+                 duration_headers=True)
+    status, headers, body = _get(app)
+    # 1152 samples a frame at 44100Hz
+    assert headers['X-Content-Duration'] == '%.3f' % (8 * 1152 / 44100.0)
+    assert headers['X-Segment-Offsets'] == '0.000,%.3f' % (2 * 1152 / 44100.0)
+    # the timing was written along with the combined file
+    sidecar = os.path.join(targetdir, 'show.mp3.json')
+    data = json.load(open(sidecar))
+    assert data['segments'][1] == dict(file='main/show.mp3',
+                                       start=round(2 * 1152 / 44100.0, 3),
+                                       duration=round(6 * 1152 / 44100.0, 3))
+    # and describes the file served, not what the rule says now
+    app.rule = MatchRule(GlobMatcher('*'), pre=['intro.mp3', 'intro.mp3'])
+    status, headers, body = _get(app)
+    assert body == expected
+    assert headers['X-Segment-Offsets'] == '0.000,%.3f' % (2 * 1152 / 44100.0)
+    # streamed output is timed from what is streamed
+    for kw in (dict(stream=True),
+               dict(stream=True, use_xsendfile=False,
+                    splicer=ewa.mp3._resync_splicer)):
+        app = EwaApp(rule, tmpdir, duration_headers=True, **kw)
+        status, headers, body = _get(app)
+        assert headers['X-Content-Duration'] == '%.3f' % (
+            8 * 1152 / 44100.0)
+
+
+def test_start_time():
+    write_mp3(tmpdir, 'main/long.mp3', 100)
+    write_mp3(tmpdir, 'main/xinged.mp3', 10,
+              first=xing_frame(10, 10 * FRAMELEN_128, tag='Info'))
+    frametime = 1152 / 44100.0
+    for kw in (dict(stream=True),
+               dict(stream=True, xing=True),
+               dict(targetdir=os.path.join(tmpdir, 'combined4'),
+                    use_xsendfile=False),
+               dict(targetdir=os.path.join(tmpdir, 'combined4x'),
+                    use_xsendfile=False, xing=True)):
+        app = EwaApp(rule, tmpdir, **kw)
+        status, headers, body = _get(app, path='/long.mp3', query='start=1')
+        # the 39th frame, the 37th of the main file
+        assert headers['X-Start-Time'] == '%.3f' % (38 * frametime)
+        assert body == (id3v2() + frames(100)[36 * FRAMELEN_128:] +
+                        id3v1('main/long.mp3'))
+        # in the intro
+        status, headers, body = _get(app, path='/long.mp3',
+                                     query='start=0.05')
+        assert headers['X-Start-Time'] == '%.3f' % frametime
+        assert body == (id3v2() + frames(2)[FRAMELEN_128:] + frames(100) +
+                        id3v1('main/long.mp3'))
+        # the main file's own Info frame is left out as it is from
+        # the whole output, when that has one of its own
+        status, headers, body = _get(app, path='/xinged.mp3',
+                                     query='start=0.03')
+        audio = frames(2)[FRAMELEN_128:] + frames(10)
+        if not kw.get('xing'):
+            audio = (frames(2)[FRAMELEN_128:] +
+                     xing_frame(10, 10 * FRAMELEN_128, tag='Info') +
+                     frames(10))
+        assert body == id3v2() + audio + id3v1('main/xinged.mp3')
+        status, headers, body = _get(app, path='/long.mp3',
+                                     query='start=junk')
+        assert 'X-Start-Time' not in headers
+        assert len(body) == int(headers.get('Content-Length', len(body)))
+
+
+def test_hls():
+    write_mp3(tmpdir, 'main/long.mp3', 100)
+    app = EwaApp(rule, tmpdir, os.path.join(tmpdir, 'combined5'),
+                 use_xsendfile=False, hls=True, hls_target_duration=2)
+    status, headers, body = _get(app, path='/long.mp3.m3u8')
+    assert headers['Content-Type'] == 'application/vnd.apple.mpegurl'
+    lines = body.splitlines()
+    assert lines[0] == '#EXTM3U' and lines[-1] == '#EXT-X-ENDLIST'
+    assert '#EXT-X-DISCONTINUITY' in lines
+    ranges = [(lines[i + 1], lines[i + 2]) for i, l in enumerate(lines)
+              if l.startswith('#EXTINF')]
+    intro = '/_media/extra/transcoded/128/44100/j/intro.mp3'
+    assert ranges[0] == ('#EXT-X-BYTERANGE:%d@0' % (2 * FRAMELEN_128), intro)
+    # 64 frames is the nearest seekpoint multiple to 2 seconds
+    main = [r for r in ranges if r[1] == '/_media/main/long.mp3']
+    assert [r[0] for r in main] == [
+        '#EXT-X-BYTERANGE:%d@%d' % (min(64, 100 - n) * FRAMELEN_128,
+                                    len(id3v2()) + n * FRAMELEN_128)
+        for n in (0, 64)]
+    # fetching the segments gives back the audio
+    audio = ''
+    for byterange, url in ranges:
+        length, offset = map(int, byterange.split(':')[1].split('@'))
+        status, headers, body = _get(app, 'bytes=%d-%d' % (
+            offset, offset + length - 1), path=url)
+        assert status.startswith('206')
+        audio += body
+    assert audio == frames(2) + frames(100)
+    assert _get(app, path='/_media/../main/long.mp3')[0].startswith('404')
+    assert _get(app, path='/_media/extra/master/intro.mp3')[0].startswith(
+        '404')